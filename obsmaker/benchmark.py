@@ -0,0 +1,352 @@
+"""
+Benchmark of the AOR translation, observation build and scan writing.
+
+Synthetic USPOT proposals are generated with different numbers of
+requests, map sizes, OTF legs and nod patterns, then translated, built
+and written headless. Results are printed and saved as JSON to compare
+performances between versions:
+
+    python -m obsmaker.benchmark -o benchmark.json
+
+With --xml, the XML backends are compared on proposal files of 1 to 100 MB.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import io
+
+# Cases: name, requests, map points (OTF legs), OTF, nod pattern
+CASES = [
+    ('small', 4, 9, False, 'ABBA'),
+    ('many requests', 40, 9, False, 'ABBA'),
+    ('large map', 2, 400, False, 'ABBA'),
+    ('large map ABA', 2, 400, False, 'ABA'),
+    ('OTF legs', 4, 50, True, 'AB'),
+]
+QUICK_CASES = [('small', 4, 9, False, 'ABBA'), ('OTF legs', 2, 10, True, 'AB')]
+# Sizes of the proposal files for the XML backends [MB]
+XML_SIZES = [1, 10, 100]
+QUICK_XML_SIZES = [1, 10]
+
+
+def syntheticRequest(index, npoints, otf=False, nodpattern='ABBA', mode=None):
+    """
+    XML of a FIFI-LS request with a map of npoints points (or OTF legs).
+    The observing mode follows the nod pattern unless given.
+    """
+    if otf:
+        mode, chop = 'OTF_MAP', 'None'
+        points = ''.join(
+            '<deltaX>%.1f</deltaX><deltaY>%.1f</deltaY><scanSpeed>5.0</scanSpeed>'
+            '<scanDirection>%s</scanDirection>' % (i * 10., i * 5., ['+X', '-X', '+Y', '-Y'][i % 4])
+            for i in range(npoints))
+    else:
+        if mode is None:
+            mode = 'SYMMETRIC_CHOP' if nodpattern == 'ABBA' else 'ASYMMETRIC_CHOP'
+        chop = {'SYMMETRIC_CHOP': 'Sym', 'TOTAL_POWER': 'None'}.get(mode, 'Asym')
+        side = max(1, int(npoints ** 0.5))
+        points = ''.join('<deltaRaV>%.1f</deltaRaV><deltaDecW>%.1f</deltaDecW>' %
+                         ((i % side) * 15., (i // side) * 15.) for i in range(npoints))
+    target = 'Target%d' % (index % 3)
+    return ('<Request><target><name>{0}</name><position><lon>83.8221</lon><lat>-5.3911</lat>'
+            '<equinoxDesc>J2000</equinoxDesc></position></target><instrument><data>'
+            '<InstrumentName>FIFI-LS</InstrumentName><aorID>90_0001_{1}</aorID>'
+            '<title>bench{1}</title><SourceType>Point_Source</SourceType>'
+            '<WavelengthBlue>63.183705</WavelengthBlue><BandwidthBlue>1000</BandwidthBlue>'
+            '<WavelengthRed>157.7409</WavelengthRed><BandwidthRed>1000</BandwidthRed>'
+            '<Redshift>0</Redshift><RedshiftUnit>kmPerSec</RedshiftUnit>'
+            '<Dichroic>105 micron</Dichroic><PrimeArray>Red</PrimeArray>'
+            '<NodPattern>{2}</NodPattern><ObsPlanMode>{3}</ObsPlanMode><ChopType>{4}</ChopType>'
+            '<ChopThrow>120</ChopThrow><ChopAngleCoordinate>J2000</ChopAngleCoordinate>'
+            '<ChopAngle>0</ChopAngle><ReferenceType>Offset</ReferenceType><MapRefPos>false</MapRefPos>'
+            '<RAOffset>300</RAOffset><DecOffset>0</DecOffset><TimePerPoint>30</TimePerPoint>'
+            '<Repeat>2</Repeat><MapRotationAngle>15</MapRotationAngle><PlannedTime>1800</PlannedTime>'
+            '{5}</data></instrument></Request>').format(target, index, nodpattern, mode, chop, points)
+
+
+def syntheticAOR(nrequests, npoints, otf=False, nodpattern='ABBA', mode=None):
+    """XML of a USPOT proposal with nrequests FIFI-LS requests."""
+    requests = ''.join(syntheticRequest(i, npoints, otf, nodpattern, mode)
+                       for i in range(nrequests))
+    return ('<?xml version="1.0"?><AORs><list><ProposalInfo><ProposalID>90_0001</ProposalID>'
+            '<Investigator Honorific="Dr" FirstName="Jane" LastName="Doe"/></ProposalInfo>'
+            '<vector>' + requests + '</vector></list></AORs>')
+
+
+def writeProposal(filename, megabytes, npoints=9):
+    """Write a synthetic proposal of about the given size, returns the number of requests."""
+    header, footer = syntheticAOR(0, npoints).split('<vector>')
+    with open(filename, 'w') as f:
+        f.write(header + '<vector>')
+        size, n = 0, 0
+        while size < megabytes * 1024 * 1024:
+            request = syntheticRequest(n, npoints)
+            f.write(request)
+            size += len(request)
+            n += 1
+        f.write(footer)
+    return n
+
+
+def runXML(sizes=XML_SIZES, verbose=False):
+    """Time the parsing and the reading of the requests with each XML backend."""
+    from obsmaker import xmlparser
+    from obsmaker.io import readAOR, groupRequests
+    default = xmlparser.backend
+    backends = ['ElementTree'] if xmlparser.lxmlTree is None else ['lxml', 'ElementTree']
+    workdir = tempfile.mkdtemp(prefix='obsmaker_xml_')
+    results = []
+    try:
+        for megabytes in sizes:
+            aorfile = os.path.join(workdir, '%dMB.aor' % megabytes)
+            nrequests = writeProposal(aorfile, megabytes)
+            for backend in backends:
+                xmlparser.setBackend(backend)
+                start = time.perf_counter()
+                tree = xmlparser.parse(aorfile)
+                parse_s = time.perf_counter() - start
+                start = time.perf_counter()
+                groups = groupRequests(tree.find('list/vector'))
+                aors = [readAOR(request) for requests in groups.values() for request in requests]
+                read_s = time.perf_counter() - start
+                del tree, groups, aors
+                results.append({'backend': backend, 'megabytes': megabytes,
+                                'requests': nrequests, 'parse_s': parse_s, 'read_s': read_s,
+                                'total_s': parse_s + read_s,
+                                'mb_per_s': megabytes / (parse_s + read_s)})
+                if verbose:
+                    print(results[-1])
+    finally:
+        xmlparser.setBackend(default)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {'environment': environment(), 'xml': results}
+
+
+def reportXML(results):
+    lines = ['{0:12s} {1:>6s} {2:>9s} {3:>9s} {4:>9s} {5:>9s} {6:>7s}'.format(
+        'backend', 'MB', 'requests', 'parse s', 'read s', 'total s', 'MB/s')]
+    for r in results['xml']:
+        lines.append('{0:12s} {1:6d} {2:9d} {3:9.3f} {4:9.3f} {5:9.3f} {6:7.1f}'.format(
+            r['backend'], r['megabytes'], r['requests'], r['parse_s'], r['read_s'],
+            r['parse_s'] + r['read_s'], r['mb_per_s']))
+    # the backend is chosen on the time to parse and read, not to parse only
+    for megabytes in sorted(set(r['megabytes'] for r in results['xml'])):
+        runs = [r for r in results['xml'] if r['megabytes'] == megabytes]
+        fastest = min(runs, key=lambda r: r['parse_s'] + r['read_s'])
+        lines.append('{0:d} MB: fastest {1:s}'.format(megabytes, fastest['backend']))
+    return '\n'.join(lines)
+
+
+def translate(aorfile, outdir):
+    """Translate the FIFI-LS requests of an AOR file into *.sct and map files."""
+    from obsmaker.io import readAOR, writeFAOR, groupRequests
+    from obsmaker import xmlparser
+    tree = xmlparser.parse(aorfile)
+    PropID = tree.find('list/ProposalInfo/ProposalID').text
+    PI = tree.find('list/ProposalInfo/Investigator')
+    PIname = PI.attrib['FirstName'] + ' ' + PI.attrib['LastName']
+    n = 0
+    for (target, inst), requests in groupRequests(tree.find('list/vector')).items():
+        if inst == 'FIFI-LS':
+            for aor in requests:
+                writeFAOR(readAOR(aor), PropID, PIname, outdir)
+                n += 1
+    return n
+
+
+def loadTemplate(tw, sctfile, overrides=None):
+    """
+    Load a *.sct file in the GUI, with some values possibly replaced.
+    The replaced values are set again after loading, as if edited in the
+    GUI, since the instrumental mode resets some fields (e.g. nod pattern).
+    """
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtWidgets import QComboBox, QLineEdit
+    from obsmaker.io import readSct
+    tw.setDefaults()
+    # Back to the first pattern without asking for a map file
+    tw.mapPattern.blockSignals(True)
+    tw.mapPattern.setCurrentIndex(0)
+    tw.mapPattern.blockSignals(False)
+    tw.sctfile = sctfile
+    pars = readSct(sctfile)
+    pars.update(overrides or {})
+    tw.update_gui(pars)
+    for key, value in (overrides or {}).items():
+        widget = tw.k2tw[key]
+        if isinstance(widget, QComboBox):
+            widget.setCurrentIndex(widget.findText(value, Qt.MatchFixedString))
+        elif isinstance(widget, QLineEdit):
+            widget.setText(value)
+    tw.pathFile = os.path.dirname(sctfile)
+    tw.mapListPath = os.path.join(tw.pathFile, os.path.basename(tw.mapListPath))
+
+
+def build(tw):
+    """Build the loaded template, returns False on failure."""
+    try:
+        if tw.prepareBuild() == False or tw.calculate() == False:
+            return False
+        tw.buildDone()
+    except Exception as error:
+        print('Build failed:', error)
+        return False
+
+
+def peakRSS():
+    """Peak resident memory of the process [MB], None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. / 1024. if sys.platform == 'darwin' else rss / 1024.
+
+
+def runCase(tw, name, nrequests, npoints, otf, nodpattern, workdir, memory=False):
+    """Translate, build and write one synthetic proposal."""
+    from obsmaker.timers import timers
+    casedir = os.path.join(workdir, name.replace(' ', '_'))
+    os.makedirs(casedir)
+    aorfile = os.path.join(casedir, 'bench.aor')
+    with open(aorfile, 'w') as f:
+        f.write(syntheticAOR(nrequests, npoints, otf, nodpattern))
+    timers.reset()
+    if memory:
+        tracemalloc.start()
+    result = {'case': name, 'requests': nrequests, 'points': npoints, 'otf': otf,
+              'nodpattern': nodpattern}
+
+    start = time.perf_counter()
+    translated = translate(aorfile, casedir)
+    result['translate_s'] = time.perf_counter() - start
+    result['aors_per_s'] = translated / result['translate_s']
+
+    build_s = write_s = 0.
+    rebuild = {'unchanged': 0., 'chop amplitude': 0., 'red wavelength': 0.}
+    scans = failed = 0
+    outdir = os.path.join(casedir, 'scans')
+    sctfiles = sorted(f for f in os.listdir(casedir) if f.endswith('.sct'))
+    for sctfile in sctfiles:
+        loadTemplate(tw, os.path.join(casedir, sctfile))
+        tw.sctdir.setText(outdir)
+        tw.graph.cache.clear()  # first build from scratch
+        start = time.perf_counter()
+        if build(tw) == False:
+            failed += 1
+            continue
+        build_s += time.perf_counter() - start
+        # Rebuild latency after single field edits
+        for edit, widget in (('unchanged', None), ('chop amplitude', tw.chopAmp),
+                             ('red wavelength', tw.redWave)):
+            if widget is not None:
+                widget.setText(str(float(widget.text() or 0) + 1))
+            start = time.perf_counter()
+            build(tw)
+            rebuild[edit] += time.perf_counter() - start
+        start = time.perf_counter()
+        output = tw.prepareWrite()
+        if tw.writeScans(output) == False:
+            output.abort()
+            failed += 1
+            continue
+        write_s += time.perf_counter() - start
+    for _, _, files in os.walk(outdir):
+        scans += sum(f.endswith('.scn') for f in files)
+
+    built = max(1, len(sctfiles) - failed)
+    result.update({'templates': len(sctfiles), 'failed': failed, 'build_s': build_s,
+                   'rebuild_s': {k: v / built for k, v in rebuild.items()},
+                   'write_s': write_s, 'scans': scans,
+                   'scans_per_s': scans / write_s if write_s > 0 else None})
+    if memory:
+        result['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024. / 1024.
+        tracemalloc.stop()
+    result['stages'] = timers.summary()
+    return result
+
+
+def environment():
+    import numpy
+    from obsmaker import __version__
+    commit = None
+    try:
+        import subprocess
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except Exception:
+        pass
+    return {'obsmaker': __version__, 'commit': commit, 'python': platform.python_version(),
+            'numpy': numpy.__version__, 'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def run(cases=CASES, memory=False, verbose=False):
+    """Run the benchmark cases, returns the results as a dictionary."""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    from obsmaker.dialog import TableWidget
+    from obsmaker.timers import timers
+    timers.enabled = True
+    tw = TableWidget(None)
+    tw.quiet = True  # no message boxes
+    workdir = tempfile.mkdtemp(prefix='obsmaker_bench_')
+    results = []
+    try:
+        for case in cases:
+            log = sys.stdout if verbose else io.StringIO()
+            with contextlib.redirect_stdout(log):
+                results.append(runCase(tw, *case, workdir, memory=memory))
+            app.processEvents()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    # the resident peak covers the whole process, not a single case
+    return {'environment': environment(), 'cases': results, 'peak_rss_mb': peakRSS()}
+
+
+def report(results):
+    lines = ['{0:16s} {1:>9s} {2:>8s} {3:>9s} {4:>10s} {5:>7s} {6:>8s} {7:>8s}'.format(
+        'case', 'AORs/s', 'build s', 'rebuild s', 'scans/s', 'scans', 'failed', 'peak MB')]
+    for r in results['cases']:
+        rebuild = max(r['rebuild_s'].values())
+        lines.append('{0:16s} {1:9.1f} {2:8.3f} {3:9.4f} {4:>10s} {5:7d} {6:8d} {7:>8s}'.format(
+            r['case'], r['aors_per_s'], r['build_s'], rebuild,
+            '%.1f' % r['scans_per_s'] if r['scans_per_s'] else '-', r['scans'], r['failed'],
+            '%.1f' % r['peak_traced_mb'] if 'peak_traced_mb' in r else '-'))
+    if results.get('peak_rss_mb'):
+        lines.append('Peak resident memory of the run: {0:.0f} MB'.format(results['peak_rss_mb']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark obsmaker on synthetic proposals.')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON results file')
+    parser.add_argument('--quick', action='store_true', help='run only small cases')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace the Python memory peak of each case (slower)')
+    parser.add_argument('--xml', action='store_true',
+                        help='compare the XML backends on large proposal files')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the obsmaker output')
+    args = parser.parse_args(argv)
+    if args.xml:
+        results = runXML(QUICK_XML_SIZES if args.quick else XML_SIZES, args.verbose)
+        print(reportXML(results))
+    else:
+        results = run(QUICK_CASES if args.quick else CASES, args.memory, args.verbose)
+        print(report(results))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved to', args.output)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Coverage of a map by the 5x5 spaxel footprint of FIFI-LS.
+
+The footprints of all the map positions are rasterized on a grid of
+offsets from the target. The spaxels are contiguous, so a footprint is
+a square of five spaxels rotated by the detector angle. Positions are
+processed in chunks, so that the memory does not grow with the map.
+"""
+import numpy as np
+
+NSPAXELS = 5  # spaxels along each side of the footprint
+
+
+class CoverageGrid:
+    """
+    Grid of square pixels [arcsec] of offsets from the target. Columns go
+    towards East with decreasing index, as the RA axis of sky images.
+    """
+
+    def __init__(self, dlam, dbet, footprint, pixel):
+        margin = footprint * np.sqrt(0.5)  # half diagonal of the footprint
+        self.pixel = pixel
+        xmin = np.floor((np.min(dlam) - margin) / pixel) * pixel
+        ymax = np.ceil((np.max(dbet) + margin) / pixel) * pixel
+        self.xmax = np.ceil((np.max(dlam) + margin) / pixel) * pixel
+        self.ymin = np.floor((np.min(dbet) - margin) / pixel) * pixel
+        self.nx = int(round((self.xmax - xmin) / pixel)) + 1
+        self.ny = int(round((ymax - self.ymin) / pixel)) + 1
+
+    def x(self, j):
+        return self.xmax - j * self.pixel
+
+    def y(self, k):
+        return self.ymin + k * self.pixel
+
+    def header(self, ra0, dec0):
+        """FITS WCS keywords of the grid for a target at ra0, dec0 [deg]."""
+        return {'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CUNIT1': 'deg', 'CUNIT2': 'deg',
+                'CRVAL1': ra0, 'CRVAL2': dec0,
+                'CRPIX1': self.xmax / self.pixel + 1, 'CRPIX2': -self.ymin / self.pixel + 1,
+                'CDELT1': -self.pixel / 3600., 'CDELT2': self.pixel / 3600.}
+
+
+def footprintCoverage(dlam, dbet, spaxel, detangle, grid, maxcells=2**20):
+    """
+    Number of footprints covering each pixel centre of grid, for map
+    positions at offsets dlam, dbet [arcsec], spaxels of size spaxel
+    [arcsec] and the detector y-axis at detangle [deg E of N].
+    At most maxcells pixels are tested at once.
+    """
+    dlam = np.asarray(dlam, dtype=float)
+    dbet = np.asarray(dbet, dtype=float)
+    half = NSPAXELS * spaxel / 2.
+    theta = np.radians(detangle)
+    cosa, sina = np.cos(theta), np.sin(theta)
+    # window of pixels around a position containing the rotated footprint
+    w = int(np.ceil(2 * half * np.sqrt(2) / grid.pixel)) + 3
+    wk, wj = np.indices((w, w)) - w // 2
+    wj, wk = wj.ravel(), wk.ravel()
+    counts = np.zeros(grid.nx * grid.ny, dtype=np.int64)
+    step = max(1, maxcells // (w * w))
+    for start in range(0, len(dlam), step):
+        x = dlam[start:start + step, None]
+        y = dbet[start:start + step, None]
+        j = np.rint((grid.xmax - x) / grid.pixel).astype(int) + wj
+        k = np.rint((y - grid.ymin) / grid.pixel).astype(int) + wk
+        east, north = grid.x(j) - x, grid.y(k) - y
+        u = east * cosa - north * sina  # along the detector axes
+        v = east * sina + north * cosa
+        inside = ((np.abs(u) < half) & (np.abs(v) < half) &
+                  (j >= 0) & (j < grid.nx) & (k >= 0) & (k < grid.ny))
+        counts += np.bincount((k * grid.nx + j)[inside], minlength=grid.nx * grid.ny)
+    return counts.reshape(grid.ny, grid.nx)
+
+
+def coverageSummary(counts, grid, dlam, dbet):
+    """
+    Text with the redundancy of the covered pixels and the holes, pixels
+    not covered inside the box of the map positions.
+    """
+    covered = counts[counts > 0]
+    k, j = np.indices(counts.shape)
+    x, y = grid.x(j), grid.y(k)
+    box = ((x >= np.min(dlam)) & (x <= np.max(dlam)) &
+           (y >= np.min(dbet)) & (y <= np.max(dbet)))
+    holes = np.count_nonzero(box & (counts == 0))
+    return ('{0:d} pixels of {1:.1f}" covered, redundancy min {2:d} median {3:.0f} max {4:d}, '
+            '{5:d} holes inside the map').format(
+                covered.size, grid.pixel, int(covered.min()), np.median(covered),
+                int(covered.max()), holes)
+
+
+def writeCoverageFITS(filename, images, grid, ra0, dec0):
+    """
+    Save the images (name: (data, unit)) as extensions of a FITS file
+    with the WCS of grid.
+    """
+    from astropy.io import fits
+    hdus = [fits.PrimaryHDU()]
+    for name, (data, unit) in images.items():
+        hdu = fits.ImageHDU(data, name=name)
+        hdu.header.update(grid.header(ra0, dec0))
+        hdu.header['BUNIT'] = unit
+        hdus.append(hdu)
+    fits.HDUList(hdus).writeto(filename, overwrite=True)
@@ -1,18 +1,31 @@
 from PyQt5.QtWidgets import (QWidget, QTabWidget, QVBoxLayout, QComboBox,
                              QLabel, QLineEdit, QMessageBox, QFileDialog,
-                             QPlainTextEdit, QSizePolicy, QScrollArea)
-from PyQt5.QtCore import Qt, QObject
-from PyQt5.QtGui import QTextCursor, QIntValidator
+                             QPlainTextEdit, QSizePolicy, QScrollArea, QProgressBar)
+from PyQt5.QtCore import Qt, QObject, QThread, QTimer, pyqtSignal
+from PyQt5.QtGui import QIntValidator
 import os
+import io
 import json
 import math
+import contextlib
+from collections import ChainMap
+from types import MappingProxyType
 import numpy as np
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 from obsmaker.grating import inductosyn2wavelength, wavelength2inductosyn
+from obsmaker.timing import (scanTiming, observationTiming, gratingTiming, optimizeGrating,
+                             bestSetups, writeSetupsCSV)
 from obsmaker.io import (velocity2z, writeSct, readMap, add2widgets, addComboBox,
                          createEditableBox, createWidget, createButton,
-                         writeTable)
+                         writeTable, ScanDirectory, ScanArchive, BackgroundWriter,
+                         ScanSequence, ScanTable, ScanRecorder, StatusLog)
+from obsmaker.worker import Task
+from obsmaker.graph import StageGraph
+from obsmaker.timers import timers, timed
+from obsmaker.sky import offsetsToSky, rotateOffsets, writePositionsCSV, writePositionsDS9
+from obsmaker.coverage import CoverageGrid, footprintCoverage, coverageSummary, writeCoverageFITS
+from obsmaker.spectral import scanGratingPositions, spectralHistogram, spectralSummary, writeSpectralFITS
 
 
 this_dir = os.path.dirname(os.path.realpath(__file__))
@@ -20,25 +33,21 @@ file = os.path.join(this_dir, "data", "defaults.json")
 with open(file) as f:
     defaults = json.load(f)
 
-def mround(number, multiple):
-    """
-    MS Excel's MROUND function.  Rounds up number to the closest integer
-    multiple of multiple if number % multiple is greater than
-    multiple / 2.
-    """
-    num = int(number / multiple)
-    rem = number % multiple
-    if rem > multiple / 2.:
-        return multiple * (num + 1)
-    else:
-        return multiple * num
-
-
 class TableWidget(QWidget):
+    # GUI updates requested by calculations, possibly from a worker thread
+    statusChanged = pyqtSignal(str)
+    fieldChanged = pyqtSignal(object, str)
+    messageRequested = pyqtSignal(str, str)
 
     def __init__(self, parent):
         super().__init__(parent)
         self.layout = QVBoxLayout(self)
+        self.statusChanged.connect(self.showStatus)
+        self.fieldChanged.connect(self.showField)
+        self.messageRequested.connect(self.showMessage)
+        self.task = None
+        self.quiet = False
+        self.graph = self.stageGraph()
 
         # Read defaults
         self.readDefaults()
@@ -78,21 +87,43 @@ class TableWidget(QWidget):
         self.timePerPoint = 0
         self.timePlanned = 0
         self.naifid = ''
+        self.gratingFront = None  # Pareto front of the last grating optimization
 
         # Col 1
         c1 = self.col1.layout
         self.translateAOR = createButton('Load and translate AOR')
-        c1.addRow(self.translateAOR, None)
+        self.translateAORDir = createButton('Translate AOR directory')
+        c1.addRow(self.translateAOR, self.translateAORDir)
         self.loadTemplate = createButton('Load template')
         self.exit = createButton('Exit')
         c1.addRow(self.loadTemplate, self.exit)
 
         self.buildObservation = createButton('Build observation')
-        self.buildObservation.clicked.connect(self.buildObs)
+        self.buildObservation.clicked.connect(self.startBuild)
         self.writeObservation = createButton('Write observation')
-        self.writeObservation.clicked.connect(self.writeObs)
+        self.writeObservation.clicked.connect(self.startWrite)
         self.writeObservation.setEnabled(False)
         c1.addRow(self.buildObservation, self.writeObservation)
+        self.dryRunObservation = createButton('Dry run')
+        self.dryRunObservation.clicked.connect(self.dryRun)
+        self.dryRunObservation.setEnabled(False)
+        self.stageTimings = createButton('Stage timings')
+        self.stageTimings.clicked.connect(self.showTimings)
+        c1.addRow(self.dryRunObservation, self.stageTimings)
+        self.exportPositions = createButton('Export positions')
+        self.exportPositions.clicked.connect(self.savePositions)
+        self.mapCoverage = createButton('Map coverage')
+        self.mapCoverage.clicked.connect(self.saveCoverage)
+        c1.addRow(self.exportPositions, self.mapCoverage)
+        self.spectralCoverage = createButton('Spectral coverage')
+        self.spectralCoverage.clicked.connect(self.saveSpectralCoverage)
+        c1.addRow(self.spectralCoverage, None)
+        self.cancelTask = createButton('Cancel')
+        self.cancelTask.clicked.connect(self.cancel)
+        self.cancelTask.setEnabled(False)
+        self.progressBar = QProgressBar()
+        self.progressBar.setTextVisible(True)
+        c1.addRow(self.cancelTask, self.progressBar)
 
         c1.addRow(QLabel('Top directory to save sct files'), None)
         self.sctdir = QLineEdit(os.getcwd())
@@ -102,6 +133,9 @@ class TableWidget(QWidget):
         self.selectSctdirectory = createButton('Select')
         self.selectSctdirectory.clicked.connect(self.selectSctdir)
         c1.addRow(self.selectSctdirectory, self.sctdir)
+        self.scanOutputs = ['Directory', 'Zip archive', 'Tar archive']
+        self.scanOutputMode = addComboBox('Scan files output: ', self.scanOutputs, c1)
+        self.scanTableMode = addComboBox('Scan table: ', ['None', 'CSV and NPZ'], c1)
 
         self.observationID = createEditableBox("None", 200, "Observation ID: ", c1)
         self.observationType = addComboBox('Observation type: ', self.obstypes, c1)
@@ -188,7 +222,14 @@ class TableWidget(QWidget):
         self.chopCompute = createButton('Compute')
         self.chopCompute.setEnabled(False)
         self.chopCompute.clicked.connect(self.grating_xls)
-        c3.addRow(self.chopCompute, None)
+        self.chopOptimize = createButton('Optimize')
+        self.chopOptimize.setEnabled(False)
+        self.chopOptimize.clicked.connect(self.optimizeGratingSetup)
+        c3.addRow(self.chopCompute, self.chopOptimize)
+        self.exportSetups = createButton('Export setups')
+        self.exportSetups.setEnabled(False)
+        self.exportSetups.clicked.connect(self.saveSetups)
+        c3.addRow(self.exportSetups, None)
         self.nodCycles = createEditableBox('', 70, 'No of nod cycles: ', c3)
         self.ccPerGratPos = createEditableBox('', 70, 'Chop cycles per grating pos: ', c3)
         #self.ccPerGratPos.setReadOnly(True) - editable on request of Christian
@@ -213,6 +254,8 @@ class TableWidget(QWidget):
         self.e_status_text = QPlainTextEdit()
         self.e_status_text.setReadOnly(True)
         status.addWidget(self.e_status_text)
+        self.statusLog = StatusLog(self.e_status_text, self.status_capacity, self.status_logfile,
+                                   self.status_logbytes, self.status_logbackups)
 
         # Arrays tab
         self.col4 = createWidget('F', self.tab2.layout)
@@ -300,6 +343,18 @@ class TableWidget(QWidget):
         # Define conversion
         self.defineConversion()
 
+        # Live timing, recomputed once the edits pause for 200 ms
+        self.liveTimer = QTimer(self)
+        self.liveTimer.setSingleShot(True)
+        self.liveTimer.setInterval(200)
+        self.liveTimer.timeout.connect(self.liveTiming)
+        for widget in self.k2tw.values():
+            if isinstance(widget, QLineEdit):
+                widget.textEdited.connect(self.scheduleTiming)
+            elif isinstance(widget, QComboBox):
+                widget.currentIndexChanged.connect(self.scheduleTiming)
+        self.velocity.textEdited.connect(self.scheduleTiming)
+
         # First conversion
         self.gui2vars()
 
@@ -745,6 +800,7 @@ class TableWidget(QWidget):
             noMapPoints, mapListPath = readMap()
             self.mapListPath = mapListPath
             self.noMapPoints.setText(str(noMapPoints))
+            self.scheduleTiming()
         except:
             print('Invalid map file.')
 
@@ -805,6 +861,17 @@ class TableWidget(QWidget):
         self.obs_con_samplesize = defaults["obs_con_samplesize"]
         self.gratstepsize = defaults["grating_step"]
         self.c = defaults["speed_of_light"]
+        self.status_capacity = defaults["status_capacity"]
+        self.status_logfile = defaults["status_logfile"]
+        self.status_logbytes = defaults["status_logbytes"]
+        self.status_logbackups = defaults["status_logbackups"]
+        timers.enabled = defaults["stage_timing"]
+        self.translate_workers = defaults["translate_workers"]
+        self.optimize_shown = defaults["optimize_shown"]
+        self.spaxel_red = defaults["spaxel_red"]
+        self.spaxel_blue = defaults["spaxel_blue"]
+        self.coverage_pixel = defaults["coverage_pixel"]
+        self.spectral_bin = defaults["spectral_bin"]
 
     def defineConversion(self):
         self.k2tw = {
@@ -971,31 +1038,121 @@ class TableWidget(QWidget):
         """
 
         try:
-            if self.pathFile == '' or self.mapListPath == '':
-                message = 'Upload a template before building the observation.'
-                QMessageBox.about(self, "Build", message)
-                return
-            self.writeObservation.setEnabled(False)
-            print('nodcycles before gui2vars ', self.var['nodcycles'])
-            result = self.gui2vars()
+            result = self.prepareBuild()
             if result != False:
-                print('path file before calculate is: ', self.pathFile)
-                print('nodcycles before calculate are: ', self.var['nodcycles'])
                 result = self.calculate()
                 if result != False:
-                    print('path file after calculate is: ', self.pathFile)
-                    self.var['ind_scanindex'] = 0
-                    self.var['commandline_option'] = '0'  # No command line option for the moment
-                    print('Observation built')
-                    self.update_status("Observation built. \n")
-                    self.writeObservation.setEnabled(True)
-                    self.chopCompute.setEnabled(True)
-                    # from pprint import pprint; pprint(self.var)
+                    self.buildDone()
         except:
             message = 'Something went wrong during building the observation.'
             QMessageBox.about(self, "Build", message)
             print(message)
 
+    def prepareBuild(self):
+        """
+        Check the template and save GUI parameters before the calculation.
+        """
+        if self.pathFile == '' or self.mapListPath == '':
+            message = 'Upload a template before building the observation.'
+            QMessageBox.about(self, "Build", message)
+            return False
+        self.liveTimer.stop()
+        self.writeObservation.setEnabled(False)
+        print('nodcycles before gui2vars ', self.var['nodcycles'])
+        result = self.gui2vars()
+        if result != False:
+            print('path file before calculate is: ', self.pathFile)
+            print('nodcycles before calculate are: ', self.var['nodcycles'])
+        return result
+
+    def buildDone(self):
+        print('path file after calculate is: ', self.pathFile)
+        self.var['ind_scanindex'] = 0
+        self.var['commandline_option'] = '0'  # No command line option for the moment
+        print('Observation built')
+        self.update_status("Observation built. \n")
+        self.writeObservation.setEnabled(True)
+        self.dryRunObservation.setEnabled(True)
+        self.chopCompute.setEnabled(True)
+        self.chopOptimize.setEnabled(True)
+        # from pprint import pprint; pprint(self.var)
+
+    def startBuild(self):
+        """
+        Build the observation in a worker thread, the GUI stays responsive.
+        """
+        try:
+            result = self.prepareBuild()
+        except:
+            result = False
+            message = 'Something went wrong during building the observation.'
+            QMessageBox.about(self, "Build", message)
+            print(message)
+        if result == False:
+            return
+        self.runTask(self.calculate, self.buildFinished, self.buildFailed)
+
+    def buildFinished(self, result):
+        self.endTask()
+        if result != False:
+            self.buildDone()
+
+    def buildFailed(self, error):
+        self.endTask()
+        message = 'Something went wrong during building the observation.'
+        QMessageBox.about(self, "Build", message)
+        print(message, error)
+
+    def runTask(self, function, finished, failed, cancelled=None, *args):
+        """
+        Run function in a worker thread with progress bar and cancel button.
+        The actions are disabled until the task ends.
+        """
+        self.busy = [button for button in (self.buildObservation, self.writeObservation,
+                                           self.dryRunObservation, self.chopCompute,
+                                           self.chopOptimize, self.translateAOR,
+                                           self.translateAORDir) if button.isEnabled()]
+        for button in self.busy:
+            button.setEnabled(False)
+        self.progressBar.reset()
+        self.cancelTask.setEnabled(True)
+        self.task = Task(function, *args)
+        self.task.progress.connect(self.showProgress)
+        self.task.finished.connect(finished)
+        self.task.failed.connect(failed)
+        self.task.cancelled.connect(cancelled if cancelled is not None else self.taskCancelled)
+        self.task.start()
+
+    def endTask(self):
+        self.task.wait()
+        self.task = None
+        self.cancelTask.setEnabled(False)
+        for button in self.busy:
+            button.setEnabled(True)
+
+    def cancel(self):
+        if self.task is not None:
+            self.cancelTask.setEnabled(False)
+            self.task.cancel()
+
+    def taskCancelled(self):
+        self.endTask()
+        self.update_status('Cancelled.\n')
+
+    def progress(self, done, total, text=''):
+        """
+        Report progress when running in a worker thread.
+        Raises Cancelled if the user cancelled the task.
+        """
+        if self.task is not None and QThread.currentThread() is self.task.thread:
+            self.task.report(done, total, text)
+
+    def showProgress(self, done, total, text):
+        self.progressBar.setMaximum(total)
+        self.progressBar.setValue(done)
+        self.progressBar.setFormat('%v/%m ' + text)
+
+    @timed
     def gui2vars(self):
         """
         Save selected GUI variables to local variables.
@@ -1072,6 +1229,8 @@ class TableWidget(QWidget):
         self.var['ch_scheme'] = self.chopScheme.currentText()
         self.var['symmetry'] = self.observingMode.currentText()
         self.var['scandesdir'] = self.sctdir.text()  # Same directory where the AOR files are read
+        self.var['scanoutput'] = self.scanOutputMode.currentText()
+        self.var['scantable'] = self.scanTableMode.currentText()
 
         # calculate any "support" variables needed
         self.var['target_lambda_hms'] = self.var['target_lambda']
@@ -1081,7 +1240,7 @@ class TableWidget(QWidget):
             coord_deg = SkyCoord(coord, unit=(u.hourangle, u.deg))
         except:
             message = 'Invalid Target RA-DEC.'
-            QMessageBox.about(self, "Target", message)
+            self.messageRequested.emit("Target", message)
             return False
         # target RA/DEC in decimal degrees
         self.var['target_lambda_deg'] = coord_deg.ra.degree
@@ -1096,6 +1255,11 @@ class TableWidget(QWidget):
         self.var['target_coordsys'] = 'J2000'
         self.var['map_centlambda'] = float(self.lambdaMapCenter.text())
         self.var['map_centbeta'] = float(self.betaMapCenter.text())
+        # a changed map file invalidates the map offsets
+        try:
+            self.var['maplist_mtime'] = os.path.getmtime(self.var['maplistpath'])
+        except:
+            self.var['maplist_mtime'] = None
         # # TOTAL_POWER mode if chop throw is 0
         # if self.var['chop_amp'] == 0.0:
         #     self.var['instmode'] = 'TOTAL_POWER'
@@ -1103,161 +1267,130 @@ class TableWidget(QWidget):
         if self.var['nodpattern'] == 'A':
             self.var['instmode'] = 'SKY'
 
+    @timed
     def calculate(self):
         """
         Make calculations and update GUI.
         """
-        result = self.calcTiming()  # calculate timing, update GUI
+        result = self.graph.run(self.var, progress=lambda done, total:
+                                self.progress(done, total, 'build steps'))
         if result == False:
-            print("ERROR in calc_timing")
             return False
-        print('path file after calctiming is: ', self.pathFile)
 
-        result = self.calcInductosynPos()  # calculate inductosyn position, update GUI
-        if result == False:
-            print('ERROR in calc_lookup')
-            return False
-        print('path file after calcinductonsynpos is: ', self.pathFile)
-        result = self.calcGrtpos()  # calculate grating positions and movements
-        if result == False:
-            print('ERROR in calc_grtpos')
-            return False
+    def stageGraph(self):
+        """
+        Stages deriving the observation quantities from the GUI variables.
+        """
+        graph = StageGraph()
+        graph.add('scan timing', self.scanTimingStage,
+                  ('chop_amp', 'chop_length', 'red_ramplen', 'blue_ramplen',
+                   'red_chopcyc', 'blue_chopcyc', 'red_posup', 'red_posdown',
+                   'blue_posup', 'blue_posdown', 'red_grtcyc', 'blue_grtcyc',
+                   'nodcycles', 'scandist'),
+                  ('scantiming', 'red_numgrtpos', 'blue_numgrtpos'),
+                  self.showScanTiming)
+        graph.add('map offsets', self.mapStage,
+                  ('pattern', 'maplistpath', 'maplist_mtime', 'dithmap_numpoints',
+                   'dithmap_stepsize', 'target_lambda_hms', 'target_beta_dms',
+                   'map_centlambda', 'map_centbeta', 'offpos_lambda', 'offpos_beta',
+                   'offpos_reduc', 'instmode', 'detangle'),
+                  ('numlistpoints', 'map_lambda', 'map_beta', 'nod_lambda', 'nod_beta',
+                   'skyspeed', 'scandirection', 'velangle', 'detangle', 'dithmap_stepsize'))
+        graph.add('observation time', self.observationTimeStage,
+                  ('scantiming', 'numlistpoints', 'nodcycles', 'nodpattern', 'symmetry'),
+                  ('obstiming', 'chop_tip'),
+                  self.showObservationTime)
+        graph.add('grating positions', self.inductosynPositions,
+                  ('red_micron', 'red_offset_type', 'red_offset',
+                   'blue_micron', 'blue_offset_type', 'blue_offset',
+                   'redshift', 'dichroic', 'order'),
+                  ('red_grtpos', 'blue_grtpos', 'red_grtpos_micron',
+                   'blue_grtpos_micron', 'redshift'),
+                  self.showGratingPositions)
+        graph.add('grating starts', self.gratingStartPositions,
+                  ('scandist', 'splits', 'nodcycles', 'red_lambda', 'red_grtpos',
+                   'red_sizeup_isu', 'red_sizedown_isu', 'red_posup', 'red_posdown',
+                   'blue_lambda', 'blue_grtpos', 'blue_sizeup_isu', 'blue_sizedown_isu',
+                   'blue_posup', 'blue_posdown'),
+                  ('numnodcyc', 'red_grstart', 'blue_grstart'))
+        graph.add('start wavelengths', self.startWavelengths,
+                  ('red_grstart', 'blue_grstart', 'dichroic', 'order'),
+                  ('red_lambdastart', 'blue_lambdastart'))
+        return graph
+
+    def scheduleTiming(self, *args):
+        """
+        Restart the live timing countdown, rapid edits are coalesced.
+        """
+        self.liveTimer.start()
+
+    def liveTiming(self):
+        """
+        Update timing and grating positions in the GUI without a full build.
+        The variables of the last build are kept for writing. Runs in the GUI
+        thread, since the stages work on self.var; cached stages make it fast.
+        """
+        if self.task is not None or self.pathFile == '' or self.mapListPath == '':
+            return
+        built, quiet = self.var, self.quiet
+        self.quiet = True
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                if self.gui2vars() != False:
+                    if self.calcTiming() != False:
+                        self.calcInductosynPos()
+        except Exception as error:
+            # partially edited fields often fail, the next pause retries
+            print('Live timing not updated: ', type(error).__name__, error)
+        finally:
+            self.var = built
+            self.quiet = quiet
 
     def calcTiming(self):
         """
         Calculate time estimates, set chopper values.
         """
+        return self.graph.run(self.var, ['observation time'])
+
+    @timed
+    def scanTimingStage(self):
         # obs_con_samplesize = 250.0  #250.0 SOFIA clock, 256.0 lab clock
         obs_con_samplesize = self.obs_con_samplesize
-        if self.var['chop_amp'] == 0.0:
-            obs_con_chopeff = 1.0
-        else:
-            obs_con_chopeff = 0.5
-
-        # ramp length in ms, red and blue
-        red_ramplen_ms = (1000.0 / obs_con_samplesize) * self.var['red_ramplen']
-        blue_ramplen_ms = (1000.0 / obs_con_samplesize) * self.var['blue_ramplen']
-        # for 2POINT chop scheme - time in samples
-        chopcyctime_sam = 2. * self.var['chop_length']
-
-        # time per grating position in samples, red and blue_ramplen_ms
-        red_grtpostime_sam = self.var['red_chopcyc'] * chopcyctime_sam
-        blue_grtpostime_sam = self.var['blue_chopcyc'] * chopcyctime_sam
         print('red chop cycle ', self.var['red_chopcyc'])
+        print('Nod cycles in calcTiming ', self.var['nodcycles'])
+        scan = scanTiming(self.var['chop_amp'], self.var['chop_length'],
+                          self.var['red_ramplen'], self.var['blue_ramplen'],
+                          self.var['red_chopcyc'], self.var['blue_chopcyc'],
+                          self.var['red_posup'], self.var['red_posdown'],
+                          self.var['blue_posup'], self.var['blue_posdown'],
+                          self.var['red_grtcyc'], self.var['blue_grtcyc'],
+                          self.var['nodcycles'], self.var['scandist'], obs_con_samplesize)
+        scan = {k: v.item() for k, v in scan.items()}
+        self.var['scantiming'] = scan
         # number of total grating positions = up + down, red and blue
-        self.var['red_numgrtpos'] = self.var['red_posup'] + self.var['red_posdown']
-        self.var['blue_numgrtpos'] = self.var['blue_posup'] + self.var['blue_posdown']
-        # time per grading cycle in samples
+        self.var['red_numgrtpos'] = scan['red_numgrtpos']
+        self.var['blue_numgrtpos'] = scan['blue_numgrtpos']
         print('red number of grat pos ', self.var['red_numgrtpos'])
-        red_grtcyctime_sam = self.var['red_numgrtpos'] * red_grtpostime_sam
-        blue_grtcyctime_sam = self.var['blue_numgrtpos'] * blue_grtpostime_sam
 
-        # override timepergrtcyc if distributing steps
-        print('Nod cycles in calcTiming ', self.var['nodcycles'])
-        if self.var['nodcycles'] >= 2:
-            if self.var['scandist'] == 'Up':
-                if self.var['red_posup'] <= 1:
-                    red_grtcyctime_sam = self.var['red_numgrtpos'] * red_grtpostime_sam
-                else:
-                    red_grtcyctime_sam = \
-                        (self.var['red_posup'] / self.var['nodcycles']) * red_grtpostime_sam
-                if self.var['blue_posup'] <= 1:
-                    blue_grtcyctime_sam = self.var['blue_numgrtpos'] * blue_grtpostime_sam
-                else:
-                    blue_grtcyctime_sam = \
-                        (self.var['blue_posup'] / self.var['nodcycles']) * blue_grtpostime_sam
-            elif self.var['scandist'] == 'Down':
-                if self.var['red_posdown'] <= 1:
-                    red_grtcyctime_sam = self.var['red_numgrtpos'] * red_grtpostime_sam
-                else:
-                    red_grtcyctime_sam = \
-                        (self.var['red_posdown'] / self.var['nodcycles']) * red_grtpostime_sam
-                if self.var['blue_posdown'] <= 1:
-                    blue_grtcyctime_sam = self.var['blue_numgrtpos'] * blue_grtpostime_sam
-                else:
-                    blue_grtcyctime_sam = \
-                        (self.var['blue_posdown'] / self.var['nodcycles']) * blue_grtpostime_sam
-
-        # time per scan in ms, red and blue
-        print('red_grtcyctime_sam ', red_grtcyctime_sam)
-        red_scantime_ms = (1000 / obs_con_samplesize) * self.var['red_grtcyc'] * red_grtcyctime_sam
-        blue_scantime_ms = (1000 / obs_con_samplesize) * self.var['blue_grtcyc'] * blue_grtcyctime_sam
-
-        # ramps per chop pos
-        red_rampsperchoppos = self.var['chop_length'] / self.var['red_ramplen']
-        blue_rampsperchoppos = self.var['chop_length'] / self.var['blue_ramplen']
-
-        # On-source chop cycle length in samples, account for chopper eff.
-        chopcyctime_src_sam = float(chopcyctime_sam) * obs_con_chopeff
-        red_grtpostime_src_sam = chopcyctime_src_sam * self.var['red_chopcyc']
-        # time spent by grating settling after a move in samps
-        red_grtsettime_sam = (self.var['red_posup'] - 1 + self.var['red_posdown'] - 1) * (0.25 / obs_con_samplesize)
-        # actual time per grating cycle on source
-        red_grtcyctime_src_sam = (red_grtpostime_src_sam * self.var['red_numgrtpos']) - red_grtsettime_sam
-        red_scantime_src_sam = red_grtcyctime_src_sam * self.var['red_grtcyc']
-        # blue_grtpostime_src_sam =  chopcyctime_src_sam * self.var['blue_chopcyc']
-        # time spent by grating settling after a move in samps
-        # blue_grtsettime_sam = \
-        #    (self.var['blue_posup'] - 1 + self.var['blue_posdown'] - 1) *  (0.25 / obs_con_samplesize)
-        # actual time per grating cycle on source
-        # blue_grtcyctime_src_sam =  \
-        #    (blue_grtpostime_src_sam * self.var['blue_numgrtpos']) - blue_grtsettime_sam
-        # blue_scantime_src_sam =  blue_grtcyctime_src_sam * self.var['blue_grtcyc']
-
-        # Loops to sort out special cases where we are distributing steps over nod nycles;
-        # also special case where only one channel does this if distributing scans, use the steps per nod cycle
-        if self.var['nodcycles'] >= 2:
-            obs4sample = 0.25 / obs_con_samplesize
-            nodCycles = self.var['nodcycles']
-            if self.var['scandist'] == 'Up':
-                rUp = self.var['red_posup']
-                # bUp = self.var['blue_posup']
-                if rUp <= 1:
-                    red_grtsettime_sam = rUp * obs4sample
-                else:
-                    red_grtsettime_sam = rUp / nodCycles * obs4sample
-                # if bUp <= 1:
-                #    blue_grtsettime_sam = bUp * obs4sample
-                # else:
-                #    blue_grtsettime_sam = bUp / nodCycles * obs4sample
-                red_grtcyctime_src_sam = red_grtpostime_src_sam * rUp / nodCycles - red_grtsettime_sam
-                red_scantime_src_sam = red_grtcyctime_src_sam * self.var['red_grtcyc']
-                # blue_grtcyctime_src_sam = blue_grtpostime_src_sam * bUp / nodCycles -  blue_grtsettime_sam
-                # blue_scantime_src_sam =  blue_grtcyctime_src_sam * self.var['blue_grtcyc']
-            elif self.var['scandist'] == 'Down':
-                rDo = self.var['red_posdown']
-                # bDo = self.var['blue_posdown']
-                # blue_grtsettime_sam = bDo / nodCycles * obs4sample
-                if rDo <= 1:
-                    red_grtsettime_sam = rDo * obs4sample
-                else:
-                    red_grtsettime_sam = rDo / nodCycles * obs4sample
-                # if bDo <= 1:
-                #    blue_grtsettime_sam = bDo * obs4sample
-                # else:
-                #    blue_grtsettime_sam = bDo / nodCycles * obs4sample
-                red_grtcyctime_src_sam = red_grtpostime_src_sam * rDo / nodCycles - red_grtsettime_sam
-                red_scantime_src_sam = red_grtcyctime_src_sam * self.var['red_grtcyc']
-                # blue_grtcyctime_src_sam = blue_grtpostime_src_sam * bDo / nodCycles -  blue_grtsettime_sam
-                # blue_scantime_src_sam = blue_grtcyctime_src_sam * self.var['blue_grtcyc']
-
-        # chop_freq = float(1.0 / (self.var['chop_length'] / obs_con_samplesize)) / 2.
-        chop_freq = obs_con_samplesize / self.var['chop_length'] * 0.5
-
-        # Update GUI
+    def showScanTiming(self):
+        scan = self.var['scantiming']
         # Ramp length in ms
-        self.redRampLengthMs.setText('{0:.2f}'.format(round(red_ramplen_ms, 2)))
-        self.blueRampLengthMs.setText('{0:.2f}'.format(round(blue_ramplen_ms, 2)))
+        self.fieldChanged.emit(self.redRampLengthMs, '{0:.2f}'.format(round(scan['red_ramplen_ms'], 2)))
+        self.fieldChanged.emit(self.blueRampLengthMs, '{0:.2f}'.format(round(scan['blue_ramplen_ms'], 2)))
         # Fill Scan file length (s), red and blue
-        self.redScanFileLength.setText('{0:.2f}'.format(round(red_scantime_ms / 1000., 2)))
-        self.blueScanFileLength.setText('{0:.2f}'.format(round(blue_scantime_ms / 1000., 2)))
+        self.fieldChanged.emit(self.redScanFileLength, '{0:.2f}'.format(round(scan['red_scantime_ms'] / 1000., 2)))
+        self.fieldChanged.emit(self.blueScanFileLength, '{0:.2f}'.format(round(scan['blue_scantime_ms'] / 1000., 2)))
         # Fill Ramps per chop pos, red and blue_rampsperchoppos
-        self.redRamp4ChopPos.setText(str(red_rampsperchoppos))
-        self.blueRamp4ChopPos.setText(str(blue_rampsperchoppos))
+        self.fieldChanged.emit(self.redRamp4ChopPos, str(scan['red_rampsperchoppos']))
+        self.fieldChanged.emit(self.blueRamp4ChopPos, str(scan['blue_rampsperchoppos']))
         # Chop frequency
-        self.chopLengthFrequency.setText(str(chop_freq))
+        self.fieldChanged.emit(self.chopLengthFrequency, str(scan['chop_freq']))
 
-        # Compute nod multipliers for integration time calculation
+    @timed
+    def mapStage(self):
+        """
+        Compute the map and nod offsets of the mapping pattern.
+        """
         if self.var['pattern'] == 'File':
             if self.var['maplistpath']:
                 result = self.calcFile()
@@ -1281,80 +1414,34 @@ class TableWidget(QWidget):
                 if result == False:
                     return False
 
+    @timed
+    def observationTimeStage(self):
+        # Compute nod multipliers for integration time calculation
         print('num list points is: ', self.var['numlistpoints'])
         print('nod cycles ', self.var['nodcycles'])
 
-        if self.var['nodpattern'] in ['ABA', 'AABAA']:
-            nodmultiplier = math.ceil(self.var['numlistpoints'] / self.var['nodcycles'])
-        elif self.var['nodpattern'] == 'A':
-            nodmultiplier = self.var['nodcycles']
-        else:  # 'AB' and 'ABBA'
-            nodmultiplier = 2 * self.var['nodcycles']
-        if int(self.var['nodcycles']) == 0:
-            nodmultiplier = 1
-
-        print('nodmultiplier ', nodmultiplier)
-
         # Determine C_TIP based on Chopper Symmetry
         if self.var['symmetry'] == 'Symmetric':
             self.var['chop_tip'] = 0.0
         else:
             self.var['chop_tip'] = 1.0
 
-        # Compute raw integration time - use the longest scan time between both channels
-        if red_scantime_ms >= blue_scantime_ms:
-            scantime_ms = red_scantime_ms
-        else:
-            scantime_ms = blue_scantime_ms
-        print('scantime in ms: ', scantime_ms)
-        npts = self.var['numlistpoints']
-        if self.var['nodpattern'] in ['ABA', 'AABAA']:
-            rawtime_ms = (npts + nodmultiplier) * scantime_ms
-        else:  # 'AB', 'ABBA', and 'A'
-            rawtime_ms = npts * scantime_ms * nodmultiplier
-        rawtime_sec = rawtime_ms / 1000.
-
-        # update GUI
-        print('integration time ', rawtime_sec)
-        self.rawIntTime.setText(str("%.1f" % rawtime_sec))
-
-        # Compute on source integration time
-        if self.var['nodpattern'] in ['ABA', 'AABAA']:
-            sourcetime_sam = self.var['numlistpoints'] * red_scantime_src_sam
-        else:
-            if self.var['symmetry'] == 'Symmetric':
-                symfactor = 1.
-            else:
-                symfactor = 2.
-            sourcetime_sam = npts * nodmultiplier / symfactor * red_scantime_src_sam
-        sourcetime_sec = float(sourcetime_sam / obs_con_samplesize)
-        print('time on source [s]: ', sourcetime_sec)
-        self.onsourceIntTime.setText(str("%.1f" % sourcetime_sec))
-
-        # Compute observation time including overheads
-        if self.var['nodpattern'] == 'A':
-            nodcycmovetime_sec = 0.
-            nodcycmovetime_total_sec = 0.
-            obstime_sec = rawtime_sec + nodcycmovetime_total_sec
-        elif self.var['nodpattern'] == 'AB':
-            nodcycmovetime_sec = 10.0 * 2.0 * self.var['nodcycles']
-            nodcycmovetime_total_sec = nodcycmovetime_sec * self.var['numlistpoints']
-            obstime_sec = rawtime_sec + nodcycmovetime_total_sec
-        elif self.var['nodpattern'] == 'ABBA':
-            nodcycmovetime_sec = 10.0 * self.var['nodcycles']
-            nodcycmovetime_total_sec = nodcycmovetime_sec * self.var['numlistpoints']
-            obstime_sec = rawtime_sec + nodcycmovetime_total_sec
-        elif self.var['nodpattern'] in ['ABA', 'AABAA']:
-            nodcycmovetime_sec = 10. * (self.var['nodcycles'] + 1)
-            nodcycscantime_sec = nodcycmovetime_sec + \
-                (red_scantime_ms / 1000. * (self.var['nodcycles'] + 1))
-            nodcycmovetime_total_sec = nodcycmovetime_sec *   \
-                (math.ceil(self.var['numlistpoints'] / self.var['nodcycles']))
-            nodcycscantime_total_sec = nodcycscantime_sec *  \
-                (math.ceil(self.var['numlistpoints'] / self.var['nodcycles']))
-            obstime_sec = nodcycscantime_total_sec
-        self.estObsTime.setText(str("%.1f" % obstime_sec))
-
+        timing = observationTiming(self.var['scantiming'], self.var['numlistpoints'],
+                                   self.var['nodcycles'], self.var['nodpattern'],
+                                   self.var['symmetry'], self.obs_con_samplesize)
+        timing = {k: v.item() for k, v in timing.items()}
+        self.var['obstiming'] = timing
+        print('nodmultiplier ', timing['nodmultiplier'])
+        print('integration time ', timing['rawtime_sec'])
+        print('time on source [s]: ', timing['sourcetime_sec'])
+
+    def showObservationTime(self):
+        timing = self.var['obstiming']
+        self.fieldChanged.emit(self.rawIntTime, str("%.1f" % timing['rawtime_sec']))
+        self.fieldChanged.emit(self.onsourceIntTime, str("%.1f" % timing['sourcetime_sec']))
+        self.fieldChanged.emit(self.estObsTime, str("%.1f" % timing['obstime_sec']))
+
+    @timed
     def calcFile(self):
         """
         Read mapping file.
@@ -1416,31 +1503,21 @@ class TableWidget(QWidget):
             self.var['numlistpoints'] = cnt
 
             if self.var['instmode'] == 'OTF_TP':  # n > 2
-                self.var['skyspeed'] = skyspeed  # always positive
                 self.var['scandirection'] = scandirXY  # '+/-X' or '+/-Y'
-                self.var['velangle'] = []
                 mapoffsets = np.array([map_lambda, map_beta])
                 if 'X' in scandirXY or 'Y' in scandirXY:  #  scandirXY[0] in ['X', 'Y']:
                     message = 'Outdated Scan Template loaded. Please ' + \
                         'load and save the .aor file with the most recent ' + \
                         'version of USpot and run the AOR Translator again.'
-                    QMessageBox.about(self, "Out Of Date", message)
+                    self.messageRequested.emit("Out Of Date", message)
+                    return False
+                if len(skyspeed) == 0:
+                    print('No scan leg in map file.')
                     return False
                 print('Scan offsets before rotation \n', mapoffsets)
-                for idx in range(len(skyspeed)):  # translate to EofN deg
-                    if scandirXY[idx] == '+X': velangle = 90
-                    if scandirXY[idx] == '-X': velangle = 270
-                    if scandirXY[idx] == '+Y': velangle = 0
-                    if scandirXY[idx] == '-Y': velangle = 180
-                    total_angle = ((velangle + self.var['detangle']) + 360) % 360
-                    self.var['velangle'].append(total_angle)  # normalize to 0 to 360/0
-                    # need to rotate by MapRotationAngle
-                    detang = self.var['detangle']
-                    detang *= np.pi / 180.0
-                    cosa = np.cos(detang)
-                    sina = np.sin(detang)
-                    r = np.array([[cosa, -sina], [sina, cosa]])
-                    rot_mapoffsets = np.dot(np.transpose(r), mapoffsets)
+                # all the legs at once, rotated by MapRotationAngle
+                self.var['skyspeed'], self.var['velangle'], rot_mapoffsets = \
+                    otfLegs(scandirXY, skyspeed, mapoffsets, self.var['detangle'])
                 print('Scan offsets after rotation \n', rot_mapoffsets)
                 self.var['map_lambda'] = rot_mapoffsets[0, :]
                 self.var['map_beta'] = rot_mapoffsets[1, :]
@@ -1451,6 +1528,7 @@ class TableWidget(QWidget):
             print('Problems to read map file ..')
             return False
 
+    @timed
     def calcNpoint(self):
         self.var['map_lambda'] = [None] * self.var['numlistpoints']
         self.var['map_beta'] = [None] * self.var['numlistpoints']
@@ -1497,6 +1575,7 @@ class TableWidget(QWidget):
                 self.var['nod_lambda'][4 + i] = mapclam
                 self.var['nod_beta'][4 + i] = mapcbet - idx * dithstep / self.var['offpos_reduc']
 
+    @timed
     def calcStare(self):
         if self.var['numlistpoints'] == 0:
             self.var['numlistpoints'] = 1
@@ -1505,70 +1584,41 @@ class TableWidget(QWidget):
         self.var['nod_lambda'] = [self.var['map_centlambda']] * self.var['numlistpoints']
         self.var['nod_beta'] = [self.var['map_centbeta']] * self.var['numlistpoints']
 
-    def upright(self, pointidx, corneridx):
-        dithstep = float(self.var['dithmap_stepsize'])
-        # go up
-        for upidx in range(1, corneridx):
-            self.var['map_lambda'][pointidx] = self.var['map_lambda'][pointidx - 1] + dithstep
-            self.var['map_beta'][pointidx] = self.var['map_beta'][pointidx - 1]
-            self.var['nod_lambda'][pointidx] = self.var['nod_lambda'][pointidx - 1] +  \
-                dithstep / float(self.var['offpos_reduc'])
-            self.var['nod_beta'][pointidx] = self.var['nod_beta'][pointidx - 1]
-            pointidx += 1
-        # go right
-        for rightidx in range(1, corneridx):
-            self.var['map_lambda'][pointidx] = self.var['map_lambda'][pointidx - 1]
-            self.var['map_beta'][pointidx] =  self.var['map_beta'][pointidx - 1] + dithstep
-            self.var['nod_lambda'][pointidx] =  self.var['nod_lambda'][pointidx - 1]
-            self.var['nod_beta'][pointidx] =  self.var['nod_beta'][pointidx - 1] +  \
-                dithstep / float(self.var['offpos_reduc'])
-            pointidx += 1
-
-    def downleft(self, pointidx, corneridx):
-        dithstep = float(self.var['dithmap_stepsize'])
-        # go down
-        for downidx in range(1, corneridx):
-            self.var['map_lambda'][pointidx] = self.var['map_lambda'][pointidx - 1] - dithstep
-            self.var['map_beta'][pointidx] = self.var['map_beta'][pointidx - 1]
-            self.var['nod_lambda'][pointidx] =  self.var['nod_lambda'][pointidx - 1] -  \
-                dithstep / float(self.var['offpos_reduc'])
-            self.var['nod_beta'][pointidx] = self.var['nod_beta'][pointidx - 1]
-            pointidx += 1
-        # go left
-        for leftidx in range(1, corneridx):
-            self.var['map_lambda'][pointidx] = self.var['map_lambda'][pointidx - 1]
-            self.var['map_beta'][pointidx] = self.var['map_beta'][pointidx - 1] - dithstep
-            self.var['nod_lambda'][pointidx] = self.var['nod_lambda'][pointidx - 1]
-            self.var['nod_beta'][pointidx] = self.var['nod_beta'][pointidx - 1] - \
-                dithstep / float(self.var['offpos_reduc'])
-            pointidx += 1
-
+    @timed
     def calcSpiral(self):
+        """
+        Square spiral around the map centre: legs of 1, 1, 2, 2, 3, 3, ...
+        steps going up, right, down and left, until all the points are placed.
+        """
         numpoints = self.var['dithmap_numpoints']
-        numcorners = int(math.sqrt(numpoints)) - 1
-        self.var['map_lambda'] = [None] * self.var['dithmap_numpoints']
-        self.var['map_beta'] = [None] * self.var['dithmap_numpoints']
-        self.var['nod_lambda'] = [None] * self.var['dithmap_numpoints']
-        self.var['nod_beta'] = [None] * self.var['dithmap_numpoints']
+        dithstep = float(self.var['dithmap_stepsize'])
+        reduc = float(self.var['offpos_reduc'])
+        self.var['map_lambda'] = [None] * numpoints
+        self.var['map_beta'] = [None] * numpoints
+        self.var['nod_lambda'] = [None] * numpoints
+        self.var['nod_beta'] = [None] * numpoints
         self.var['map_lambda'][0] = self.var['map_centlambda']
         self.var['map_beta'][0] = self.var['map_centbeta']
         self.var['nod_lambda'][0] = self.var['map_centlambda']
         self.var['nod_beta'][0] = self.var['map_centbeta']
-        pointidx = 1
-        for corneridx in range(1, numcorners + 1):
-            self.upright(pointidx, corneridx)
-            corneridx += 1
-            self.downleft(pointidx, corneridx)
-        for upidx in range(numcorners):
-            self.var['map_lambda'][pointidx] = self.var['map_lambda'][pointidx - 1] + \
-                float(self.var['dithmap_stepsize'])
-            self.var['map_beta'][pointidx] = self.var['map_beta'][pointidx - 1]
-            self.var['nod_lambda'][pointidx] = self.var['nod_lambda'][pointidx - 1] + \
-                float(self.var['dithmap_stepsize']) / float(self.var['offpos_reduc'])
-            self.var['nod_beta'][pointidx] = self.var['nod_beta'][pointidx - 1]
-            pointidx += 1
-
-    def calcGrtpos(self):
+        directions = [(1, 0), (0, 1), (-1, 0), (0, -1)]  # up, right, down, left
+        pointidx, leg = 1, 0
+        while pointidx < numpoints:
+            dlam, dbet = directions[leg % 4]
+            for stepidx in range(leg // 2 + 1):
+                if pointidx == numpoints:
+                    break
+                self.var['map_lambda'][pointidx] = self.var['map_lambda'][pointidx - 1] + dlam * dithstep
+                self.var['map_beta'][pointidx] = self.var['map_beta'][pointidx - 1] + dbet * dithstep
+                self.var['nod_lambda'][pointidx] = self.var['nod_lambda'][pointidx - 1] + \
+                    dlam * dithstep / reduc
+                self.var['nod_beta'][pointidx] = self.var['nod_beta'][pointidx - 1] + \
+                    dbet * dithstep / reduc
+                pointidx += 1
+            leg += 1
+
+    @timed
+    def gratingStartPositions(self):
         # Compute red grating start positions for different distribution modes
         # print('computing grating positions ...')
         # print('scandist ', self.var['scandist'], ' red_lambda ', self.var['red_lambda'])
@@ -1815,7 +1865,8 @@ class TableWidget(QWidget):
                     if self.var['blue_lambda'] == 'Inward dither':
                         self.var['blue_grstart'].reverse()
 
-        # Compute values
+    @timed
+    def startWavelengths(self):
         gratpos = np.array(self.var['red_grstart'])
         l, w = inductosyn2wavelength(gratpos, self.var['dichroic'], 'RED', 1)
         self.var['red_lambdastart'] = np.mean(l, axis=(1, 2))
@@ -1825,7 +1876,17 @@ class TableWidget(QWidget):
 
     def calcInductosynPos(self):
         """ Convert input wavelength to inductosyn units and update GUI."""
+        return self.graph.run(self.var, ['grating positions'])
+
+    def showGratingPositions(self):
+        self.fieldChanged.emit(self.redGratPosMicron, self.var['red_grtpos_micron'])
+        self.fieldChanged.emit(self.redGratPosUnits, str(self.var['red_grtpos']))
+        self.fieldChanged.emit(self.blueGratPosMicron, self.var['blue_grtpos_micron'])
+        self.fieldChanged.emit(self.blueGratPosUnits, str(self.var['blue_grtpos']))
 
+    @timed
+    def inductosynPositions(self):
+        """ Compute the inductosyn positions of the red and blue wavelengths."""
         # Red
         xt = self.var['red_micron']
         if self.var['red_offset_type'] == 'um':
@@ -1837,7 +1898,7 @@ class TableWidget(QWidget):
                 self.var['redshift'] = velocity2z(self.var['red_offset'])
             xt = xt * (1.0 + self.var['redshift'])
         # print('Requested red wavelength: ' + str(xt))
-        self.redGratPosMicron.setText('{0:.4f}'.format(round(xt, 4)))
+        self.var['red_grtpos_micron'] = '{0:.4f}'.format(round(xt, 4))
         grtpos = wavelength2inductosyn(xt, self.var['dichroic'], 'RED', 1, obsdate='')
         self.var['red_grtpos'] = int(grtpos)
         if self.var['red_offset_type'] == 'units' and self.var['red_offset'] != 0:
@@ -1849,8 +1910,7 @@ class TableWidget(QWidget):
                 obsdate='')
             # red_micron_actual = l[0,8,12]
             red_micron_actual = np.mean(l[0, :, :])
-            self.redGratPosMicron.setText(str(red_micron_actual).strip())
-        self.redGratPosUnits.setText(str(self.var['red_grtpos']))
+            self.var['red_grtpos_micron'] = str(red_micron_actual).strip()
 
         # Blue
         xt = self.var['blue_micron']
@@ -1863,7 +1923,7 @@ class TableWidget(QWidget):
                 self.var['redshift'] = velocity2z(self.var['blue_offset'])
             xt = xt * (1.0 + self.var['redshift'])
         # print('Requested blue wavelength: ' + str(xt))
-        self.blueGratPosMicron.setText('{0:.4f}'.format(round(xt, 4)))
+        self.var['blue_grtpos_micron'] = '{0:.4f}'.format(round(xt, 4))
         grtpos = wavelength2inductosyn(xt, self.var['dichroic'], 'BLUE', self.var['order'], obsdate='')
         self.var['blue_grtpos'] = int(grtpos)
         if self.var['blue_offset_type'] == 'units' and self.var['blue_offset'] != 0:
@@ -1875,8 +1935,7 @@ class TableWidget(QWidget):
                 obsdate='')
             # blue_micron_actual = l[0,8,12]
             blue_micron_actual = np.mean(l[0, :, :])
-            self.blueGratPosMicron.setText(str(blue_micron_actual).strip())
-        self.blueGratPosUnits.setText(str(self.var['blue_grtpos']))
+            self.var['blue_grtpos_micron'] = str(blue_micron_actual).strip()
 
     def grating_xls(self):
         """
@@ -1917,74 +1976,36 @@ class TableWidget(QWidget):
                 # ' Number of A positions per B (n) must be an even number.\n')
                 return
 
-        # exposure time needed due to attain t_int_source, seconds
         print('obs_eff ', self.obs_eff)
-        t_int_chopped = t_int_source / self.obs_eff
-        # time spent in one grating position, seconds
-        # for Asymmetric chops
         print('symmetry ', self.var['symmetry'])
-        if self.var['symmetry'] == 'Asymmetric':  # self.var['obsmode'] != 'Beam switching':
-            t_grating_pos = (t_int_chopped / n_grating_pos) + self.t_grating_move
-        # for Symmetric chops
-        else:
-            t_grating_pos = (t_int_chopped / (2 * n_grating_pos)) + self.t_grating_move
-
+        t = gratingTiming(t_int_source, n_grating_pos, n_map_pts, self.var['nodcycles'],
+                          self.var['nodpattern'], self.var['symmetry'], self.obs_eff,
+                          self.t_grating_move, self.t_ta_move, self.f_chop)
+        t = {k: v.item() for k, v in t.items()}
         print('t_grating_move ', self.t_grating_move)
-        print('t_grating_pos ', t_grating_pos)
-
-        # above time needs to be a rounded up to nearest integer, seconds
-        t_grating_pos_use = t_grating_pos
-        # time it takes to complete all grating steps
-        t_grating_sweep = t_grating_pos_use * n_grating_pos
-        print('t_grating_sweep ', t_grating_sweep)
-        # number of chop cycles during one grating position
-        n_cc_per_grating_pos = t_grating_pos_use * self.f_chop
+        print('t_grating_pos ', t['t_grating_pos'])
+        print('t_grating_sweep ', t['t_grating_sweep'])
+        n_cc_per_grating_pos = t['n_cc_per_grating_pos']
+        t_map = t['t_map']
 
         # Bright Object mode
-        # print self.var['nodpattern']
         if self.var['nodpattern'] in ['ABA', 'AABAA']:
-            # nod interval, seconds
-            t_nod_interval = t_int_source * 2
-            # time spent in one grating position, seconds
-            t_grating_pos = t_int_chopped / n_grating_pos + self.t_grating_move
-            # total time to complete map, minutes
-            t_map = (self.var['nodcycles'] + 1) * \
-                (t_int_source * 2 + self.t_ta_move) * n_map_pts / self.var['nodcycles'] / 60.
             # update GUI
             self.nodCycles.setText("{0:d}".format(self.var['nodcycles']))
             self.noGratPos4Nod.setText('')
             self.gratCycle4Nod.setText('')
         else:  # (AB)*n and (ABBA)*(n/2) modes
-            t_nod_interval = 30.  # nod interval, seconds
-            print('t_grating_sweep ', t_grating_sweep)
-            if t_grating_sweep <= 15:
+            if t['t_grating_sweep'] <= 15:
                 message = 'On-source time has to be longer than 15s.\n Fixing on-source time to 16s'
                 QMessageBox.about(self, "Onsource time", message)
                 self.onSourceTimeChop.setText('16')
                 return
-
-            # number of nod cycles needed to complete all grating positions
-            # n_nod_cycles = int( t_grating_sweep / t_nod_interval)   # CHECK is this the same ???
-            n_nod_cycles = mround(math.ceil(t_grating_sweep * 2 / t_nod_interval), 2) / 2
-            # number of grating positions on one nod
-            n_grating_pos_per_nod = n_grating_pos // n_nod_cycles
-            # it should be at least one ?
-            # if n_grating_pos_per_nod < 1:
-            #    n_grating_pos_per_nod = 1
-            # time of one nod, based on the number of grating positions on the nod, seconds.
-            t_nod_grating = t_grating_pos_use * n_grating_pos_per_nod  # We want it to be 30
-            # time interval of AB nod pair
-            t_nod_ab = (t_nod_grating + self.t_ta_move) * 2  # should be 80
-            # total time to step thru all grating positions
-            t_total = t_nod_ab * n_nod_cycles
-            # total time to complete map, minutes
-            t_map = t_total * n_map_pts / 60.
-
+            n_nod_cycles = t['n_nod_cycles']
             # update GUI
             self.nodCycles.setText("{0:d}".format(round(n_nod_cycles)))
             self.nodcyclesPerMapPosition.setText("{0:d}".format(round(n_nod_cycles)))
-            self.noGratPos4Nod.setText("{0:.1f}".format(n_grating_pos_per_nod))
-            self.gratCycle4Nod.setText("{0:.1f}".format(t_nod_grating))
+            self.noGratPos4Nod.setText("{0:.1f}".format(t['n_grating_pos_per_nod']))
+            self.gratCycle4Nod.setText("{0:.1f}".format(t['t_nod_grating']))
         # Common updates
         self.ccPerGratPos.setText("{0:.2f}".format(round(n_cc_per_grating_pos, 2)))
         self.timeCompleteMap.setText("{0:.2f}".format(round(t_map, 2)))
@@ -1998,6 +2019,66 @@ class TableWidget(QWidget):
         print('nodcycles before buidlObs are: ', self.var['nodcycles'])
         self.buildObs()
 
+    def optimizeGratingSetup(self):
+        """
+        Called by optimize button.
+        Search the setups reaching the on-source time per map position with
+        at least the entered number of grating positions and report the
+        fastest setups of the Pareto front of map time vs. overhead fraction.
+        The whole front is exported with the Export setups button.
+        """
+        try:
+            n_grating_pos = int(self.noGratPosChop.text())
+            n_map_pts = int(self.totMapPositions.text())
+            t_int_source = int(self.onSourceTimeChop.text())
+        except ValueError:
+            message = 'Please enter non-zero values for on-source time and number of grating positions.'
+            QMessageBox.about(self, "Grating", message)
+            return
+        if (t_int_source == 0) or (n_grating_pos == 0):
+            message = 'Please enter non-zero values for on-source time and number of grating positions.'
+            QMessageBox.about(self, "Grating", message)
+            return
+
+        front = optimizeGrating(t_int_source, n_grating_pos, n_map_pts, self.var['nodpattern'],
+                                self.var['symmetry'], obs_eff=self.obs_eff,
+                                t_grating_move=self.t_grating_move, t_ta_move=self.t_ta_move,
+                                f_chop=self.f_chop)
+        if len(front['t_map']) == 0:
+            self.gratingFront = None
+            self.exportSetups.setEnabled(False)
+            message = 'No setup reaches the requested on-source time.'
+            QMessageBox.about(self, "Grating", message)
+            return
+        self.gratingFront = front
+        self.exportSetups.setEnabled(True)
+        best = bestSetups(front, self.optimize_shown)
+        msg = '{0:d} setups on the Pareto front, fastest for each grating pos and nod cycles:\n'.format(
+            len(front['t_map']))
+        msg += 'grating pos, nod cycles, chop cycles, on source [s], map [min], overhead\n'
+        for i in best:
+            msg += '{0:d} {1:d} {2:d} {3:.1f} {4:.2f} {5:.2f}\n'.format(
+                front['grating_pos'][i], front['nodcycles'][i], front['chopcyc'][i],
+                front['sourcetime'][i], front['t_map'][i], front['overhead'][i])
+        print(msg)
+        self.update_status(msg)
+
+    def saveSetups(self):
+        """
+        Export all the setups of the last grating optimization as CSV.
+        """
+        if self.gratingFront is None:
+            message = 'Optimize the grating setup before exporting it.'
+            QMessageBox.about(self, "Export setups", message)
+            return
+        filename, _ = QFileDialog.getSaveFileName(
+            self, 'Export setups', os.path.join(self.sctdir.text(), 'grating_setups.csv'),
+            'CSV (*.csv);;All Files (*)')
+        if filename:
+            writeSetupsCSV(filename, self.gratingFront)
+            self.update_status('{0:d} grating setups exported to {1:s}\n'.format(
+                len(self.gratingFront['t_map']), filename))
+
     def selectSctdir(self):
         dir = QFileDialog.getExistingDirectory(self,
             "Select top directory to save .sct files",
@@ -2012,33 +2093,313 @@ class TableWidget(QWidget):
         """
         Write observation.
         """
+        output = self.prepareWrite()
+        try:
+            result = self.writeScans(output)
+        except Exception as error:
+            print('Error writing scan files: ', error)
+            self.update_status('Error writing scan files: ' + str(error) + '\n')
+            result = False
+        self.writeDone(result)
+
+    def prepareWrite(self):
+        """
+        Select the output of the scan files.
+        """
         # from pprint import pprint; pprint(self.var)
-        scan = ScanDescription()
         # make map
         print('Making ' + self.var['pattern'] + ' map.')
         self.update_status('Making ' + self.var['pattern'] + ' map.\n')
 
-        # Empty directory
+        # Only changed scan files are rewritten, stale ones are removed at the end
         dir = os.path.join(self.var['scandesdir'], self.var['obsid'])
-        if not os.path.exists(dir):
-            os.mkdir(dir)
+        if self.var['scanoutput'] == 'Zip archive':
+            output = ScanArchive(dir, 'zip')
+        elif self.var['scanoutput'] == 'Tar archive':
+            output = ScanArchive(dir, 'tar')
         else:
-            files = os.listdir(dir)
-            for f in files:
-                os.remove(os.path.join(dir, f))
-
-        if self.var['pattern'] == 'Inward spiral':
-            self.var['map_lambda'].reverse()
-            self.var['map_beta'].reverse()
-            result = self.makemap(scan)
-        else:  # 'File', 'N-point cross', 'Spiral', 'Stare'
-            result = self.makemap(scan)
-        self.var['ind_scanindex'] = 0
+            output = ScanDirectory(dir)
+        # Files are written by a separate thread while they are rendered
+        self.writeOutput = BackgroundWriter(output)
+        return self.writeOutput
 
+    @timed
+    def writeScans(self, output):
+        """
+        Compute the scans and write them to output.
+        """
+        # The files are written as the scans are computed, the table
+        # of the scans is only collected when it is saved
+        table = None
+        if self.var['scantable'] == 'CSV and NPZ':
+            table = ScanTable(ScanDescription.SCN_LAYOUT)
+            output = ScanRecorder(output, table)
+        result = self.scanObs(output)
+        if result == False:
+            return False
+        self.update_status(output.close())
+        if table is not None:
+            dir = os.path.join(self.var['scandesdir'], self.var['obsid'])
+            table.toCSV(dir + '_scans.csv')
+            table.toNPZ(dir + '_scans.npz')
+            self.update_status(table.close())
+
+    def writeDone(self, result):
         # save template and update History box: insert text at beginning
         if result != False:
             self.exportSct()
+        else:
+            self.update_status(self.writeOutput.abort())
+
+    def startWrite(self):
+        """
+        Write the observation in a worker thread, the GUI stays responsive.
+        If cancelled, the output is left as it was before writing.
+        """
+        output = self.prepareWrite()
+        self.runTask(self.writeScans, self.writeFinished, self.writeFailed,
+                     self.writeCancelled, output)
+
+    def writeFinished(self, result):
+        self.endTask()
+        self.writeDone(result)
+
+    def writeFailed(self, error):
+        self.endTask()
+        print('Error writing scan files: ', error)
+        self.update_status('Error writing scan files: ' + error + '\n')
+        self.writeDone(False)
+
+    def writeCancelled(self):
+        self.endTask()
+        self.update_status('Writing cancelled.\n')
+        self.writeDone(False)
+
+    def dryRun(self):
+        """
+        Compute all the scans of the observation without writing them.
+        Returns the ordered list of scans and the totals.
+        """
+        if not self.writeObservation.isEnabled():
+            message = 'Build the observation before the dry run.'
+            QMessageBox.about(self, "Dry run", message)
+            return None
+        sequence = ScanSequence(self.obs_con_samplesize)
+        result = self.scanObs(sequence)
+        if result == False:
+            self.update_status(sequence.abort())
+            return None
+        self.update_status(sequence.close())
+        return sequence.scans, sequence.totals()
 
+    def mapOffsets(self):
+        """
+        East and North offsets [arcsec] of the map positions from the target,
+        in the order of the scans.
+        """
+        dlam = np.asarray(self.var['map_lambda'], dtype=float)
+        dbet = np.asarray(self.var['map_beta'], dtype=float)
+        if self.var['pattern'] == 'Inward spiral':  # as in scanObs
+            dlam, dbet = dlam[::-1], dbet[::-1]
+        if self.var['mapcoord_system'] == 'SIRF':  # map offsets along the detector axes
+            dlam, dbet = rotateOffsets(dlam, dbet, self.var['detangle'])
+        return dlam, dbet
+
+    def skyPositions(self):
+        """
+        Absolute RA/Dec [deg] of the A and B positions of the built observation,
+        one per map position in the order of the scans. B is the off position
+        used when nodding from that map position (NaN without B nods).
+        """
+        v = self.var
+        ra0, dec0 = v['target_lambda_deg'], v['target_beta_deg']
+        ra_a, dec_a = offsetsToSky(ra0, dec0, *self.mapOffsets())
+        n = len(ra_a)
+        if v['nodpattern'] == 'A':
+            ra_b, dec_b = np.full(n, np.nan), np.full(n, np.nan)
+        elif v['offpos'] == 'Matched':
+            ra_b, dec_b = ra_a.copy(), dec_a.copy()
+        elif v['offpos'] == 'Absolute':
+            ra_b, dec_b = np.full(n, float(v['offpos_lambda'])), np.full(n, float(v['offpos_beta']))
+        elif v['offpos'] == 'Relative to target':
+            ra_b, dec_b = offsetsToSky(ra0, dec0, np.full(n, float(v['offpos_lambda'])),
+                                       np.full(n, float(v['offpos_beta'])))
+        else:  # 'Relative to active map pos', same offsets as in writeB
+            nod_lambda = np.asarray(v['nod_lambda'], dtype=float)[:n]
+            nod_beta = np.asarray(v['nod_beta'], dtype=float)[:n]
+            if v['pattern'] != 'File':
+                nod_lambda = nod_lambda + float(v['offpos_lambda'])
+                nod_beta = nod_beta + float(v['offpos_beta'])
+            ra_b, dec_b = offsetsToSky(ra0, dec0, nod_lambda, nod_beta)
+        return {'position': np.arange(1, n + 1), 'ra_a': ra_a, 'dec_a': dec_a,
+                'ra_b': ra_b, 'dec_b': dec_b}
+
+    def savePositions(self):
+        """
+        Export the absolute A and B positions as CSV and DS9 region files.
+        """
+        if not self.writeObservation.isEnabled():
+            message = 'Build the observation before exporting the positions.'
+            QMessageBox.about(self, "Export positions", message)
+            return
+        try:
+            positions = self.skyPositions()
+        except:
+            message = 'The map positions of the observation are not valid.'
+            QMessageBox.about(self, "Export positions", message)
+            return
+        filename, _ = QFileDialog.getSaveFileName(
+            self, 'Export positions', os.path.join(self.sctdir.text(), self.var['obsid'] + '_positions.csv'),
+            'CSV (*.csv);;All Files (*)')
+        if filename:
+            region = os.path.splitext(filename)[0] + '.reg'
+            writePositionsCSV(filename, positions)
+            writePositionsDS9(region, positions, self.var['obsid'])
+            self.update_status('{0:d} positions exported to {1:s} and {2:s}\n'.format(
+                len(positions['position']), filename, region))
+
+    def coverageImages(self):
+        """
+        Coverage (number of footprints) and exposure [s] images of the red
+        and blue arrays, on grids of coverage_pixel. Returns the images
+        (name: (data, unit)), the grids and a summary text.
+        """
+        dlam, dbet = self.mapOffsets()
+        # on-source time of each map position
+        exposure = float(np.squeeze(self.var['obstiming']['sourcetime_sec'])) / len(dlam)
+        images, grids, summary = {}, {}, ''
+        for array, spaxel in (('RED', self.spaxel_red), ('BLUE', self.spaxel_blue)):
+            grid = CoverageGrid(dlam, dbet, spaxel * 5, self.coverage_pixel)
+            counts = footprintCoverage(dlam, dbet, spaxel, self.var['detangle'], grid)
+            images[array + '_COVERAGE'] = (counts, 'positions')
+            images[array + '_EXPOSURE'] = (counts * exposure, 's')
+            grids[array] = grid
+            summary += array.capitalize() + ': ' + coverageSummary(counts, grid, dlam, dbet) + '\n'
+        return images, grids, summary
+
+    def saveCoverage(self):
+        """
+        Rasterize the spaxel footprints of the map and save the coverage
+        and exposure images of both arrays as FITS.
+        """
+        if not self.writeObservation.isEnabled():
+            message = 'Build the observation before computing the coverage.'
+            QMessageBox.about(self, "Map coverage", message)
+            return
+        try:
+            images, grids, summary = self.coverageImages()
+        except:
+            message = 'The map positions of the observation are not valid.'
+            QMessageBox.about(self, "Map coverage", message)
+            return
+        self.update_status(summary)
+        filename, _ = QFileDialog.getSaveFileName(
+            self, 'Save map coverage', os.path.join(self.sctdir.text(), self.var['obsid'] + '_coverage.fits'),
+            'FITS (*.fits);;All Files (*)')
+        if filename:
+            ra0, dec0 = self.var['target_lambda_deg'], self.var['target_beta_deg']
+            base, ext = os.path.splitext(filename)
+            for array in ('RED', 'BLUE'):
+                arrayfile = base + '_' + array.lower() + (ext or '.fits')
+                writeCoverageFITS(arrayfile, {name: image for name, image in images.items()
+                                              if name.startswith(array)}, grids[array], ra0, dec0)
+                self.update_status('Coverage saved to ' + arrayfile + '\n')
+
+    def spectralImages(self):
+        """
+        Coverage (number of samples) and exposure [s] of the red and blue
+        spaxels in wavelength bins of spectral_bin pixels, for all the scans
+        of the observation. Returns the images (name: (data, unit)), the bin
+        edges and a summary text.
+        """
+        base = self.scanBase()
+        npos = len(self.mapOffsets()[0])
+        sourcetime = float(np.squeeze(self.var['obstiming']['sourcetime_sec']))
+        # grating start of each on (A) scan of a map position, see writenods
+        nodcycles = 1 if self.var['nodpattern'] in ['ABA', 'AABAA'] else self.var['nodcycles']
+        indices = [self.gratingStartIndex(n, s) for n in range(nodcycles)
+                   for s in range(self.var['splits'])]
+        images, edges, summary = {}, {}, ''
+        for channel, array in enumerate(('RED', 'BLUE')):
+            prefix = array.lower() + '_'
+            starts = np.atleast_1d(self.var[prefix + 'grstart'])
+            gratpos = scanGratingPositions(
+                [starts[index or 0] for index in indices],
+                base['gr_steps_up'][channel], base['gr_stepsize_up'][channel],
+                base['gr_steps_down'][channel], base['gr_stepsize_down'][channel],
+                base['gr_cycles'][channel])
+            order = 1 if array == 'RED' else self.var['order']
+            edges[array], counts = spectralHistogram(gratpos, self.var['dichroic'], array, order,
+                                                     self.spectral_bin)
+            exposure = counts * sourcetime / gratpos.size  # same time for each visit
+            images[array + '_COVERAGE'] = (counts * npos, 'samples')
+            images[array + '_EXPOSURE'] = (exposure, 's')
+            line = float(self.var[prefix + 'grtpos_micron'])
+            summary += array.capitalize() + ': ' + spectralSummary(
+                edges[array], counts, exposure, line) + '\n'
+        return images, edges, summary
+
+    def saveSpectralCoverage(self):
+        """
+        Histogram the wavelengths seen by the spaxels during the observation
+        and save the coverage and exposure of both arrays as FITS.
+        """
+        if not self.writeObservation.isEnabled():
+            message = 'Build the observation before computing the spectral coverage.'
+            QMessageBox.about(self, "Spectral coverage", message)
+            return
+        try:
+            images, edges, summary = self.spectralImages()
+        except:
+            message = 'The grating positions of the observation are not valid.'
+            QMessageBox.about(self, "Spectral coverage", message)
+            return
+        self.update_status(summary)
+        filename, _ = QFileDialog.getSaveFileName(
+            self, 'Save spectral coverage', os.path.join(self.sctdir.text(), self.var['obsid'] + '_spectral.fits'),
+            'FITS (*.fits);;All Files (*)')
+        if filename:
+            base, ext = os.path.splitext(filename)
+            for array in ('RED', 'BLUE'):
+                arrayfile = base + '_' + array.lower() + (ext or '.fits')
+                writeSpectralFITS(arrayfile, {name: image for name, image in images.items()
+                                              if name.startswith(array)}, edges[array])
+                self.update_status('Spectral coverage saved to ' + arrayfile + '\n')
+
+    def showTimings(self):
+        """
+        Show the durations of the pipeline stages and the state of the build
+        stages, then save the durations as JSON.
+        """
+        self.update_status(timers.report())
+        self.update_status('Build stages:\n' + self.graph.describe() + '\n')
+        filename, _ = QFileDialog.getSaveFileName(self, 'Save stage timings',
+                                                  os.path.join(self.sctdir.text(), 'timings.json'),
+                                                  'JSON (*.json);;All Files (*)')
+        if filename:
+            timers.toJSON(filename)
+            self.update_status('Stage timings saved to ' + filename + '\n')
+
+    @timed
+    def scanObs(self, output):
+        """
+        Make the map sending the scans to output.
+        """
+        scan = ScanDescription()
+        scan.setBase(self.scanBase())
+        self.scanOutput = output
+        map_lambda, map_beta = self.var['map_lambda'], self.var['map_beta']
+        try:
+            if self.var['pattern'] == 'Inward spiral':
+                self.var['map_lambda'] = map_lambda[::-1]
+                self.var['map_beta'] = map_beta[::-1]
+            # 'File', 'N-point cross', 'Spiral', 'Stare'
+            return self.makemap(scan)
+        finally:
+            self.var['map_lambda'], self.var['map_beta'] = map_lambda, map_beta
+            self.var['ind_scanindex'] = 0
+
+    @timed
     def makemap(self, s):
         """
         Create map.
@@ -2051,6 +2412,7 @@ class TableWidget(QWidget):
                 print('ERROR writing nods.')
                 return False
         else:
+            npos = len(self.var['map_lambda'])
             for ml, mb in zip(self.var['map_lambda'], self.var['map_beta']):
                 # These are overwritten by specific map position definitions in writeA and writeB
                 s.scn['del_lam_map'] = ml  # self.var['map_lambda'][posidx]
@@ -2061,6 +2423,7 @@ class TableWidget(QWidget):
                     print('ERROR writing nods.')
                     return False
                 posidx += 1
+                self.progress(posidx, npos, 'positions')
 
         print('Wrote ' + str(self.var['ind_scanindex']) + ' scans.')
         self.update_status('Wrote ' + str(self.var['ind_scanindex']) + ' scans.\n')
@@ -2123,6 +2486,7 @@ class TableWidget(QWidget):
                 while posidx < self.var['dithmap_numpoints']:
                     nodcyclenum = 0
                     print('Writing scans for position ' + str(posidx + 1))
+                    self.progress(posidx, self.var['dithmap_numpoints'], 'positions')
                     # write first half of As (self.var['nodcycles'] / 2)
                     while nodcyclenum < (self.var['nodcycles'] / 2):
                         if posidx > self.var['dithmap_numpoints'] - 1:
@@ -2176,7 +2540,7 @@ class TableWidget(QWidget):
                             return False
         else:  # case of no nod, just write the on position
             print('No nod: not implemented yet.')
-            QMessageBox.about(self, 'Warning', 'No nod: not implemented yet.')
+            self.messageRequested.emit('Warning', 'No nod: not implemented yet.')
             return False
 
     def writeA(self, posidx, s, nodcyclenum, splitidx, rewind):
@@ -2207,7 +2571,7 @@ class TableWidget(QWidget):
         if check[0] == 'NoErrors':
             print('Writing nod A.')
             self.var['ind_scanindex'] += 1
-            s.write(scanfilepath)  # ; from pprint import pprint; pprint(self.var)
+            s.write(scanfilename, self.scanOutput)  # ; from pprint import pprint; pprint(self.var)
         else:
             print(check[1])
             return False
@@ -2260,13 +2624,12 @@ class TableWidget(QWidget):
         scanfilename = '{0:05d}_{1:s}_'.format(scannum, self.var['obsid']) + \
             str(int(round(self.var['map_laston_lambda']))).strip() + '_' + \
             str(int(round(self.var['map_laston_beta']))).strip() + '_B.scn'
-        scanfilepath = os.path.join(self.var['scandesdir'], self.var['obsid'], scanfilename)
 
         check = s.check()
         if check[0] == 'NoErrors':
             print('Writing nod B.')
             self.var['ind_scanindex'] += 1
-            s.write(scanfilepath)  # ; from pprint import pprint; pprint(self.var)
+            s.write(scanfilename, self.scanOutput)  # ; from pprint import pprint; pprint(self.var)
         else:
             print(check[1])
             return False
@@ -2276,134 +2639,145 @@ class TableWidget(QWidget):
         s.scn['target_beta'] = self.var['target_beta_deg']
         s.scn['obs_coord_sys'] = self.var['target_coordsys']
 
-    def populate_scan(self, s, nodcyclenum, splitidx):
+    def scanBase(self):
         """
-        Update scan with variable values.
-        """
-        s.scn['target_name'] = self.var['target_name']
-        s.scn['naifid'] = self.var['naifid']
-        s.scn['aorid'] = self.var['aorid']
-        s.scn['propid'] = self.var['propid']
-        s.scn['observer'] = self.var['observer']
-        s.scn['filegp_r'] = self.var['filegp_r']
-        s.scn['filegp_b'] = self.var['filegp_b']
-        s.scn['obstype'] = self.var['obstype']
-        # s.scn['focusoff'] = self.var['focusoff']
-        s.scn['srctype'] = self.var['srctype']
-        s.scn['instmode'] = self.var['instmode']
-        s.scn['redshift'] = self.var['redshift']
-        s.scn['obs_coord_sys'] = self.var['target_coordsys']
-        s.scn['target_lambda'] = self.var['target_lambda_deg']
-        s.scn['target_beta'] = self.var['target_beta_deg']
-        s.scn['mapcoord_system'] = self.var['mapcoord_system']
-        s.scn['off_coord_sys'] = 'J2000'
-        s.scn['offpos_lambda'] = self.var['offpos_lambda']
-        s.scn['offpos_beta'] = self.var['offpos_beta']
-
-        if s.scn['instmode'] == "OTF_TP":
-            s.scn['trk_drtn'] = float(self.timePerPoint)  # self.var['time_point']
-            # s.scn['skyspeed'] = self.var['skyspeed']
-            # s.scn['velangle'] = self.var['velangle']
-            # print(s.scn['trk_drtn'], type(s.scn['trk_drtn']))
-
-        s.scn['detangle'] = self.var['detangle']
+        Observation-level values shared by all the scans.
+        """
+        base = {}
+        base['target_name'] = self.var['target_name']
+        base['naifid'] = self.var['naifid']
+        base['aorid'] = self.var['aorid']
+        base['propid'] = self.var['propid']
+        base['observer'] = self.var['observer']
+        base['filegp_r'] = self.var['filegp_r']
+        base['filegp_b'] = self.var['filegp_b']
+        base['obstype'] = self.var['obstype']
+        # base['focusoff'] = self.var['focusoff']
+        base['srctype'] = self.var['srctype']
+        base['instmode'] = self.var['instmode']
+        base['redshift'] = self.var['redshift']
+        base['obs_coord_sys'] = self.var['target_coordsys']
+        base['target_lambda'] = self.var['target_lambda_deg']
+        base['target_beta'] = self.var['target_beta_deg']
+        base['mapcoord_system'] = self.var['mapcoord_system']
+        base['off_coord_sys'] = 'J2000'
+        base['offpos_lambda'] = self.var['offpos_lambda']
+        base['offpos_beta'] = self.var['offpos_beta']
+
+        if base['instmode'] == "OTF_TP":
+            base['trk_drtn'] = float(self.timePerPoint)  # self.var['time_point']
+            # base['skyspeed'] = self.var['skyspeed']
+            # base['velangle'] = self.var['velangle']
+
+        base['detangle'] = self.var['detangle']
         if self.var['commandline_option'] == '0':
-            s.scn['primaryarray'] = self.var['primaryarray']
+            base['primaryarray'] = self.var['primaryarray']
         elif self.var['commandline_option'] == '1':
-            s.scn['primaryarray'] = self.var['setpoint']
-        s.scn['los_focus_update'] = 0
-        s.scn['nodpattern'] = self.var['nodpattern']
-        s.scn['dichroic'] = self.var['dichroic']
-        s.scn['order'] = self.var['order']
-        s.scn['blue_filter'] = self.var['blue_filter']
-        s.scn['blue_micron'] = self.var['blue_micron']
-        s.scn['red_micron'] = self.var['red_micron']
-        s.scn['gr_cycles'] = [self.var['red_grtcyc'], self.var['blue_grtcyc']]
-        s.scn['gr_stepsize_up'] = [
+            base['primaryarray'] = self.var['setpoint']
+        base['los_focus_update'] = 0
+        base['nodpattern'] = self.var['nodpattern']
+        base['dichroic'] = self.var['dichroic']
+        base['order'] = self.var['order']
+        base['blue_filter'] = self.var['blue_filter']
+        base['blue_micron'] = self.var['blue_micron']
+        base['red_micron'] = self.var['red_micron']
+        base['gr_cycles'] = [self.var['red_grtcyc'], self.var['blue_grtcyc']]
+        base['gr_stepsize_up'] = [
             int(self.var['red_sizeup_isu']),
             int(self.var['blue_sizeup_isu'])]
-        s.scn['gr_stepsize_down'] = [
+        base['gr_stepsize_down'] = [
             int(self.var['red_sizedown_isu']),
             int(self.var['blue_sizedown_isu'])]
-        gratingDirection = self.gratingDirection.currentText()
-        if gratingDirection == "None":
-            s.scn['gr_start'] = [int(self.var['red_grstart']), int(self.var['blue_grstart'])]
-            s.scn['gr_lambda'] = [self.var['red_lambdastart'], self.var['blue_lambdastart']]
-            s.scn['gr_steps_up'] = [  # minimum steps is 1
+        # the grating start changes with the scan, see populate_scan
+        self.scanDirection = self.var['scandist']
+        if self.scanDirection == "None":
+            base['gr_steps_up'] = [  # minimum steps is 1
                 max([self.var['red_posup'], 1]),
                 max([self.var['blue_posup'], 1])]
-            s.scn['gr_steps_down'] = [int(self.var['red_posdown']), int(self.var['blue_posdown'])]
-        elif gratingDirection == "Up":
-            s.scn['gr_start'] = [
-                int(self.var['red_grstart'][nodcyclenum]),
-                int(self.var['blue_grstart'][nodcyclenum])]
-            s.scn['gr_lambda'] = [
-                self.var['red_lambdastart'][nodcyclenum],
-                self.var['blue_lambdastart'][nodcyclenum]]
-            s.scn['gr_steps_up'] = [
+            base['gr_steps_down'] = [int(self.var['red_posdown']), int(self.var['blue_posdown'])]
+        elif self.scanDirection == "Up":
+            base['gr_steps_up'] = [
                 max([int(self.var['red_posup'] / self.var['nodcycles']), 1]),
                 max([int(self.var['blue_posup'] / self.var['nodcycles']), 1])]
-            s.scn['gr_steps_down'] = [int(self.var['red_posdown']), int(self.var['blue_posdown'])]
-        elif gratingDirection == "Down":
-            s.scn['gr_start'] = [
-                int(self.var['red_grstart'][nodcyclenum]),
-                int(self.var['blue_grstart'][nodcyclenum])]
-            s.scn['gr_lambda'] = [
-                self.var['red_lambdastart'][nodcyclenum],
-                self.var['blue_lambdastart'][nodcyclenum]]
-            s.scn['gr_steps_up'] = [max([self.var['red_posup'], 1]), max([self.var['blue_posup'], 1])]
-            s.scn['gr_steps_down'] = [
+            base['gr_steps_down'] = [int(self.var['red_posdown']), int(self.var['blue_posdown'])]
+        elif self.scanDirection == "Down":
+            base['gr_steps_up'] = [max([self.var['red_posup'], 1]), max([self.var['blue_posup'], 1])]
+            base['gr_steps_down'] = [
                 int(self.var['red_posdown'] / self.var['nodcycles']),
                 int(self.var['blue_posdown'] / self.var['nodcycles'])]
-        elif gratingDirection == "Split":
-            s.scn['gr_start'] = [
-                int(self.var['red_grstart'][splitidx]),
-                int(self.var['blue_grstart'][splitidx])]
-            s.scn['gr_lambda'] = [
-                self.var['red_lambdastart'][splitidx],
-                self.var['blue_lambdastart'][splitidx]]
-            s.scn['gr_steps_up'] = [
+        elif self.scanDirection == "Split":
+            base['gr_steps_up'] = [
                 max([int(self.var['red_posup'] / self.var['splits']), 1]),
                 max([int(self.var['blue_posup'] / self.var['splits']), 1])]
-            s.scn['gr_steps_down'] = [
+            base['gr_steps_down'] = [
                 max([int(self.var['red_posdown'] / self.var['splits']), 1]),
                 max([int(self.var['blue_posdown'] / self.var['splits']), 1])]
 
         if self.var['nodpattern'] in ['ABA', 'AABAA']:
-            s.scn['gr_start'] = [int(self.var['red_grstart'][0]), int(self.var['blue_grstart'][0])]
-            s.scn['gr_lambda'] = [self.var['red_lambdastart'][0], self.var['blue_lambdastart'][0]]
-            s.scn['gr_steps_up'] = [int(self.var['red_posup']), int(self.var['blue_posup'])]
-            s.scn['gr_steps_down'] = [int(self.var['red_posdown']), int(self.var['blue_posdown'])]
+            base['gr_steps_up'] = [int(self.var['red_posup']), int(self.var['blue_posup'])]
+            base['gr_steps_down'] = [int(self.var['red_posdown']), int(self.var['blue_posdown'])]
 
         # minimum steps is 1
-        if s.scn['gr_steps_up'][0] < 1:
-            s.scn['gr_steps_up'][0] = int(1)
-        if s.scn['gr_steps_up'][1] < 1:
-            s.scn['gr_steps_up'][1] = int(1)
-
-        s.scn['ramplength'] = [self.var['red_ramplen'], self.var['blue_ramplen']]
-        s.scn['ch_scheme'] = self.var['ch_scheme']
-        s.scn['chopcoord_system'] = self.var['chopcoord_system']
-        s.scn['chop_amp'] = self.var['chop_amp']
-        s.scn['ch_tip'] = self.var['chop_tip']
-        s.scn['ch_beam'] = 1
-        s.scn['chop_posang'] = self.var['chop_posang']
-        s.scn['ch_cycles'] = [self.var['red_chopcyc'], self.var['blue_chopcyc']]
+        if base['gr_steps_up'][0] < 1:
+            base['gr_steps_up'][0] = int(1)
+        if base['gr_steps_up'][1] < 1:
+            base['gr_steps_up'][1] = int(1)
+
+        base['ramplength'] = [self.var['red_ramplen'], self.var['blue_ramplen']]
+        base['ch_scheme'] = self.var['ch_scheme']
+        base['chopcoord_system'] = self.var['chopcoord_system']
+        base['chop_amp'] = self.var['chop_amp']
+        base['ch_tip'] = self.var['chop_tip']
+        base['ch_beam'] = 1
+        base['chop_posang'] = self.var['chop_posang']
+        base['ch_cycles'] = [self.var['red_chopcyc'], self.var['blue_chopcyc']]
         if self.var['chopphase'] == 'Default':
-            s.scn['chop_manualphase'] = self.chop_phase_default
+            base['chop_manualphase'] = self.chop_phase_default
         elif self.var['chopphase'] == 'Manual':
-            s.scn['chop_manualphase'] = self.var['chop_manualphase']
-        s.scn['chop_length'] = self.var['chop_length']
-        s.scn['sel_cap'] = [self.var['red_capacitor'], self.var['blue_capacitor']]
-        s.scn['zero_bias'] = [self.var['red_zbias'], self.var['blue_zbias']]
-        # bluezerobiasold = s.scn['zero_bias'][1]
-        if s.scn['zero_bias'][1] == 90:
-            s.scn['zero_bias'][1] = 75
-        if s.scn['zero_bias'][0] == 50 and s.scn['zero_bias'][1] == 90:
-            s.scn['zero_bias'][0] = 60
-        s.scn['biasr'] = [self.var['red_biasr'], self.var['blue_biasr']]
-        s.scn['heater'] = [0, 0]
-        s.scn['cal_src_temp'] = 0.
+            base['chop_manualphase'] = self.var['chop_manualphase']
+        base['chop_length'] = self.var['chop_length']
+        base['sel_cap'] = [self.var['red_capacitor'], self.var['blue_capacitor']]
+        base['zero_bias'] = [self.var['red_zbias'], self.var['blue_zbias']]
+        # bluezerobiasold = base['zero_bias'][1]
+        if base['zero_bias'][1] == 90:
+            base['zero_bias'][1] = 75
+        if base['zero_bias'][0] == 50 and base['zero_bias'][1] == 90:
+            base['zero_bias'][0] = 60
+        base['biasr'] = [self.var['red_biasr'], self.var['blue_biasr']]
+        base['heater'] = [0, 0]
+        base['cal_src_temp'] = 0.
+        return base
+
+    def populate_scan(self, s, nodcyclenum, splitidx):
+        """
+        Start a new scan on top of the observation-level values.
+        Only the grating start depends on nod cycle and split.
+        """
+        s.newScan()
+        index = self.gratingStartIndex(nodcyclenum, splitidx)
+        if index is None:
+            s.scn['gr_start'] = [int(self.var['red_grstart']), int(self.var['blue_grstart'])]
+            s.scn['gr_lambda'] = [self.var['red_lambdastart'], self.var['blue_lambdastart']]
+            return
+        s.scn['gr_start'] = [
+            int(self.var['red_grstart'][index]),
+            int(self.var['blue_grstart'][index])]
+        s.scn['gr_lambda'] = [
+            self.var['red_lambdastart'][index],
+            self.var['blue_lambdastart'][index]]
+
+    def gratingStartIndex(self, nodcyclenum, splitidx):
+        """
+        Index of the grating start positions used by a scan, None if
+        there is a single start position.
+        """
+        if self.var['nodpattern'] in ['ABA', 'AABAA']:
+            return 0
+        elif self.var['scandist'] in ['Up', 'Down']:
+            return nodcyclenum
+        elif self.var['scandist'] == 'Split':
+            return splitidx
+        return None
 
     def exportSct(self):
         """
@@ -2453,10 +2827,52 @@ class TableWidget(QWidget):
 
     def update_status(self, msg):
         """
-        updates value in Status box
+        updates value in Status box, also from a worker thread
         """
-        self.e_status_text.moveCursor(QTextCursor.Start)
-        self.e_status_text.insertPlainText(msg)
+        self.statusChanged.emit(msg)
+
+    def showStatus(self, msg):
+        if self.quiet:
+            return
+        self.statusLog.append(msg)
+
+    def showField(self, widget, text):
+        widget.setText(text)
+
+    def showMessage(self, title, message):
+        if self.quiet:
+            return
+        QMessageBox.about(self, title, message)
+
+
+# Directions of the OTF scan legs in degrees E of N
+SCAN_ANGLES = {'+X': 90., '-X': 270., '+Y': 0., '-Y': 180.}
+
+
+def otfLegs(scandirXY, skyspeed, mapoffsets, detangle):
+    """
+    Arrays of sky speeds (always positive), velocity angles normalized to
+    0-360 deg and offsets of the OTF legs rotated by detangle [deg].
+    Raises KeyError for an unknown scan direction.
+    """
+    velangle = np.array([SCAN_ANGLES[direction] for direction in scandirXY])
+    velangle = ((velangle + detangle) + 360) % 360
+    # same rotation as the exported positions of SIRF maps
+    return np.array(skyspeed, dtype=float), velangle, np.array(
+        rotateOffsets(mapoffsets[0], mapoffsets[1], detangle))
+
+
+def _quoted(value):
+    return '"' + value + '"'
+
+def _f1(value):
+    return "%.1f" % value
+
+def _f3(value):
+    return "%.3f" % value
+
+def _float1(value):
+    return "%.1f" % float(value)
 
 
 class ScanDescription(QObject):
@@ -2479,6 +2895,104 @@ class ScanDescription(QObject):
     BLUE_BR_MIN = 150.
     DICHROIC_VAL = [105, 130]  # um
 
+    # Layout of a *.scn file. Strings are written verbatim, tuples are
+    # (keyword, scn key, index, format, width, comment, optional section).
+    SCN_LAYOUT = [
+        '#    ASTRONOMY\n',
+        ('AOR_ID', 'aorid', None, _quoted, 20, '# from DCS', None),
+        # POSSIBLE NEW KEYWORDS
+        # ('PROP_ID', 'propid', None, _quoted, 20, '# from DCS', None),
+        ('OBSERVER', 'observer', None, _quoted, 20, '# from DCS', None),
+        ('FILEGP_R', 'filegp_r', None, _quoted, 20, '# file group id RED for DPS use', None),
+        ('FILEGP_B', 'filegp_b', None, _quoted, 20, '# file group id BLUE for DPS use', None),
+        ('OBSTYPE', 'obstype', None, _quoted, 20, '# Observation type for DPS use', None),
+        # ('FOCUSOFF', 'focusoff', None, str, 20, '# Focus offset in microns', None),
+        ('SRCTYPE', 'srctype', None, _quoted, 20, '# Source type for DPS use', None),
+        ('INSTMODE', 'instmode', None, _quoted, 20, '# Instrument mode', None),
+        ('OBJ_NAME', 'target_name', None, _quoted, 20,
+         '# Name of astronomical object observed', None),
+        ('NAIF_ID', 'naifid', None, str, 20, '# NAIF ID of object observed', 'naifid'),
+        ('REDSHIFT', 'redshift', None, str, 20, '# redshift of the source (z)', None),
+        ('COORDSYS', 'obs_coord_sys', None, _quoted, 20, '# Target coordinate system', None),
+        ('OBSLAM', 'target_lambda', None, str, 20, '# in deg', None),
+        ('OBSBET', 'target_beta', None, str, 20, '# in deg', None),
+        ('DET_ANGL', 'detangle', None, _f3, 20, '# Detector y-axis EofN', None),
+        ('CRDSYSMP', 'mapcoord_system', None, _quoted, 20, '# Mapping coordinate system', None),
+        ('DLAM_MAP', 'del_lam_map', None, _f1, 20, '# arcsec', None),
+        ('DBET_MAP', 'del_bet_map', None, _f1, 20, '# arcsec', None),
+        ('SKYSPEED', 'skyspeed', None, _f1, 20, '# OTF sky scan speed, arcsec/s', 'otf'),
+        ('VELANGLE', 'velangle', None, _f1, 20,
+         '# Angle of the velocity vector for OTF scan, EofN in deg', 'otf'),
+        ('TRK_DRTN', 'trk_drtn', None, _f1, 20, '# Duration of OTF scan', 'otf'),
+        ('CRDSYSOF', 'off_coord_sys', None, _quoted, 20, '# Off position coordinate system', None),
+        ('DLAM_OFF', 'offpos_lambda', None, _f1, 20, '# arcsec', None),
+        ('DBET_OFF', 'offpos_beta', None, _f1, 20, '# arcsec', None),
+        ('PRIMARAY', 'primaryarray', None, _quoted, 20, '# Primary array', None),
+        ('LOSF_UPD', 'los_focus_update', None, str, 20, '# 0/1/2  block/allow/force updates', None),
+        ('NODPATT', 'nodpattern', None, _quoted, 20, '# Nod pattern', None),
+        '\n#    DICHROIC SETTING\n',
+        ('DICHROIC', 'dichroic', None, str, 20, '# Dichroic wavelength in um', None),
+        '\n#    GRATING\n# Blue\n',
+        ('G_ORD_B', 'order', None, str, 15, '# Blue grating order to be used', None),
+        ('G_FLT_B', 'blue_filter', None, str, 15, '# Filter number for Blue', None),
+        ('G_WAVE_B', 'gr_lambda', 1, _f3, 15, '# Wavelength to be observed in um INFO ONLY', None),
+        ('RESTWAVB', 'blue_micron', None, _f3, 15, '# Reference wavelength in um', None),
+        ('G_CYC_B', 'gr_cycles', 1, str, 15, '# The number of grating cycles (up-down)', None),
+        ('G_STRT_B', 'gr_start', 1, str, 15, '# absolute starting value in inductosyn units', None),
+        ('G_PSUP_B', 'gr_steps_up', 1, str, 15, '# number of grating position up in one cycle', None),
+        ('G_SZUP_B', 'gr_stepsize_up', 1, str, 15,
+         '# step size on the way up; same unit as G_STRT', None),
+        ('G_PSDN_B', 'gr_steps_down', 1, str, 15,
+         '# number of grating position down in one cycle', None),
+        ('G_SZDN_B', 'gr_stepsize_down', 1, str, 15,
+         '# step size on the way down; same unit as G_STRT', None),
+        '# Red\n',
+        ('G_WAVE_R', 'gr_lambda', 0, _f3, 15, '# Wavelength to be observed in um INFO ONLY', None),
+        ('RESTWAVR', 'red_micron', None, _f3, 15, '# Reference wavelength in um', None),
+        ('G_CYC_R', 'gr_cycles', 0, str, 15, '# The number of grating cycles (up-down)', None),
+        ('G_STRT_R', 'gr_start', 0, str, 15, '# absolute starting value in inductosyn units', None),
+        ('G_PSUP_R', 'gr_steps_up', 0, str, 15, '# number of grating position up in one cycle', None),
+        ('G_SZUP_R', 'gr_stepsize_up', 0, str, 15,
+         '# step size on the way up; same unit as G_STRT', None),
+        ('G_PSDN_R', 'gr_steps_down', 0, str, 15,
+         '# number of grating position down in one cycle', None),
+        ('G_SZDN_R', 'gr_stepsize_down', 0, str, 15,
+         '# step size on the way down; same unit as G_STRT', None),
+        '\n#    RAMP\n',
+        ('RAMPLN_B', 'ramplength', 1, str, 15, '# number of readouts per blue ramp', None),
+        ('RAMPLN_R', 'ramplength', 0, str, 15, '# number of readouts per red ramp', None),
+        '\n#    CHOPPER\n',
+        ('C_SCHEME', 'ch_scheme', None, _quoted, 15, '# Chopper scheme; 2POINT or 4POINT', None),
+        ('C_CRDSYS', 'chopcoord_system', None, _quoted, 15, '# Chopper coodinate system', None),
+        ('C_AMP', 'chop_amp', None, str, 15, '# chop amplitude in arcsec', None),
+        ('C_TIP', 'ch_tip', None, str, 15, '# fraction', None),
+        ('C_BEAM', 'ch_beam', None, _f1, 15, '# nod phase', None),
+        ('C_POSANG', 'chop_posang', None, str, 15, '# deg, S of E', None),
+        ('C_CYC_B', 'ch_cycles', 1, str, 15, '# chopping cycles per grating position', None),
+        ('C_CYC_R', 'ch_cycles', 0, str, 15, '# chopping cycles per grating position', None),
+        ('C_PHASE', 'chop_manualphase', None, _float1, 15,
+         '# chopper signal phase shift relative to R/O in deg', None),
+        ('C_CHOPLN', 'chop_length', None, str, 15, '# number of readouts per chop position', None),
+        '\n#    CAPACITORS\n',
+        ('CAP_B', 'sel_cap', 1, str, 15, '# Integrating capacitors in pF', None),
+        ('CAP_R', 'sel_cap', 0, str, 15, '# Integrating capacitors in pF', None),
+        '\n#    CONVERTER\n# Blue\n',
+        ('ZBIAS_B', 'zero_bias', 1, _f3, 15, '# Voltage in mV', None),
+        ('BIASR_B', 'biasr', 1, _f3, 15, '# Voltage in mV', None),
+        ('HEATER_B', 'heater', 1, _f3, 15, '# Voltage in mV', None),
+        '# Red\n',
+        ('ZBIAS_R', 'zero_bias', 0, _f3, 15, '# Voltage in mV', None),
+        ('BIASR_R', 'biasr', 0, _f3, 15, '# Voltage in mV', None),
+        ('HEATER_R', 'heater', 0, _f3, 15, '# Voltage in mV', None),
+        '\n#    CALIBRATION SOURCE\n',
+        ('CALSTMP', 'cal_src_temp', None, str, 15, '# Kelvin', None),
+        '\nHERE_COMETH_THE_END\n',
+    ]
+    _templates = {}
+    # set by the full check from the observation-level values
+    DERIVED = ('choppos_per_cycle', 'subramp_length', 'subramps_per_choppos',
+               'subramps_per_ramp', 'anz_frames')
+
     def __init__(self):
         """ initialize """
         self.scn = {
@@ -2537,9 +3051,44 @@ class ScanDescription(QObject):
             'subramps_per_ramp': [0, 0],  # num of chop pos per cycles
             'choppos_per_cycle': 0  # num of chop pos per cycle as defined by ch_scheme
         }
+        # set once the observation-level fields have been validated
+        self.observation_checked = False
+        self.base = None
 
+    def setBase(self, values):
+        """
+        Freeze the default values updated with values as the read-only
+        observation-level record. Scans started with newScan() only store
+        the values which differ from it.
+        """
+        base = dict(self.scn)
+        base.update(values)
+        for key, value in base.items():
+            if isinstance(value, list):
+                base[key] = tuple(value)
+        self.base = MappingProxyType(base)
+        self.observation_checked = False
+        self.newScan()
+
+    def newScan(self):
+        """ start a new scan as an empty overlay of the base record """
+        self.scn = ChainMap({}, self.base)
+
+    @timed
     def check(self):
-        """ check Scan Description and return any error """
+        """
+        check Scan Description and return any error
+
+        The first successful check validates the whole scan description.
+        Since only offsets, grating start and rewind flags change between
+        the scans of an observation, further calls check only those.
+        """
+        if self.observation_checked:
+            return self.check_scan()
+        # frame counts are derived below, copy them before updating
+        for key in self.DERIVED:
+            if isinstance(self.scn[key], (list, tuple)):
+                self.scn[key] = list(self.scn[key])
         errmsg = ''
         if self.scn['aorid'] == "NONE": errmsg += 'AORID not set\n'
         if self.scn['filegp_r'] == "NONE": errmsg += 'FILEGP_R not set\n'
@@ -2630,14 +3179,7 @@ class ScanDescription(QObject):
                 self.scn['choppos_per_cycle'] = 4
 
             # check BLUE
-            gr_end = self.scn['gr_start'][1] + \
-                self.scn['gr_steps_up'][1] * self.scn['gr_stepsize_up'][1]
-            if not self.MIN_GR_POS <= gr_end <= self.MAX_GR_POS:
-                errmsg += 'Blue grating exceeds range on up\n '
-            gr_end = gr_end - \
-                self.scn['gr_steps_down'][1] * self.scn['gr_stepsize_down'][1]
-            if not self.MIN_GR_POS <= gr_end <= self.MAX_GR_POS:
-                errmsg += 'Blue grating exceeds range on down\n '
+            errmsg += self.check_grating_range(1, 'Blue')
 
             ramplength = self.scn['ramplength'][1]
             choplength = self.scn['chop_length']
@@ -2673,14 +3215,7 @@ class ScanDescription(QObject):
                 self.scn['subramp_length'][1]
 
             # check RED
-            gr_end = self.scn['gr_start'][0] + \
-                self.scn['gr_steps_up'][0] * self.scn['gr_stepsize_up'][0]
-            if not self.MIN_GR_POS <= gr_end <= self.MAX_GR_POS:
-                errmsg += 'Red grating exceeds range on up\n '
-            gr_end = gr_end - \
-                self.scn['gr_steps_down'][0] * self.scn['gr_stepsize_down'][0]
-            if not self.MIN_GR_POS <= gr_end <= self.MAX_GR_POS:
-                errmsg += 'Red grating exceeds range on down\n '
+            errmsg += self.check_grating_range(0, 'Red')
 
             ramplength = self.scn['ramplength'][0]
             choplength = self.scn['chop_length']
@@ -2719,218 +3254,112 @@ class ScanDescription(QObject):
                 errmsg += 'Red and Blue parameters do not commensurate\n '
             self.scn['anz_frames'] = anz_frames_b
 
+        if len(errmsg) == 0:
+            self.observation_checked = True
+            if self.base is not None:
+                # the derived values hold for all the scans of the observation
+                base = dict(self.base)
+                for key in self.DERIVED:
+                    value = self.scn[key]
+                    base[key] = tuple(value) if isinstance(value, list) else value
+                self.base = MappingProxyType(base)
+                self.scn.maps[-1] = self.base
+            return 'NoErrors', 'NoErrors'
+        else:
+            return False, '\n' + errmsg + '\n'
+
+    def check_scan(self):
+        """ check only the fields which change from scan to scan """
+        errmsg = ''
+        if not 0 <= self.scn['target_lambda'] < 360.:
+            errmsg += 'OBSLAM out of range\n '
+        if not -90.0 <= self.scn['target_beta'] <= 90.:
+            errmsg += 'OBSBET out of range\n '
+        if self.scn['los_focus_update'] not in [0, 1, 2]:
+            errmsg += 'LOSF_UPD out of range\n '
+        if not self.BLUEMIN <= self.scn['gr_lambda'][1] <= self.BLUEMAX:
+            errmsg += 'GR_LAMBDA_b out of range\n '
+        if not self.MIN_GR_POS <= self.scn['gr_start'][1] <= self.MAX_GR_POS:
+            errmsg += 'GR_START_b out of range\n '
+        if not self.REDMIN <= self.scn['gr_lambda'][0] <= self.REDMAX:
+            errmsg += 'GR_LAMBDA_r out of range\n '
+        if not self.MIN_GR_POS <= self.scn['gr_start'][0] <= self.MAX_GR_POS:
+            errmsg += 'GR_START_r out of range\n '
+        if errmsg == '':
+            errmsg += self.check_grating_range(1, 'Blue')
+            errmsg += self.check_grating_range(0, 'Red')
+
         if len(errmsg) == 0:
             return 'NoErrors', 'NoErrors'
         else:
             return False, '\n' + errmsg + '\n'
 
-    def write(self, filename):
-        """ write a *.scn file to folder """
+    def check_grating_range(self, channel, name):
+        """ check that the grating stays in range during the scan """
+        errmsg = ''
+        gr_end = self.scn['gr_start'][channel] + \
+            self.scn['gr_steps_up'][channel] * self.scn['gr_stepsize_up'][channel]
+        if not self.MIN_GR_POS <= gr_end <= self.MAX_GR_POS:
+            errmsg += name + ' grating exceeds range on up\n '
+        gr_end = gr_end - \
+            self.scn['gr_steps_down'][channel] * self.scn['gr_stepsize_down'][channel]
+        if not self.MIN_GR_POS <= gr_end <= self.MAX_GR_POS:
+            errmsg += name + ' grating exceeds range on down\n '
+        return errmsg
+
+    def template(self, naifid=False, otf=False):
+        """
+        Return the compiled *.scn layout for the given optional sections.
+
+        The fixed labels, paddings and comments are formatted only once;
+        each layout variant is cached on the class.
+        """
+        variant = (naifid, otf)
+        if variant not in self._templates:
+            template, fields = '', []
+            for item in self.SCN_LAYOUT:
+                if isinstance(item, str):
+                    template += item.replace('%', '%%')
+                    continue
+                keyword, key, index, fmt, width, comment, section = item
+                if section == 'naifid' and not naifid:
+                    continue
+                if section == 'otf' and not otf:
+                    continue
+                template += keyword.ljust(12) + '%-' + str(width) + 's' + \
+                    comment.replace('%', '%%') + '\n'
+                fields.append((key, index, fmt))
+            self._templates[variant] = (template, fields)
+        return self._templates[variant]
+
+    def render(self):
+        """ return the content of a *.scn file as a string """
         import time
+        template, fields = self.template(self.scn['naifid'] != '',
+                                         self.scn['instmode'] == 'OTF_TP')
+        values = []
+        for key, index, fmt in fields:
+            if index is None:
+                values.append(fmt(self.scn[key]))
+            else:
+                values.append(fmt(self.scn[key][index]))
+        # seconds elapsed since 1 January 1970 UTC as time stamp below
+        return '# Time stamp at last update: ' + str(time.time()) + '\n' + \
+            template % tuple(values)
+
+    @timed
+    def write(self, filename, output=None):
+        """
+        write a *.scn file to folder, or pass it by name to an output
+        such as ScanDirectory
+        """
+        if output is not None:
+            if hasattr(output, 'record'):
+                output.record(filename, self.scn)
+            if hasattr(output, 'write'):
+                output.write(filename, self.render())
+            return
         if not os.path.exists(os.path.dirname(filename)):
             os.makedirs(os.path.dirname(filename))
-        file = open(filename, 'w')
-        # seconds elapsed since 1 January 1970 UTC as time stamp below
-        file.write('# Time stamp at last update: ' + str(time.time()) + '\n')
-        file.write('#    ASTRONOMY\n')
-        file.write('%s%s%s' % ("AOR_ID".ljust(12),  # adjust ljust param
-            ('"' + self.scn["aorid"] + '"').ljust(20), '# from DCS\n'))
-        # POSSIBLE NEW KEYWORDS
-        # file.write('%s%s%s' % ("PROP_ID".ljust(12),  # adjust ljust param
-        #    ('"' + self.scn["propid"] + '"').ljust(20), '# from DCS\n'))
-        file.write('%s%s%s' % ("OBSERVER".ljust(12),  # adjust ljust param
-            ('"' + self.scn["observer"] + '"').ljust(20), '# from DCS\n'))
-        file.write('%s%s%s' % ("FILEGP_R".ljust(12),
-            ('"' + self.scn["filegp_r"] + '"').ljust(20),
-            '# file group id RED for DPS use\n'))
-        file.write('%s%s%s' % ("FILEGP_B".ljust(12),
-            ('"' + self.scn["filegp_b"] + '"').ljust(20),
-            '# file group id BLUE for DPS use\n'))
-        file.write('%s%s%s' % ("OBSTYPE".ljust(12),
-            ('"' + self.scn["obstype"] + '"').ljust(20),
-            '# Observation type for DPS use\n'))
-        # file.write('%s%s%s' % ("FOCUSOFF".ljust(12),
-        #     str(self.scn["focusoff"]).ljust(20),
-        #     '# Focus offset in microns\n'))
-        file.write('%s%s%s' % ("SRCTYPE".ljust(12),
-            ('"' + self.scn["srctype"] + '"').ljust(20),
-            '# Source type for DPS use\n'))
-        file.write('%s%s%s' % ("INSTMODE".ljust(12),
-            ('"' + self.scn["instmode"] + '"').ljust(20),
-            '# Instrument mode\n'))
-        file.write('%s%s%s' % ("OBJ_NAME".ljust(12),
-            ('"' + self.scn["target_name"] + '"').ljust(20),
-            '# Name of astronomical object observed\n'))
-        if self.scn["naifid"] != "":
-            file.write('%s%s%s' % ("NAIF_ID".ljust(12),
-                (self.scn["naifid"]).ljust(20),
-                '# NAIF ID of object observed\n'))
-        file.write('%s%s%s' % ("REDSHIFT".ljust(12),
-            str(self.scn["redshift"]).ljust(20),
-            '# redshift of the source (z)\n'))
-        file.write('%s%s%s' % ("COORDSYS".ljust(12),
-            ('"' + self.scn["obs_coord_sys"] + '"').ljust(20),
-            '# Target coordinate system\n'))
-        file.write('%s%s%s' % ("OBSLAM".ljust(12),  # adjust ljust param
-            str(self.scn["target_lambda"]).ljust(20), '# in deg\n'))
-        file.write('%s%s%s' % ("OBSBET".ljust(12),  # adjust ljust param
-            str(self.scn["target_beta"]).ljust(20), '# in deg\n'))
-        file.write('%s%s%s' % ("DET_ANGL".ljust(12),  # adjust ljust param
-            str("%.3f" % self.scn["detangle"]).ljust(20),
-            '# Detector y-axis EofN\n'))
-        file.write('%s%s%s' % ("CRDSYSMP".ljust(12),  # adjust ljust param
-            ('"' + self.scn["mapcoord_system"] + '"').ljust(20),
-            '# Mapping coordinate system\n'))
-        file.write('%s%s%s' % ("DLAM_MAP".ljust(12),
-            str("%.1f" % self.scn['del_lam_map']).ljust(20), '# arcsec\n'))
-        file.write('%s%s%s' % ("DBET_MAP".ljust(12),
-            str("%.1f" % self.scn['del_bet_map']).ljust(20), '# arcsec\n'))
-        if self.scn["instmode"] == "OTF_TP":
-            file.write('%s%s%s' % ("SKYSPEED".ljust(12),
-                str("%.1f" % self.scn["skyspeed"]).ljust(20),
-                '# OTF sky scan speed, arcsec/s\n'))
-            file.write('%s%s%s' % ("VELANGLE".ljust(12),
-                str("%.1f" % self.scn["velangle"]).ljust(20),
-                '# Angle of the velocity vector for OTF scan, EofN in deg\n'))
-            file.write('%s%s%s' % ("TRK_DRTN".ljust(12),
-                str("%.1f" % self.scn["trk_drtn"]).ljust(20),
-                '# Duration of OTF scan\n'))
-        file.write('%s%s%s' % ("CRDSYSOF".ljust(12),
-            ('"' + self.scn["off_coord_sys"] + '"').ljust(20),
-            '# Off position coordinate system\n'))
-        file.write('%s%s%s' % ("DLAM_OFF".ljust(12),
-            str("%.1f" % self.scn['offpos_lambda']).ljust(20), '# arcsec\n'))
-        file.write('%s%s%s' % ("DBET_OFF".ljust(12),
-            str("%.1f" % self.scn['offpos_beta']).ljust(20), '# arcsec\n'))
-        file.write('%s%s%s' % ("PRIMARAY".ljust(12),
-            ('"' + self.scn["primaryarray"] + '"').ljust(20),
-            '# Primary array\n'))
-        file.write('%s%s%s' % ("LOSF_UPD".ljust(12),
-            str(self.scn['los_focus_update']).ljust(20),
-            '# 0/1/2  block/allow/force updates\n'))
-        file.write('%s%s%s' % ("NODPATT".ljust(12),
-            ('"' + self.scn["nodpattern"] + '"').ljust(20),
-            '# Nod pattern\n'))
-        file.write('\n#    DICHROIC SETTING\n')
-        file.write('%s%s%s' % ("DICHROIC".ljust(12),
-            str(self.scn['dichroic']).ljust(20),
-            '# Dichroic wavelength in um\n'))
-        file.write('\n#    GRATING\n# Blue\n')
-        file.write('%s%s%s' % ("G_ORD_B".ljust(12),
-            str(self.scn['order']).ljust(15),
-            '# Blue grating order to be used\n'))
-        file.write('%s%s%s' % ("G_FLT_B".ljust(12),
-            str(self.scn['blue_filter']).ljust(15),
-            '# Filter number for Blue\n'))
-        file.write('%s%s%s' % ("G_WAVE_B".ljust(12),
-            str("%.3f" % self.scn['gr_lambda'][1]).ljust(15),
-            '# Wavelength to be observed in um INFO ONLY\n'))
-        file.write('%s%s%s' % ("RESTWAVB".ljust(12),
-            str("%.3f" % self.scn['blue_micron']).ljust(15),
-            '# Reference wavelength in um\n'))
-        file.write('%s%s%s' % ("G_CYC_B".ljust(12),
-            str(self.scn['gr_cycles'][1]).ljust(15),
-            '# The number of grating cycles (up-down)\n'))
-        file.write('%s%s%s' % ("G_STRT_B".ljust(12),
-            str(self.scn['gr_start'][1]).ljust(15),
-            '# absolute starting value in inductosyn units\n'))
-        file.write('%s%s%s' % ("G_PSUP_B".ljust(12),
-            str(self.scn['gr_steps_up'][1]).ljust(15),
-            '# number of grating position up in one cycle\n'))
-        file.write('%s%s%s' % ("G_SZUP_B".ljust(12),
-            str(self.scn['gr_stepsize_up'][1]).ljust(15),
-            '# step size on the way up; same unit as G_STRT\n'))
-        file.write('%s%s%s' % ("G_PSDN_B".ljust(12),
-            str(self.scn['gr_steps_down'][1]).ljust(15),
-            '# number of grating position down in one cycle\n'))
-        file.write('%s%s%s' % ("G_SZDN_B".ljust(12),
-            str(self.scn['gr_stepsize_down'][1]).ljust(15),
-            '# step size on the way down; same unit as G_STRT\n'))
-        file.write('# Red\n')
-        file.write('%s%s%s' % ("G_WAVE_R".ljust(12),
-            str("%.3f" % self.scn['gr_lambda'][0]).ljust(15),
-            '# Wavelength to be observed in um INFO ONLY\n'))
-        file.write('%s%s%s' % ("RESTWAVR".ljust(12),
-            str("%.3f" % self.scn['red_micron']).ljust(15),
-            '# Reference wavelength in um\n'))
-        file.write('%s%s%s' % ("G_CYC_R".ljust(12),
-            str(self.scn['gr_cycles'][0]).ljust(15),
-            '# The number of grating cycles (up-down)\n'))
-        file.write('%s%s%s' % ("G_STRT_R".ljust(12),
-            str(self.scn['gr_start'][0]).ljust(15),
-            '# absolute starting value in inductosyn units\n'))
-        file.write('%s%s%s' % ("G_PSUP_R".ljust(12),
-            str(self.scn['gr_steps_up'][0]).ljust(15),
-            '# number of grating position up in one cycle\n'))
-        file.write('%s%s%s' % ("G_SZUP_R".ljust(12),
-            str(self.scn['gr_stepsize_up'][0]).ljust(15),
-            '# step size on the way up; same unit as G_STRT\n'))
-        file.write('%s%s%s' % ("G_PSDN_R".ljust(12),
-            str(self.scn['gr_steps_down'][0]).ljust(15),
-            '# number of grating position down in one cycle\n'))
-        file.write('%s%s%s' % ("G_SZDN_R".ljust(12),
-            str(self.scn['gr_stepsize_down'][0]).ljust(15),
-            '# step size on the way down; same unit as G_STRT\n'))
-        file.write('\n#    RAMP\n')
-        file.write('%s%s%s' % ("RAMPLN_B".ljust(12),
-            str(self.scn['ramplength'][1]).ljust(15),
-            '# number of readouts per blue ramp\n'))
-        file.write('%s%s%s' % ("RAMPLN_R".ljust(12),
-            str(self.scn['ramplength'][0]).ljust(15),
-            '# number of readouts per red ramp\n'))
-        file.write('\n#    CHOPPER\n')
-        file.write('%s%s%s' % ("C_SCHEME".ljust(12),
-            ('"' + self.scn["ch_scheme"] + '"').ljust(15),
-            '# Chopper scheme; 2POINT or 4POINT\n'))
-        file.write('%s%s%s' % ("C_CRDSYS".ljust(12),
-            ('"' + self.scn["chopcoord_system"] + '"').ljust(15),
-            '# Chopper coodinate system\n'))
-        file.write('%s%s%s' % ("C_AMP".ljust(12),
-            str(self.scn['chop_amp']).ljust(15),
-            '# chop amplitude in arcsec\n'))
-        file.write('%s%s%s' % ("C_TIP".ljust(12),
-            str(self.scn['ch_tip']).ljust(15), '# fraction\n'))
-        file.write('%s%s%s' % ("C_BEAM".ljust(12),
-            str("%.1f" % self.scn['ch_beam']).ljust(15), '# nod phase\n'))
-        file.write('%s%s%s' % ("C_POSANG".ljust(12),
-            str(self.scn['chop_posang']).ljust(15), '# deg, S of E\n'))
-        file.write('%s%s%s' % ("C_CYC_B".ljust(12),
-            str(self.scn['ch_cycles'][1]).ljust(15),
-            '# chopping cycles per grating position\n'))
-        file.write('%s%s%s' % ("C_CYC_R".ljust(12),
-            str(self.scn['ch_cycles'][0]).ljust(15),
-            '# chopping cycles per grating position\n'))
-        file.write('%s%s%s' % ("C_PHASE".ljust(12),
-            str("%.1f" % float(self.scn['chop_manualphase'])).ljust(15),
-            '# chopper signal phase shift relative to R/O in deg\n'))
-        file.write('%s%s%s' % ("C_CHOPLN".ljust(12),
-            str(self.scn['chop_length']).ljust(15),
-            '# number of readouts per chop position\n'))
-        file.write('\n#    CAPACITORS\n')
-        file.write('%s%s%s' % ("CAP_B".ljust(12),
-            str(self.scn['sel_cap'][1]).ljust(15),
-            '# Integrating capacitors in pF\n'))
-        file.write('%s%s%s' % ("CAP_R".ljust(12),
-            str(self.scn['sel_cap'][0]).ljust(15),
-            '# Integrating capacitors in pF\n'))
-        file.write('\n#    CONVERTER\n# Blue\n')
-        file.write('%s%s%s' % ("ZBIAS_B".ljust(12),
-            str("%.3f" % self.scn['zero_bias'][1]).ljust(15),
-                '# Voltage in mV\n'))
-        file.write('%s%s%s' % ("BIASR_B".ljust(12),
-            str("%.3f" % self.scn['biasr'][1]).ljust(15), '# Voltage in mV\n'))
-        file.write('%s%s%s' % ("HEATER_B".ljust(12),
-            str("%.3f" % self.scn['heater'][1]).ljust(15), '# Voltage in mV\n'))
-        file.write('# Red\n')
-        file.write('%s%s%s' % ("ZBIAS_R".ljust(12),
-            str("%.3f" % self.scn['zero_bias'][0]).ljust(15),
-                '# Voltage in mV\n'))
-        file.write('%s%s%s' % ("BIASR_R".ljust(12),
-            str("%.3f" % self.scn['biasr'][0]).ljust(15), '# Voltage in mV\n'))
-        file.write('%s%s%s' % ("HEATER_R".ljust(12),
-            str("%.3f" % self.scn['heater'][0]).ljust(15), '# Voltage in mV\n'))
-        file.write('\n#    CALIBRATION SOURCE\n')
-        file.write('%s%s%s' % ("CALSTMP".ljust(12),
-            str(self.scn['cal_src_temp']).ljust(15), '# Kelvin\n'))
-        file.write('\nHERE_COMETH_THE_END\n')
-        file.close()
+        with open(filename, 'w') as file:
+            file.write(self.render())
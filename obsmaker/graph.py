@@ -0,0 +1,120 @@
+import copy
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def _frozen(value):
+    """Hashable version of a variable value (lists, arrays, dicts)."""
+    if isinstance(value, np.ndarray):
+        return (value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _frozen(v)) for k, v in value.items()))
+    return value
+
+
+class Stage:
+    """A calculation reading and writing variables of the observation."""
+
+    def __init__(self, name, function, inputs, outputs, show=None):
+        self.name = name
+        self.function = function  # returns False on failure
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.show = show  # updates the GUI from the outputs
+        self.state = 'new'  # new, computed, cached or failed
+        self.seconds = 0.
+
+
+class StageGraph:
+    """
+    Stages depending on each other through the variables they read and write.
+
+    A stage depends on every stage writing one of its inputs. Running a
+    stage first runs what it depends on, then the stage itself only if its
+    inputs differ from a previous run; otherwise the outputs saved then are
+    copied back. Editing one variable therefore recomputes only the stages
+    downstream of it.
+    """
+
+    def __init__(self, cachesize=16):
+        self.stages = OrderedDict()
+        self.cache = OrderedDict()
+        self.cachesize = cachesize
+
+    def add(self, name, function, inputs, outputs, show=None):
+        self.stages[name] = Stage(name, function, inputs, outputs, show)
+
+    def dependencies(self, name):
+        """Names of the stages writing an input of the stage."""
+        inputs = set(self.stages[name].inputs)
+        return [other.name for other in self.stages.values()
+                if other.name != name and inputs.intersection(other.outputs)]
+
+    def order(self, targets=None):
+        """Stages needed for targets (default all), dependencies first."""
+        ordered = []
+
+        def visit(name, path):
+            if name in ordered:
+                return
+            if name in path:
+                raise ValueError('Cycle in stage graph: ' + ' -> '.join(path + [name]))
+            for dependency in self.dependencies(name):
+                visit(dependency, path + [name])
+            ordered.append(name)
+
+        for name in (targets or self.stages):
+            visit(name, [])
+        return ordered
+
+    def affectedBy(self, key):
+        """Stages recomputed when the variable key changes."""
+        affected = [s.name for s in self.stages.values() if key in s.inputs]
+        for name in self.order():
+            if name not in affected and set(self.dependencies(name)) & set(affected):
+                affected.append(name)
+        return [name for name in self.order() if name in affected]
+
+    def run(self, var, targets=None, progress=None):
+        """
+        Bring the targets (default all stages) up to date in var.
+        Returns False if a stage failed.
+        """
+        names = self.order(targets)
+        for i, name in enumerate(names):
+            stage = self.stages[name]
+            start = time.perf_counter()
+            key = (name,) + tuple(_frozen(var.get(k)) for k in stage.inputs)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                stage.state = 'cached'
+            else:
+                if stage.function() == False:
+                    stage.state = 'failed'
+                    print('ERROR in stage', name)
+                    return False
+                self.cache[key] = copy.deepcopy({k: var[k] for k in stage.outputs if k in var})
+                if len(self.cache) > self.cachesize:
+                    self.cache.popitem(last=False)
+                stage.state = 'computed'
+            var.update(copy.deepcopy(self.cache[key]))
+            if stage.show is not None:
+                stage.show()
+            stage.seconds = time.perf_counter() - start
+            if progress is not None:
+                progress(i + 1, len(names))
+        return True
+
+    def describe(self):
+        """Text listing the stages, their state and dependencies."""
+        lines = []
+        for name in self.order():
+            stage = self.stages[name]
+            lines.append('{0:20s} {1:8s} {2:8.4f}s  after: {3}'.format(
+                name, stage.state, stage.seconds, ', '.join(self.dependencies(name)) or '-'))
+            lines.append('    in:  ' + ', '.join(stage.inputs))
+            lines.append('    out: ' + ', '.join(stage.outputs))
+        return '\n'.join(lines)
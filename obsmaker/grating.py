@@ -72,28 +72,20 @@ def inductosyn2wavelength(gratpos, dichroic, array, order, obsdate=''):
     PS = wcal['PS'].values[0]
     QOFF = wcal['QOFF'].values[0]
     QS = wcal['QS'].values[0]
-    ISOFF = wcal.iloc[0][8:].values
+    ISOFF = wcal.iloc[0][8:].values.astype(float)
 
     order = int(order)
-    try:
-        ng = len(gratpos)
-    except:
-        ng = 1
-        gratpos = [gratpos]
+    # all the grating positions at once: axes are (position, module, pixel)
+    gratpos = np.atleast_1d(np.asarray(gratpos, dtype=float))[:, None, None]
     pix = np.arange(16) + 1.
-    result = np.zeros((ng, 25, 16))
-    result_dwdp = np.zeros((ng, 25, 16))
-    for ig, gp in enumerate(gratpos):
-        for module in range(25):
-            phi = 2. * np.pi * ISF * (gp + ISOFF[module]) / 2.0 ** 24
-            sign = np.sign(pix - QOFF)
-            delta = (pix - 8.5) * PS + sign * (pix - QOFF) ** 2 * QS
-            slitPos = 25 - 6 * (module // 5) + module % 5
-            g = g0 * np.cos(np.arctan2(slitPos - NP, a))  # Careful with arctan
-            lambd = 1000. * (g / order) * (np.sin(phi + gamma + delta) + np.sin(phi - gamma))
-            dwdp = 1000. * (g / order) * (PS + 2. * sign * QS * (pix - QOFF)) * np.cos(phi + gamma + delta)
-            result[ig, module, :] = lambd
-            result_dwdp[ig, module, :] = dwdp
+    module = np.arange(25)
+    phi = 2. * np.pi * ISF * (gratpos + ISOFF[:, None]) / 2.0 ** 24
+    sign = np.sign(pix - QOFF)
+    delta = (pix - 8.5) * PS + sign * (pix - QOFF) ** 2 * QS
+    slitPos = 25 - 6 * (module // 5) + module % 5
+    g = (g0 * np.cos(np.arctan2(slitPos - NP, a)))[:, None]  # Careful with arctan
+    result = 1000. * (g / order) * (np.sin(phi + gamma + delta) + np.sin(phi - gamma))
+    result_dwdp = 1000. * (g / order) * (PS + 2. * sign * QS * (pix - QOFF)) * np.cos(phi + gamma + delta)
 
     return result, result_dwdp
 
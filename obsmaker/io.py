@@ -2,13 +2,25 @@ import os
 import io
 import math
 import json
+import shutil
+import hashlib
+import time
+import tarfile
+import zipfile
+import queue
+import threading
+import logging
+import logging.handlers
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 from PyQt5.QtWidgets import (QPushButton, QWidget, QVBoxLayout, QHBoxLayout, QComboBox,
                              QLabel, QLineEdit, QFormLayout, QFileDialog, QSizePolicy)
 from PyQt5.QtGui import QIntValidator, QDoubleValidator
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
+from obsmaker import xmlparser
 
 path = os.path.dirname(os.path.realpath(__file__))
 file = os.path.join(path, "data", "keywords.json")
@@ -78,6 +90,61 @@ def addLabel(text, layout=None):
         layout.addWidget(label)
     return label
 
+class StatusLog:
+    """
+    Messages shown newest first in a text widget.
+
+    Only the last capacity messages are kept. Appends are collected and
+    shown once per event loop tick, so the widget is redrawn at most once
+    for a burst of messages. If logfile is given, every message is also
+    written to it, rotating after maxbytes with backups old files kept.
+    """
+
+    def __init__(self, widget, capacity=1000, logfile='', maxbytes=1000000, backups=5):
+        self.widget = widget
+        self.messages = deque(maxlen=capacity)
+        self.pending = []
+        self.timer = QTimer(widget)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.flush)
+        self.logger = None
+        if logfile:
+            logfile = os.path.abspath(os.path.expanduser(logfile))
+            self.logger = logging.getLogger('obsmaker.status')
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+            if not any(getattr(h, 'baseFilename', None) == logfile for h in self.logger.handlers):
+                try:
+                    handler = logging.handlers.RotatingFileHandler(
+                        logfile, maxBytes=maxbytes, backupCount=backups, encoding='utf-8')
+                except OSError as error:
+                    print('Cannot open status log file:', error)
+                    self.logger = None
+                else:
+                    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                    self.logger.addHandler(handler)
+
+    def append(self, msg):
+        self.pending.append(msg)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self):
+        """Show the pending messages."""
+        if not self.pending:
+            return
+        if self.logger is not None:
+            for msg in self.pending:
+                self.logger.info(msg.rstrip('\n'))
+        self.messages.extend(self.pending)
+        self.pending = []
+        self.widget.setPlainText(''.join(reversed(self.messages)))
+
+    def text(self):
+        """Messages kept, newest first, including the pending ones."""
+        return ''.join(reversed(self.pending)) + ''.join(reversed(self.messages))
+
 def replaceBadChar(string):
     """ replace some reserved characters with '_'
     see http://en.wikipedia.org/wiki/Filename for a list
@@ -99,6 +166,85 @@ def velocity2z(v):
     c = 299792.458 # km/s
     return v/c
 
+def groupRequests(vector):
+    '''
+    groups the <Request> elements of an AOR vector by (target, instrument)
+    in a single pass, keeping the order of appearance
+    output: dictionary of lists of requests
+    '''
+    groups = {}
+    for request in vector.findall('Request'):
+        combo = (request.find('target/name').text,
+                 request.find('instrument/data/InstrumentName').text)
+        groups.setdefault(combo, []).append(request)
+    return groups
+
+def readAORFile(aorfile):
+    '''
+    parses an AOR file once and extracts its requests
+    output: proposal ID, PI name and a list of (target, instrument) with the
+            readAOR output of each request (None for non FIFI-LS requests)
+    '''
+    from unidecode import unidecode
+    print('Reading file ', aorfile)
+    tree = xmlparser.parse(aorfile)
+    PropID = tree.find('list/ProposalInfo/ProposalID').text
+    if PropID == None:
+        PropID = "00_0000"    # indicates no PropID
+    PI = tree.find('list/ProposalInfo/Investigator')
+    # Get rid of non-ASCII characters
+    PIname = unidecode(PI.attrib['FirstName'] + ' ' + PI.attrib['LastName'])
+    combos = []
+    for combo, requests in groupRequests(tree.find('list/vector')).items():
+        if combo[1] == 'FIFI-LS':
+            combos.append((combo, [readAOR(request) for request in requests]))
+        else:
+            combos.append((combo, None))
+    return PropID, PIname, combos
+
+def translateAORFiles(aorfiles, workers=4, progress=None, status=None):
+    '''
+    translates AOR files into *.sct and map files in the directory of each
+    AOR file. The files are parsed by a pool of threads, but written in the
+    order of aorfiles so that the output does not depend on the scheduling.
+    progress(done, total, text) and status(msg) are called after each file.
+    output: summary message with the errors
+    '''
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(readAORFile, aorfile) for aorfile in aorfiles]
+        try:
+            for i, (aorfile, future) in enumerate(zip(aorfiles, futures)):
+                msg = "translateAOR: Reading file " + aorfile + "\n"
+                try:
+                    PropID, PIname, combos = future.result()
+                    # FIFI-LS wants sct and map files to be in the same directory
+                    # as the input aorfile, so set that as outdir
+                    outdir = os.path.dirname(os.path.abspath(aorfile))
+                    for combo, observations in combos:
+                        if observations is None:
+                            msg += 'Skipping a non-FIFI-LS aor.\n'
+                            continue
+                        for obs in observations:
+                            print('write translated AOR')
+                            msg += writeFAOR(obs, PropID, PIname, outdir)
+                except Exception as error:
+                    errors.append(os.path.basename(aorfile) + ': ' + str(error))
+                    msg += 'Translation failed: ' + str(error) + '\n'
+                if status is not None:
+                    status(msg)
+                if progress is not None:
+                    progress(i + 1, len(aorfiles), 'AOR files')
+        except:
+            # cancelled: do not start the remaining files
+            for future in futures:
+                future.cancel()
+            raise
+    summary = '{0:d} AOR files translated'.format(len(aorfiles) - len(errors))
+    if errors:
+        summary += ', {0:d} failed:\n'.format(len(errors)) + '\n'.join(errors)
+    return summary + '\n'
+
 def readAOR(vector):
     '''
     extracts values from <Request> for tagnames defined in definitions.py
@@ -113,18 +259,12 @@ def readAOR(vector):
     tagnames = config['tagnames']
     aor = dict.fromkeys(tagnames)
 
-    #print aor
+    # texts of all the tags, read in one pass over the request
+    texts = xmlparser.descendantTexts(vector, tagnames)
     for tag in tagnames:
-        nodes = vector.findall('.//' + tag)   # returns a list of objects
         # if the node returns values (i.e. the tag exists in the input XML):
-        if nodes != []:
-            if len(nodes) == 1:
-                aor[tag] = [nodes[0].text]
-            else:
-                data = list()
-                for node in nodes:
-                    data.append(node.text)
-                aor[tag] = data
+        if texts[tag] != []:
+            aor[tag] = texts[tag]
         # if the tag does not exist, set the value to a list with an empty element
         else: aor[tag] = ['']
     return aor
@@ -575,6 +715,341 @@ def readMap(filename=None):
     numMapPoints = numlines - 1
     return numMapPoints, mapListPath
 
+def scanDigest(content):
+    """
+    Hash of the content of a *.scn file, ignoring the time stamp line.
+    """
+    if content.startswith('# Time stamp'):
+        content = content[content.find('\n') + 1:]
+    return hashlib.sha256(content.encode()).hexdigest()
+
+class ScanDirectory:
+    """
+    Write the scan files of an observation in a directory.
+
+    Only files whose content changed are rewritten. They are staged in a
+    hidden directory and moved in place by close(), which also removes
+    the stale files and writes a manifest next to the directory.
+    If the observation cannot be completed, abort() leaves the
+    directory as it was.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.staging = os.path.join(os.path.dirname(path),
+                                    '.' + os.path.basename(path) + '.partial')
+        self.manifest = path + '_manifest.json'
+        self.scans = []
+        self.changed = []
+        if os.path.exists(self.staging):
+            shutil.rmtree(self.staging)
+
+    def write(self, filename, content):
+        """Stage a scan file if it differs from the one on disk."""
+        digest = scanDigest(content)
+        self.scans.append((filename, digest))
+        current = os.path.join(self.path, filename)
+        if os.path.exists(current):
+            with open(current) as f:
+                if scanDigest(f.read()) == digest:
+                    return
+        if not os.path.exists(self.staging):
+            os.makedirs(self.staging)
+        with open(os.path.join(self.staging, filename), 'w') as f:
+            f.write(content)
+        self.changed.append(filename)
+
+    def close(self):
+        """Move staged files in place, remove stale ones, write manifest."""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for filename in self.changed:
+            os.replace(os.path.join(self.staging, filename),
+                       os.path.join(self.path, filename))
+        if os.path.exists(self.staging):
+            shutil.rmtree(self.staging)
+        names = set(filename for filename, digest in self.scans)
+        removed = []
+        for filename in sorted(os.listdir(self.path)):
+            if filename not in names:
+                os.remove(os.path.join(self.path, filename))
+                removed.append(filename)
+        manifest = {
+            'directory': os.path.basename(self.path),
+            'scans': [{'file': filename, 'sha256': digest}
+                      for filename, digest in self.scans],
+            'written': len(self.changed),
+            'unchanged': len(self.scans) - len(self.changed),
+            'removed': removed}
+        with open(self.manifest, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        return '{0:d} scan files written, {1:d} unchanged, {2:d} removed.\n'.format(
+            manifest['written'], manifest['unchanged'], len(removed))
+
+    def abort(self):
+        """Discard the staged files."""
+        if os.path.exists(self.staging):
+            shutil.rmtree(self.staging)
+        return 'Scan files in ' + self.path + ' left unchanged.\n'
+
+class ScanArchive:
+    """
+    Stream the scan files of an observation into a single zip or tar file.
+
+    Members are named <obsid>/<scan file> so that extracting the archive
+    reproduces the directory written by ScanDirectory. The archive is
+    written to a temporary file and renamed by close().
+    """
+
+    def __init__(self, path, fmt='zip'):
+        self.obsid = os.path.basename(path)
+        self.fmt = fmt
+        if fmt == 'zip':
+            self.filename = path + '.zip'
+        else:
+            self.filename = path + '.tar'
+        self.partial = self.filename + '.partial'
+        self.nscans = 0
+        if fmt == 'zip':
+            self.archive = zipfile.ZipFile(self.partial, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(self.partial, 'w')
+
+    def write(self, filename, content):
+        """Append a scan file to the archive."""
+        name = self.obsid + '/' + filename
+        data = content.encode()
+        if self.fmt == 'zip':
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0o644
+            self.archive.addfile(info, io.BytesIO(data))
+        self.nscans += 1
+
+    def close(self):
+        """Finalize the archive and move it in place."""
+        self.archive.close()
+        os.replace(self.partial, self.filename)
+        return '{0:d} scan files written to {1:s}\n'.format(self.nscans, self.filename)
+
+    def abort(self):
+        """Discard the partial archive."""
+        self.archive.close()
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+        return 'Archive ' + self.filename + ' not written.\n'
+
+class BackgroundWriter:
+    """
+    Pass scan files to another output (ScanDirectory, ScanArchive) from a
+    writer thread, so that the next scans are computed while the previous
+    ones are written. The queue is bounded to limit memory use.
+
+    An error in the writer thread is raised again by the next call to
+    write() or by close().
+    """
+
+    def __init__(self, output, maxsize=64):
+        self.output = output
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self.output.write(*item)
+                except Exception as error:
+                    self.error = error
+
+    def write(self, filename, content):
+        """Queue a scan file, waiting if the writer is behind."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((filename, content))
+
+    def join(self):
+        """Wait until all the queued files are written."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def close(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.output.close()
+
+    def abort(self):
+        self.join()
+        return self.output.abort()
+
+class ScanSequence:
+    """
+    Keep the scans of an observation in memory instead of writing them.
+
+    Used for dry runs: only the values which change from scan to scan
+    are recorded, together with the scan file names.
+    """
+    keywords = ['los_focus_update', 'del_lam_map', 'del_bet_map', 'offpos_lambda',
+                'offpos_beta', 'gr_start', 'gr_lambda', 'ch_beam', 'anz_frames']
+
+    def __init__(self, samplesize):
+        self.samplesize = samplesize
+        self.scans = []
+
+    def record(self, filename, scn):
+        """Store the varying values of a scan."""
+        scan = {'file': filename}
+        for key in self.keywords:
+            value = scn[key]
+            if isinstance(value, list):
+                value = list(value)
+            scan[key] = value
+        self.scans.append(scan)
+
+    def totals(self):
+        """Number of scans, frames and scan time in seconds."""
+        frames = sum(scan['anz_frames'] for scan in self.scans)
+        return {'scans': len(self.scans),
+                'A': sum(1 for scan in self.scans if scan['file'].endswith('_A.scn')),
+                'B': sum(1 for scan in self.scans if scan['file'].endswith('_B.scn')),
+                'frames': frames,
+                'duration': frames / self.samplesize}
+
+    def close(self):
+        totals = self.totals()
+        return 'Dry run: {0:d} scans ({1:d} A, {2:d} B), {3:.0f} frames, ' \
+            '{4:.1f} s of scan time.\n'.format(totals['scans'], totals['A'], totals['B'],
+                                               totals['frames'], totals['duration'])
+
+    def abort(self):
+        return 'Dry run failed.\n'
+
+class ScanTable:
+    """
+    Columnar table of the scans of an observation.
+
+    One column per keyword of the *.scn layout (see ScanDescription.SCN_LAYOUT)
+    and one row per scan, in writing order. Values are kept as computed,
+    as written in the *.scn files. Keywords not set in a scan are None.
+    """
+    def __init__(self, layout):
+        self.columns = [item[:3] for item in layout if not isinstance(item, str)]
+        self.keywords = [keyword for keyword, key, index in self.columns]
+        self.files = []
+        self.data = {keyword: [] for keyword in self.keywords}
+
+    def __len__(self):
+        return len(self.files)
+
+    def record(self, filename, scn):
+        """Append a scan as a new row."""
+        self.files.append(filename)
+        for keyword, key, index in self.columns:
+            value = scn.get(key)
+            if value is not None and index is not None:
+                value = value[index]
+            self.data[keyword].append(value)
+
+    def row(self, i):
+        """Values of the i-th scan by keyword."""
+        return {keyword: self.data[keyword][i] for keyword in self.keywords}
+
+    def rows(self):
+        """Iterate over (file name, row) of the scans."""
+        for i, filename in enumerate(self.files):
+            yield filename, self.row(i)
+
+    def arrays(self):
+        """
+        Columns as numpy arrays, keywords never set are left out.
+        The scan file names are in the 'FILE' column.
+        """
+        arrays = {'FILE': np.array(self.files)}
+        for keyword in self.keywords:
+            column = self.data[keyword]
+            if all(value is None for value in column):
+                continue
+            arrays[keyword] = np.array(column)
+        return arrays
+
+    def toCSV(self, filename):
+        """Save the table as comma separated values with a header line."""
+        import csv
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['FILE'] + self.keywords)
+            for filename, row in self.rows():
+                writer.writerow([filename] + ['' if row[keyword] is None else row[keyword]
+                                              for keyword in self.keywords])
+
+    def toNPZ(self, filename):
+        """Save the columns in a numpy .npz file."""
+        np.savez_compressed(filename, **self.arrays())
+
+    def close(self):
+        return 'Scan table: {0:d} scans.\n'.format(len(self))
+
+    def abort(self):
+        return 'Scan table incomplete.\n'
+
+
+class ScanRecorder:
+    """
+    Output recording the scans in a ScanTable while passing their files to
+    another output, so the files are still written as the scans are computed.
+    """
+    def __init__(self, output, table):
+        self.output = output
+        self.table = table
+
+    def record(self, filename, scn):
+        self.table.record(filename, scn)
+
+    def write(self, filename, text):
+        self.output.write(filename, text)
+
+    def close(self):
+        return self.output.close()
+
+    def abort(self):
+        return self.output.abort()
+
+def extractScans(filename, outdir=None):
+    """
+    Extract an archive written by ScanArchive.
+
+    Returns the directory containing the scan files.
+    """
+    if outdir is None:
+        outdir = os.path.dirname(os.path.abspath(filename))
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as archive:
+            names = archive.namelist()
+            archive.extractall(outdir)
+    else:
+        with tarfile.open(filename) as archive:
+            names = archive.getnames()
+            if hasattr(tarfile, 'data_filter'):
+                archive.extractall(outdir, filter='data')
+            else:
+                archive.extractall(outdir)
+    if len(names) == 0:
+        return outdir
+    return os.path.join(outdir, names[0].split('/')[0])
+
 def writeTable(sctPars, filename, obstime):
     """
     Write *.tex tables to insert in the flight description.
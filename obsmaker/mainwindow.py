@@ -2,8 +2,7 @@ from PyQt5.QtWidgets import (QMainWindow, QApplication, QFileDialog, QWidget,
                              QHBoxLayout)
 #from PyQt5.QtCore import Qt
 from obsmaker.dialog import TableWidget
-from obsmaker.io import readAOR, writeFAOR, replaceBadChar, readSct, readMap
-import xml.etree.ElementTree as ET
+from obsmaker.io import readSct, readMap, translateAORFiles
 import sys
 import os
 
@@ -30,75 +29,56 @@ class GUI(QMainWindow):
 
     def defineActions(self):
         self.TW.translateAOR.clicked.connect(self.translateAOR)
+        self.TW.translateAORDir.clicked.connect(self.translateAORDir)
         self.TW.loadTemplate.clicked.connect(self.loadTemplate)
         self.TW.loadMapPatternFile.clicked.connect(self.loadMapFile)
         self.TW.exit.clicked.connect(self.exitObsmaker)
 
     def translateAOR(self):
         """
-        Read *aor created with USPOT, split it into multiple parts and save it in *.sct files.
+        Read *aor files created with USPOT, split them into multiple parts and save them in *.sct files.
         """
-        from unidecode import unidecode
         fd = QFileDialog(None, "Load and translate AOR")
         fd.setLabelText(QFileDialog.Accept, "Import")
         fd.setNameFilters(["AOR Files (*.aor)", "All Files (*)"])
         fd.setOptions(QFileDialog.DontUseNativeDialog)
         fd.setViewMode(QFileDialog.List)
-        fd.setFileMode(QFileDialog.ExistingFile)
+        fd.setFileMode(QFileDialog.ExistingFiles)
         if fd.exec():
-            fileName= fd.selectedFiles()
-            aorfile = fileName[0]
-            print('Reading file ', aorfile)
-            self.TW.update_status("translateAOR: Reading file " + aorfile + "\n")
-            errmsg = ''
-            # Save the file path for future reference
-            self.pathFile, file = os.path.split(aorfile)
-            # Define path of AOR file in the TW class
-            self.TW.pathFile = self.pathFile
-            tree = ET.ElementTree(file=aorfile)  # or tree = ET.parse(aorfile)
-            vector = tree.find('list/vector')
-            # Extract Target and Instrument from each AOR
-            targets = [item.text for item in vector.findall('Request/target/name')]
-            instruments = [item.text for item in vector.findall('Request/instrument/data/InstrumentName')]
-            print('targets ', targets)
-            print('instruments ', instruments)
-            # Unique combinations of target and instrument
-            target_inst=list(set(zip(targets,instruments)))
-            # get Proposal ID
-            PropID = tree.find('list/ProposalInfo/ProposalID').text
-            PI = tree.find('list/ProposalInfo/Investigator')
-            #PIname = PI.attrib['Honorific'] + ' ' + PI.attrib['FirstName'] + ' ' + PI.attrib['LastName']
-            # Get rid of non-ASCII characters
-            PIname = unidecode(PI.attrib['FirstName'] + ' ' + PI.attrib['LastName'])
-            print('Proposal ID ', PropID)
-            print('Proposer ', PIname)
-            if PropID == None:
-                PropID = "00_0000"    # indicates no PropID
-            for combo in target_inst:  # Loop over Target-Instrument combo
-                tree = ET.ElementTree(file=aorfile)
-                vector = tree.find('list/vector')
-                # remove non-relevant AORs
-                for elem in vector.findall('Request'):
-                    name = elem.find('target/name').text
-                    inst = elem.find('instrument/data/InstrumentName').text
-                    if (name, inst) != combo:
-                        vector.remove(elem)
-                # create root, PropID_Target_Inst
-                root = PropID + '_' + combo[0] + '_' + combo[1]
-                # replace some reserved characters with '_'
-                root = replaceBadChar(root)
-                inst = combo[1]
-                if inst == 'FIFI-LS':
-                    requests = vector.findall('Request')
-                    for aor in requests:
-                        obs = readAOR(aor)
-                        # FIFI-LS wants sct and map files to be in the same directory
-                        # as the input aorfile, so set that as outdir
-                        print('write translated AOR')
-                        errmsg += writeFAOR(obs, PropID, PIname,
-                            os.path.dirname(os.path.abspath(aorfile)))
-                else: errmsg += 'Skipping a non-FIFI-LS aor.\n'
-            self.TW.update_status(errmsg)
+            self.startTranslation(fd.selectedFiles())
+
+    def translateAORDir(self):
+        """Translate all the *.aor files of a directory."""
+        directory = QFileDialog.getExistingDirectory(None, "Translate AOR directory",
+                                                     options=QFileDialog.DontUseNativeDialog)
+        if directory:
+            aorfiles = [os.path.join(directory, f) for f in os.listdir(directory)
+                        if f.lower().endswith('.aor')]
+            if len(aorfiles) == 0:
+                self.TW.update_status('translateAOR: No *.aor file in ' + directory + '\n')
+                return
+            self.startTranslation(aorfiles)
+
+    def startTranslation(self, aorfiles):
+        """Translate the AOR files in a worker thread."""
+        # Sorted, so that the output does not depend on the selection order
+        aorfiles = sorted(aorfiles)
+        # Save the file path for future reference
+        self.pathFile, file = os.path.split(aorfiles[0])
+        # Define path of AOR file in the TW class
+        self.TW.pathFile = self.pathFile
+        self.TW.update_status('translateAOR: Translating {0:d} AOR files\n'.format(len(aorfiles)))
+        self.TW.runTask(translateAORFiles, self.translationFinished, self.translationFailed,
+                        None, aorfiles, self.TW.translate_workers, self.TW.progress,
+                        self.TW.update_status)
+
+    def translationFinished(self, summary):
+        self.TW.endTask()
+        self.TW.update_status(summary)
+
+    def translationFailed(self, error):
+        self.TW.endTask()
+        self.TW.update_status('translateAOR failed: ' + error + '\n')
 
     def loadTemplate(self):
         """Load a sct file."""
@@ -142,7 +122,7 @@ class GUI(QMainWindow):
                     print('Invalid map file.')
             # First build
             print('First build ')
-            self.TW.buildObs()
+            self.TW.startBuild()
 
     def loadMapFile(self):
         """Load a map file."""
@@ -0,0 +1,243 @@
+"""
+Golden output regression check with time and memory budgets.
+
+A corpus of synthetic proposals covering the observing modes and map
+patterns is translated, built and written. The *.sct, *_map.txt and
+*.scn files are recorded once with a trusted version:
+
+    python -m obsmaker.regression record golden
+
+and compared byte by byte (except the time stamp line of the scan
+files) after every change:
+
+    python -m obsmaker.regression check golden
+
+The golden output in tests/golden was produced by the version before
+the performance changes and is checked by the test suite (pytest).
+
+The check also fails if a case takes more than time-factor times the
+recorded time, or more than memory-factor times the recorded memory.
+The memory is traced in a second run of each case, since tracing slows
+down the calculation; --no-memory skips it.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import io
+
+from obsmaker.benchmark import syntheticAOR, translate, loadTemplate, build, environment
+
+# Cases: name, request parameters (npoints, otf, nodpattern, mode), *.sct values replaced
+CORPUS = [
+    ('symmetric chop', (9, False, 'ABBA', 'SYMMETRIC_CHOP'), {}),
+    ('asymmetric ABA', (6, False, 'ABA', 'ASYMMETRIC_CHOP'), {}),
+    # the asymmetric chop mode loads templates as ABA, AABAA is selected afterwards
+    ('asymmetric AABAA', (6, False, 'AABAA', 'ASYMMETRIC_CHOP'), {'NODPATTERN': 'AABAA'}),
+    ('total power', (4, False, 'ABA', 'TOTAL_POWER'), {}),
+    ('OTF_TP', (8, True, 'AB', None), {}),
+    ('spiral', (1, False, 'ABBA', 'SYMMETRIC_CHOP'),
+     {'PATTERN': 'Spiral', 'DITHMAP_NUMPOINTS': '9', 'DITHMAP_STEPSIZE': '10'}),
+    ('N-point cross', (1, False, 'ABBA', 'SYMMETRIC_CHOP'),
+     {'PATTERN': 'N-point cross', 'DITHMAP_NUMPOINTS': '5', 'DITHMAP_STEPSIZE': '10'}),
+    ('split grating', (4, False, 'ABBA', 'SYMMETRIC_CHOP'),
+     {'SCANDIST': 'Split', 'SPLITS': '2', 'RED_POSUP': '4', 'BLUE_POSUP': '4'}),
+]
+MANIFEST = 'manifest.json'
+# Compared files, other files (e.g. the manifests of the scan directories) are ignored
+OUTPUT_FILES = ('.sct', '_map.txt', '.scn')
+
+
+def caseDir(name):
+    return name.replace(' ', '_')
+
+
+def runCase(tw, request, overrides, outdir, trace=False):
+    """
+    Translate, build and write a case into outdir.
+    Returns the time [s], the traced memory peak [MB] (None if not traced)
+    and the error which stopped the case, if any. Errors are part of the
+    recorded behaviour.
+    """
+    os.makedirs(outdir)
+    aorfile = os.path.join(outdir, 'case.aor')
+    with open(aorfile, 'w') as f:
+        f.write(syntheticAOR(1, *request))
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        translate(aorfile, outdir)
+        for sctfile in sorted(f for f in os.listdir(outdir) if f.endswith('.sct')):
+            loadTemplate(tw, os.path.join(outdir, sctfile), overrides)
+            tw.sctdir.setText(os.path.join(outdir, 'scans'))
+            tw.graph.cache.clear()
+            if build(tw) == False:
+                error = 'build failed'
+                break
+            output = tw.prepareWrite()
+            try:
+                result = tw.writeScans(output)
+            except Exception:
+                output.abort()
+                raise
+            if result == False:
+                output.abort()
+                error = 'writing failed'
+                break
+    except Exception as e:
+        error = type(e).__name__ + ': ' + str(e)
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1] / 1024. / 1024.
+        tracemalloc.stop()
+    os.remove(aorfile)
+    return seconds, peak, error
+
+
+def runCorpus(outdir, corpus=CORPUS, memory=True, verbose=False):
+    """Produce the output of the corpus in outdir, returns the measures per case."""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    from obsmaker.dialog import TableWidget
+
+    def freshWidget():
+        # a new widget per run, so no case depends on the state left by another
+        tw = TableWidget(None)
+        tw.quiet = True  # no message boxes
+        return tw
+
+    measures = {}
+    for name, request, overrides in corpus:
+        log = sys.stdout if verbose else io.StringIO()
+        with contextlib.redirect_stdout(log):
+            tw = freshWidget()
+            seconds, _, error = runCase(tw, request, overrides,
+                                        os.path.join(outdir, caseDir(name)))
+            tw.deleteLater()
+            peak = None
+            if memory:
+                scratch = tempfile.mkdtemp(prefix='obsmaker_memory_')
+                tw = freshWidget()
+                try:
+                    _, peak, _ = runCase(tw, request, overrides,
+                                         os.path.join(scratch, 'case'), trace=True)
+                finally:
+                    tw.deleteLater()
+                    shutil.rmtree(scratch, ignore_errors=True)
+        app.processEvents()
+        measures[name] = {'seconds': seconds, 'peak_mb': peak, 'error': error}
+    return measures
+
+
+def readOutput(dir):
+    """Numbered lines of the files of a case, without the time stamp lines."""
+    files = {}
+    for root, _, names in os.walk(dir):
+        for name in names:
+            if not name.endswith(OUTPUT_FILES):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                lines = f.read().split(b'\n')
+            files[os.path.relpath(path, dir)] = [(i + 1, l) for i, l in enumerate(lines)
+                                                 if not l.startswith(b'# Time stamp')]
+    return files
+
+
+def compare(golden, new):
+    """List of differences between two output directories of a case."""
+    a, b = readOutput(golden), readOutput(new)
+    problems = ['missing ' + f for f in sorted(set(a) - set(b))]
+    problems += ['unexpected ' + f for f in sorted(set(b) - set(a))]
+    for f in sorted(set(a) & set(b)):
+        if a[f] != b[f]:
+            line = next((x[0] for x, y in zip(a[f], b[f]) if x != y),
+                        min(len(a[f]), len(b[f])) + 1)
+            problems.append('{0} differs at line {1:d}'.format(f, line))
+    return problems
+
+
+def record(golden, memory=True, verbose=False):
+    if os.path.exists(golden):
+        shutil.rmtree(golden)
+    os.makedirs(golden)
+    measures = runCorpus(golden, memory=memory, verbose=verbose)
+    with open(os.path.join(golden, MANIFEST), 'w') as f:
+        json.dump({'environment': environment(), 'cases': measures}, f, indent=2)
+    for name, m in measures.items():
+        print('{0:20s} recorded {1:7.3f}s {2:>8s} {3}'.format(
+            name, m['seconds'], megabytes(m['peak_mb']), m['error'] or ''))
+    return True
+
+
+def megabytes(value):
+    return '-' if value is None else '%.1f MB' % value
+
+
+def check(golden, time_factor=3., memory_factor=2., memory=True, verbose=False):
+    """
+    Compare the corpus output with the golden one, returns True if all cases pass.
+    No time budget is checked if time_factor is None.
+    """
+    with open(os.path.join(golden, MANIFEST)) as f:
+        recorded = json.load(f)['cases']
+    workdir = tempfile.mkdtemp(prefix='obsmaker_regression_')
+    try:
+        measures = runCorpus(workdir, memory=memory, verbose=verbose)
+        ok = True
+        for name, m in measures.items():
+            problems = compare(os.path.join(golden, caseDir(name)),
+                               os.path.join(workdir, caseDir(name)))
+            if name not in recorded:
+                problems.append('no recorded measures')
+            else:
+                r = recorded[name]
+                if m['error'] != r.get('error'):
+                    problems.append('error {0} instead of {1}'.format(m['error'], r.get('error')))
+                if time_factor is not None and m['seconds'] > time_factor * r['seconds']:
+                    problems.append('time {0:.3f}s over budget {1:.3f}s'.format(
+                        m['seconds'], time_factor * r['seconds']))
+                if (m['peak_mb'] is not None and r['peak_mb'] is not None and
+                        m['peak_mb'] > memory_factor * r['peak_mb']):
+                    problems.append('memory {0:.1f} MB over budget {1:.1f} MB'.format(
+                        m['peak_mb'], memory_factor * r['peak_mb']))
+            print('{0:20s} {1:4s} {2:7.3f}s {3:>8s}'.format(
+                name, 'FAIL' if problems else 'ok', m['seconds'], megabytes(m['peak_mb'])))
+            for problem in problems[:10]:
+                print('    ' + problem)
+            ok = ok and not problems
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Golden output regression check.')
+    parser.add_argument('action', choices=['record', 'check'])
+    parser.add_argument('golden', help='directory of the golden output')
+    parser.add_argument('--time-factor', type=float, default=3.,
+                        help='time budget as multiple of the recorded time')
+    parser.add_argument('--memory-factor', type=float, default=2.,
+                        help='memory budget as multiple of the recorded peak')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='do not trace the memory (faster)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the obsmaker output')
+    args = parser.parse_args(argv)
+    if args.action == 'record':
+        ok = record(args.golden, args.memory, args.verbose)
+    else:
+        ok = check(args.golden, args.time_factor, args.memory_factor, args.memory, args.verbose)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""
+Absolute sky positions of the scans and their export for quality checks.
+
+Offsets are converted with numpy on whole arrays, in the convention of
+astropy's SkyCoord.spherical_offsets_by, without astropy calls per point.
+"""
+import numpy as np
+
+
+def offsetsToSky(ra0, dec0, dlam, dbet):
+    """
+    RA/Dec [deg] of offsets dlam, dbet [arcsec] from (ra0, dec0) [deg].
+    The offsets are longitude and latitude in the frame centred on
+    (ra0, dec0) with the latitude towards North.
+    """
+    lon = np.radians(np.asarray(dlam, dtype=float) / 3600.)
+    lat = np.radians(np.asarray(dbet, dtype=float) / 3600.)
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    # unit vectors in the offset frame, rotated to the origin
+    x = np.cos(lat) * np.cos(lon)
+    y = np.cos(lat) * np.sin(lon)
+    z = np.sin(lat)
+    x, z = x * np.cos(dec0) - z * np.sin(dec0), x * np.sin(dec0) + z * np.cos(dec0)
+    ra = np.degrees(ra0 + np.arctan2(y, x)) % 360.
+    dec = np.degrees(np.arcsin(np.clip(z, -1., 1.)))
+    return ra, dec
+
+
+def rotateOffsets(dlam, dbet, angle):
+    """
+    East/North offsets of offsets along axes rotated by angle [deg E of N],
+    the y axis pointing at the position angle. This is the transpose of
+    the rotation matrix by angle, as used for the OTF legs (see otfLegs).
+    """
+    angle = np.radians(angle)
+    cosa, sina = np.cos(angle), np.sin(angle)
+    dlam = np.asarray(dlam, dtype=float)
+    dbet = np.asarray(dbet, dtype=float)
+    return cosa * dlam + sina * dbet, -sina * dlam + cosa * dbet
+
+
+def writePositionsCSV(filename, positions):
+    """Save the A and B positions as a CSV table."""
+    table = np.column_stack([positions['position'], positions['ra_a'], positions['dec_a'],
+                             positions['ra_b'], positions['dec_b']])
+    np.savetxt(filename, table, delimiter=',', fmt=['%d'] + ['%.7f'] * 4,
+               header='position,ra_a,dec_a,ra_b,dec_b', comments='')
+
+
+def writePositionsDS9(filename, positions, title=''):
+    """Save the A (green) and B (red) positions as a DS9 region file."""
+    lines = ['# Region file format: DS9 version 4.1',
+             '# ' + title,
+             'global font="helvetica 9 normal" select=1 edit=0 move=0 delete=1',
+             'fk5']
+    for n, ra, dec in zip(positions['position'], positions['ra_a'], positions['dec_a']):
+        lines.append('point({0:.7f},{1:.7f}) # point=cross color=green text={{A{2:d}}}'.format(
+            ra, dec, n))
+    b = np.isfinite(positions['ra_b'])
+    for n, ra, dec in zip(positions['position'][b], positions['ra_b'][b], positions['dec_b'][b]):
+        lines.append('point({0:.7f},{1:.7f}) # point=box color=red text={{B{2:d}}}'.format(
+            ra, dec, n))
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
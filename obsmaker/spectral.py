@@ -0,0 +1,87 @@
+"""
+Spectral coverage of the 25 spaxels during an observation.
+
+The grating positions of all the scans (nod cycles, splits, up and down
+ramps) are collected first. The distinct positions are converted to the
+wavelengths of the 25 spaxels x 16 pixels in a single call, then
+histogrammed with the number of times each position is visited.
+"""
+import numpy as np
+from obsmaker.grating import inductosyn2wavelength
+
+NSPAXELS = 25
+
+
+def scanGratingPositions(starts, steps_up, stepsize_up, steps_down, stepsize_down, cycles):
+    """
+    Inductosyn positions visited by scans starting at starts, as an array
+    (scan, position). In each grating cycle the grating makes steps_up
+    steps of stepsize_up from the start, then steps_down steps of
+    stepsize_down back from the top of the up ramp.
+    """
+    starts = np.asarray(starts, dtype=np.int64)[:, None]
+    up = np.arange(steps_up) * stepsize_up
+    down = steps_up * stepsize_up - np.arange(steps_down) * stepsize_down
+    return starts + np.tile(np.concatenate([up, down]), cycles)
+
+
+def spectralHistogram(gratpos, dichroic, array, order, binpixels=1.):
+    """
+    Number of samples of the 25 spaxels in wavelength bins for the visited
+    grating positions gratpos. The bins are binpixels spectral pixels wide
+    (median dispersion). Returns the bin edges [um] and the counts (25, nbins).
+    """
+    positions, visits = np.unique(np.ravel(gratpos), return_counts=True)
+    wave, dwdp = inductosyn2wavelength(positions, dichroic, array, order)
+    width = binpixels * np.median(np.abs(dwdp))
+    start = wave.min()
+    nbins = int((wave.max() - start) / width) + 1
+    edges = start + width * np.arange(nbins + 1)
+    bins = np.minimum(((wave - start) / width).astype(int), nbins - 1)
+    index = np.arange(NSPAXELS)[:, None] * nbins + bins
+    samples = np.broadcast_to(visits[:, None, None], wave.shape)
+    counts = np.bincount(index.ravel(), weights=samples.ravel(), minlength=NSPAXELS * nbins)
+    return edges, np.rint(counts).astype(np.int64).reshape(NSPAXELS, nbins)
+
+
+def spectralSummary(edges, counts, exposure, line):
+    """
+    Text with the wavelength range, the range around line [um] covered by
+    all the spaxels and their exposure [s] at line.
+    """
+    text = '{0:.3f}-{1:.3f} um in bins of {2:.4f} um'.format(
+        edges[0], edges[-1], edges[1] - edges[0])
+    i = int(np.searchsorted(edges, line, side='right')) - 1
+    if not 0 <= i < counts.shape[1]:
+        return text + ', {0:.3f} um not covered'.format(line)
+    missing = np.count_nonzero(counts[:, i] == 0)
+    if missing > 0:
+        return text + ', {0:.3f} um missed by {1:d} spaxels'.format(line, missing)
+    common = np.all(counts > 0, axis=0)
+    lo, hi = i, i
+    while lo > 0 and common[lo - 1]:
+        lo -= 1
+    while hi < len(common) - 1 and common[hi + 1]:
+        hi += 1
+    return (text + ', all spaxels cover {0:.3f}-{1:.3f} um, exposure at {2:.3f} um '
+            'min {3:.1f} s median {4:.1f} s max {5:.1f} s').format(
+                edges[lo], edges[hi + 1], line, exposure[:, i].min(),
+                np.median(exposure[:, i]), exposure[:, i].max())
+
+
+def writeSpectralFITS(filename, images, edges):
+    """
+    Save the images (name: (data, unit)) of spaxel x wavelength as
+    extensions of a FITS file with a linear wavelength axis.
+    """
+    from astropy.io import fits
+    width = edges[1] - edges[0]
+    hdus = [fits.PrimaryHDU()]
+    for name, (data, unit) in images.items():
+        hdu = fits.ImageHDU(data, name=name)
+        hdu.header.update({'CTYPE1': 'WAVE', 'CUNIT1': 'um', 'CRPIX1': 1.,
+                           'CRVAL1': edges[0] + width / 2., 'CDELT1': width,
+                           'CTYPE2': 'SPAXEL', 'CRPIX2': 1., 'CRVAL2': 1., 'CDELT2': 1.})
+        hdu.header['BUNIT'] = unit
+        hdus.append(hdu)
+    fits.HDUList(hdus).writeto(filename, overwrite=True)
@@ -0,0 +1,85 @@
+import json
+import time
+import functools
+import threading
+from collections import deque
+import numpy as np
+
+
+class Timers:
+    """
+    Durations of the pipeline stages, aggregated per name.
+
+    Calls and total time are exact, the percentiles use the last
+    `keep` durations of each stage.
+    """
+
+    def __init__(self, enabled=True, keep=10000):
+        self.enabled = enabled
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.totals = {}
+            self.samples = {}
+
+    def add(self, name, seconds):
+        with self.lock:
+            if name not in self.calls:
+                self.calls[name] = 0
+                self.totals[name] = 0.
+                self.samples[name] = deque(maxlen=self.keep)
+            self.calls[name] += 1
+            self.totals[name] += seconds
+            self.samples[name].append(seconds)
+
+    def summary(self):
+        """Dictionary of calls, total, p50 and p95 [s] per stage."""
+        with self.lock:
+            names = list(self.calls)
+            samples = {name: np.array(self.samples[name]) for name in names}
+            result = {name: {'calls': self.calls[name], 'total': self.totals[name]}
+                      for name in names}
+        for name in names:
+            p50, p95 = np.percentile(samples[name], [50, 95])
+            result[name]['p50'] = float(p50)
+            result[name]['p95'] = float(p95)
+        return result
+
+    def report(self):
+        """Summary as a text table, slowest stages first."""
+        summary = self.summary()
+        if not summary:
+            return 'No stage timings recorded.\n'
+        lines = ['{0:40s} {1:>7s} {2:>9s} {3:>9s} {4:>9s}'.format(
+            'Stage', 'calls', 'total [s]', 'p50 [ms]', 'p95 [ms]')]
+        for name, s in sorted(summary.items(), key=lambda item: -item[1]['total']):
+            lines.append('{0:40s} {1:7d} {2:9.3f} {3:9.3f} {4:9.3f}'.format(
+                name, s['calls'], s['total'], s['p50'] * 1000, s['p95'] * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def toJSON(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+timers = Timers()
+
+
+def timed(function):
+    """Record the duration of each call of function in timers."""
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not timers.enabled:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timers.add(name, time.perf_counter() - start)
+    return wrapper
@@ -0,0 +1,345 @@
+import numpy as np
+
+
+def scanTiming(chop_amp, chop_length, red_ramplen, blue_ramplen, red_chopcyc, blue_chopcyc,
+               red_posup, red_posdown, blue_posup, blue_posdown, red_grtcyc, blue_grtcyc,
+               nodcycles, scandist, samplesize=250.0):
+    """
+    Timing of a single scan file, red and blue.
+
+    All the numerical parameters can be scalars or numpy arrays which are
+    broadcast together, scandist is one of 'Up', 'Down', 'None', 'Split'.
+    Returns a dictionary of arrays (see TableWidget.calcTiming).
+    """
+    chop_amp = np.asarray(chop_amp, dtype=float)
+    nodcycles = np.asarray(nodcycles)
+    red_posup = np.asarray(red_posup)
+    red_posdown = np.asarray(red_posdown)
+    blue_posup = np.asarray(blue_posup)
+    blue_posdown = np.asarray(blue_posdown)
+    obs_con_chopeff = np.where(chop_amp == 0.0, 1.0, 0.5)
+
+    # ramp length in ms, red and blue
+    red_ramplen_ms = (1000.0 / samplesize) * np.asarray(red_ramplen)
+    blue_ramplen_ms = (1000.0 / samplesize) * np.asarray(blue_ramplen)
+    # for 2POINT chop scheme - time in samples
+    chopcyctime_sam = 2. * np.asarray(chop_length)
+
+    # time per grating position in samples
+    red_grtpostime_sam = red_chopcyc * chopcyctime_sam
+    blue_grtpostime_sam = blue_chopcyc * chopcyctime_sam
+    # number of total grating positions = up + down
+    red_numgrtpos = red_posup + red_posdown
+    blue_numgrtpos = blue_posup + blue_posdown
+    # time per grating cycle in samples
+    red_grtcyctime_sam = red_numgrtpos * red_grtpostime_sam
+    blue_grtcyctime_sam = blue_numgrtpos * blue_grtpostime_sam
+
+    distributed = nodcycles >= 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # override timepergrtcyc if distributing steps
+        if scandist in ['Up', 'Down']:
+            if scandist == 'Up':
+                red_pos, blue_pos = red_posup, blue_posup
+            else:
+                red_pos, blue_pos = red_posdown, blue_posdown
+            red_grtcyctime_sam = np.where(distributed & (red_pos > 1),
+                                          (red_pos / nodcycles) * red_grtpostime_sam,
+                                          red_grtcyctime_sam)
+            blue_grtcyctime_sam = np.where(distributed & (blue_pos > 1),
+                                           (blue_pos / nodcycles) * blue_grtpostime_sam,
+                                           blue_grtcyctime_sam)
+
+        # time per scan in ms
+        red_scantime_ms = (1000 / samplesize) * red_grtcyc * red_grtcyctime_sam
+        blue_scantime_ms = (1000 / samplesize) * blue_grtcyc * blue_grtcyctime_sam
+
+        # ramps per chop pos
+        red_rampsperchoppos = chop_length / np.asarray(red_ramplen, dtype=float)
+        blue_rampsperchoppos = chop_length / np.asarray(blue_ramplen, dtype=float)
+
+        # On-source chop cycle length in samples, account for chopper eff.
+        chopcyctime_src_sam = chopcyctime_sam * obs_con_chopeff
+        red_grtpostime_src_sam = chopcyctime_src_sam * red_chopcyc
+        # time spent by grating settling after a move in samps
+        red_grtsettime_sam = (red_posup - 1 + red_posdown - 1) * (0.25 / samplesize)
+        # actual time per grating cycle on source
+        red_grtcyctime_src_sam = (red_grtpostime_src_sam * red_numgrtpos) - red_grtsettime_sam
+        red_scantime_src_sam = red_grtcyctime_src_sam * red_grtcyc
+
+        # special cases where we are distributing steps over nod cycles
+        if scandist in ['Up', 'Down']:
+            obs4sample = 0.25 / samplesize
+            if scandist == 'Up':
+                red_pos = red_posup
+            else:
+                red_pos = red_posdown
+            red_grtsettime_sam = np.where(red_pos <= 1, red_pos * obs4sample,
+                                          red_pos / nodcycles * obs4sample)
+            red_scantime_src_sam = np.where(
+                distributed,
+                (red_grtpostime_src_sam * red_pos / nodcycles - red_grtsettime_sam) * red_grtcyc,
+                red_scantime_src_sam)
+
+    chop_freq = samplesize / np.asarray(chop_length, dtype=float) * 0.5
+
+    return {'red_ramplen_ms': red_ramplen_ms,
+            'blue_ramplen_ms': blue_ramplen_ms,
+            'red_numgrtpos': red_numgrtpos,
+            'blue_numgrtpos': blue_numgrtpos,
+            'red_scantime_ms': red_scantime_ms,
+            'blue_scantime_ms': blue_scantime_ms,
+            'red_rampsperchoppos': red_rampsperchoppos,
+            'blue_rampsperchoppos': blue_rampsperchoppos,
+            'red_scantime_src_sam': red_scantime_src_sam,
+            'chop_freq': chop_freq}
+
+
+def observationTiming(scan, numlistpoints, nodcycles, nodpattern, symmetry,
+                      samplesize=250.0):
+    """
+    Raw, on-source and total observation time from the scan timing
+    returned by scanTiming and the number of map points.
+
+    nodpattern is one of 'ABBA', 'AB', 'A', 'ABA', 'AABAA' and symmetry
+    'Symmetric' or 'Asymmetric'.
+    """
+    npts = np.asarray(numlistpoints)
+    nodcycles = np.asarray(nodcycles)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if nodpattern in ['ABA', 'AABAA']:
+            nodmultiplier = np.ceil(npts / nodcycles)
+        elif nodpattern == 'A':
+            nodmultiplier = nodcycles
+        else:  # 'AB' and 'ABBA'
+            nodmultiplier = 2 * nodcycles
+        nodmultiplier = np.where(nodcycles.astype(int) == 0, 1, nodmultiplier)
+
+        # raw integration time - use the longest scan time between both channels
+        red_scantime_ms = scan['red_scantime_ms']
+        scantime_ms = np.where(red_scantime_ms >= scan['blue_scantime_ms'],
+                               red_scantime_ms, scan['blue_scantime_ms'])
+        if nodpattern in ['ABA', 'AABAA']:
+            rawtime_ms = (npts + nodmultiplier) * scantime_ms
+        else:  # 'AB', 'ABBA', and 'A'
+            rawtime_ms = npts * scantime_ms * nodmultiplier
+        rawtime_sec = rawtime_ms / 1000.
+
+        # on source integration time
+        if nodpattern in ['ABA', 'AABAA']:
+            sourcetime_sam = npts * scan['red_scantime_src_sam']
+        else:
+            if symmetry == 'Symmetric':
+                symfactor = 1.
+            else:
+                symfactor = 2.
+            sourcetime_sam = npts * nodmultiplier / symfactor * scan['red_scantime_src_sam']
+        sourcetime_sec = sourcetime_sam / samplesize
+
+        # observation time including overheads
+        if nodpattern == 'A':
+            nodcycmovetime_total_sec = np.zeros(np.shape(rawtime_sec))
+            obstime_sec = rawtime_sec + nodcycmovetime_total_sec
+        elif nodpattern == 'AB':
+            nodcycmovetime_sec = 10.0 * 2.0 * nodcycles
+            nodcycmovetime_total_sec = nodcycmovetime_sec * npts
+            obstime_sec = rawtime_sec + nodcycmovetime_total_sec
+        elif nodpattern == 'ABBA':
+            nodcycmovetime_sec = 10.0 * nodcycles
+            nodcycmovetime_total_sec = nodcycmovetime_sec * npts
+            obstime_sec = rawtime_sec + nodcycmovetime_total_sec
+        else:  # 'ABA', 'AABAA'
+            nodcycmovetime_sec = 10. * (nodcycles + 1)
+            nodcycscantime_sec = nodcycmovetime_sec + \
+                (red_scantime_ms / 1000. * (nodcycles + 1))
+            nodcycmovetime_total_sec = nodcycmovetime_sec * np.ceil(npts / nodcycles)
+            obstime_sec = nodcycscantime_sec * np.ceil(npts / nodcycles)
+
+    return {'nodmultiplier': nodmultiplier,
+            'rawtime_sec': rawtime_sec,
+            'sourcetime_sec': sourcetime_sec,
+            'overhead_sec': nodcycmovetime_total_sec,
+            'obstime_sec': obstime_sec}
+
+
+def timingModel(chop_amp, chop_length, red_ramplen, blue_ramplen, red_chopcyc, blue_chopcyc,
+                red_posup, red_posdown, blue_posup, blue_posdown, red_grtcyc, blue_grtcyc,
+                nodcycles, numlistpoints, scandist='Up', nodpattern='ABBA',
+                symmetry='Symmetric', samplesize=250.0):
+    """
+    Timing of an observation for arrays of observing parameters.
+
+    Usage:
+    t = timingModel(chop_amp=60, chop_length=64, red_ramplen=32, blue_ramplen=32,
+                    red_chopcyc=np.arange(1, 20), blue_chopcyc=np.arange(1, 20),
+                    red_posup=8, red_posdown=0, blue_posup=8, blue_posdown=0,
+                    red_grtcyc=1, blue_grtcyc=1, nodcycles=2, numlistpoints=9)
+    t['obstime_sec']
+    """
+    scan = scanTiming(chop_amp, chop_length, red_ramplen, blue_ramplen, red_chopcyc,
+                      blue_chopcyc, red_posup, red_posdown, blue_posup, blue_posdown,
+                      red_grtcyc, blue_grtcyc, nodcycles, scandist, samplesize)
+    timing = observationTiming(scan, numlistpoints, nodcycles, nodpattern, symmetry,
+                               samplesize)
+    timing.update(scan)
+    return timing
+
+
+def mround(number, multiple):
+    """
+    MS Excel's MROUND function.  Rounds up number to the closest integer
+    multiple of multiple if number % multiple is greater than
+    multiple / 2.
+    """
+    num = np.trunc(number / multiple)
+    rem = number % multiple
+    return np.where(rem > multiple / 2., multiple * (num + 1), multiple * num)
+
+
+def gratingTiming(t_int_source, n_grating_pos, n_map_pts, nodcycles, nodpattern, symmetry,
+                  obs_eff=0.5, t_grating_move=0.0, t_ta_move=8.0, f_chop=2.0):
+    """
+    Nod cycles, chop cycles per grating position and time to complete the map
+    from the on-source time per map position (see TableWidget.grating_xls).
+
+    The numerical parameters can be scalars or numpy arrays. The returned
+    'valid' array flags the setups the GUI would accept.
+    """
+    t_int_source = np.asarray(t_int_source, dtype=float)
+    n_grating_pos = np.asarray(n_grating_pos)
+    nodcycles = np.asarray(nodcycles)
+    # exposure time needed due to attain t_int_source, seconds
+    t_int_chopped = t_int_source / obs_eff
+    # time spent in one grating position, seconds
+    if symmetry == 'Asymmetric':
+        t_grating_pos = (t_int_chopped / n_grating_pos) + t_grating_move
+    else:
+        t_grating_pos = (t_int_chopped / (2 * n_grating_pos)) + t_grating_move
+    # time it takes to complete all grating steps
+    t_grating_sweep = t_grating_pos * n_grating_pos
+    # number of chop cycles during one grating position
+    n_cc_per_grating_pos = t_grating_pos * f_chop
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if nodpattern in ['ABA', 'AABAA']:
+            # Bright Object mode, the number of A positions per B must be even
+            n_nod_cycles = nodcycles
+            n_grating_pos_per_nod = np.full(np.shape(t_grating_pos), np.nan)
+            t_nod_grating = np.full(np.shape(t_grating_pos), np.nan)
+            # total time to complete map, minutes
+            t_map = (nodcycles + 1) * \
+                (t_int_source * 2 + t_ta_move) * n_map_pts / nodcycles / 60.
+            valid = (nodcycles > 0) & (nodcycles % 2 == 0)
+        else:  # (AB)*n and (ABBA)*(n/2) modes
+            t_nod_interval = 30.  # nod interval, seconds
+            # number of nod cycles needed to complete all grating positions
+            n_nod_cycles = mround(np.ceil(t_grating_sweep * 2 / t_nod_interval), 2) / 2
+            # number of grating positions on one nod
+            n_grating_pos_per_nod = n_grating_pos // n_nod_cycles
+            # time of one nod, based on the number of grating positions on the nod, seconds
+            t_nod_grating = t_grating_pos * n_grating_pos_per_nod
+            # time interval of AB nod pair
+            t_nod_ab = (t_nod_grating + t_ta_move) * 2
+            # total time to complete map, minutes
+            t_map = t_nod_ab * n_nod_cycles * n_map_pts / 60.
+            valid = t_grating_sweep > 15
+
+    valid = valid & (t_int_source > 0) & (n_grating_pos > 0)
+    return {'t_grating_pos': t_grating_pos,
+            't_grating_sweep': t_grating_sweep,
+            'n_cc_per_grating_pos': n_cc_per_grating_pos,
+            'n_nod_cycles': n_nod_cycles,
+            'n_grating_pos_per_nod': n_grating_pos_per_nod,
+            't_nod_grating': t_nod_grating,
+            't_map': t_map,
+            'valid': valid}
+
+
+def paretoFront(x, y):
+    """
+    Indices of the points of (x, y) not dominated by any other point when
+    minimizing both coordinates, sorted by increasing x.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if x.size == 0:
+        return np.array([], dtype=int)
+    order = np.lexsort((y, x))
+    ys = y[order]
+    best = np.minimum.accumulate(ys)
+    keep = np.r_[True, ys[1:] < best[:-1]]
+    return order[keep]
+
+
+def optimizeGrating(t_int_source, n_grating_pos, n_map_pts, nodpattern, symmetry,
+                    max_grating_pos=None, max_chopcyc=None, nodcycles=(2, 4, 6, 8),
+                    obs_eff=0.5, t_grating_move=0.0, t_ta_move=8.0, f_chop=2.0):
+    """
+    Search the (grating positions, nod cycles, chop cycles) setups reaching
+    at least t_int_source seconds on source per map position with at least
+    n_grating_pos grating positions.
+
+    Returns the Pareto front of time to complete the map [min] vs. overhead
+    fraction as a dictionary of arrays sorted by increasing map time.
+    For (AB)*n and (ABBA)*(n/2) modes the nod cycles follow from the grating
+    sweep, for bright object modes the nodcycles values are searched.
+    """
+    if max_grating_pos is None:
+        max_grating_pos = 2 * n_grating_pos
+    if symmetry == 'Asymmetric':
+        symfactor = 1
+    else:
+        symfactor = 2
+    if max_chopcyc is None:
+        # twice the chop cycles needed with the minimum number of grating positions
+        t_grating_pos = t_int_source / obs_eff / (symfactor * n_grating_pos) + t_grating_move
+        max_chopcyc = int(np.ceil(2 * t_grating_pos * f_chop))
+    if nodpattern not in ['ABA', 'AABAA']:
+        nodcycles = (0,)
+
+    gp, nc, cc = np.meshgrid(np.arange(n_grating_pos, max_grating_pos + 1),
+                             np.asarray(nodcycles),
+                             np.arange(1, max_chopcyc + 1), indexing='ij')
+    gp, nc, cc = gp.ravel(), nc.ravel(), cc.ravel()
+    # on-source time delivered by an integer number of chop cycles
+    sourcetime = (cc / f_chop - t_grating_move) * symfactor * gp * obs_eff
+    t = gratingTiming(sourcetime, gp, n_map_pts, nc, nodpattern, symmetry,
+                      obs_eff, t_grating_move, t_ta_move, f_chop)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overhead = 1. - sourcetime * n_map_pts / (t['t_map'] * 60.)
+    ok = t['valid'] & (sourcetime >= t_int_source) & np.isfinite(t['t_map'])
+    if nodpattern not in ['ABA', 'AABAA']:
+        ok &= t['n_grating_pos_per_nod'] >= 1
+    idx = np.flatnonzero(ok)
+    idx = idx[paretoFront(t['t_map'][idx], overhead[idx])]
+
+    return {'grating_pos': gp[idx],
+            'nodcycles': np.broadcast_to(t['n_nod_cycles'], gp.shape)[idx].astype(int),
+            'chopcyc': cc[idx],
+            'sourcetime': sourcetime[idx],
+            't_map': t['t_map'][idx],
+            'overhead': overhead[idx]}
+
+
+def bestSetups(front, n=10):
+    """
+    Indices of the setups of front with the shortest map time for each
+    distinct (grating positions, nod cycles) pair, at most n of them,
+    sorted by increasing map time.
+    """
+    pairs = np.column_stack([front['grating_pos'], front['nodcycles']])
+    if len(pairs) == 0:
+        return np.array([], dtype=int)
+    first = np.unique(pairs, axis=0, return_index=True)[1]
+    # the front is sorted by map time, so the first setup of a pair is the fastest
+    idx = first[np.argsort(front['t_map'][first], kind='stable')]
+    return idx[:n]
+
+
+def writeSetupsCSV(filename, front):
+    """Save the setups of front as a CSV table."""
+    table = np.column_stack([front['grating_pos'], front['nodcycles'], front['chopcyc'],
+                             front['sourcetime'], front['t_map'], front['overhead']])
+    np.savetxt(filename, table, delimiter=',', fmt=['%d', '%d', '%d', '%.1f', '%.3f', '%.4f'],
+               header='grating_pos,nodcycles,chopcyc,sourcetime_sec,t_map_min,overhead',
+               comments='')
@@ -0,0 +1,64 @@
+import time
+import threading
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+
+
+class Cancelled(Exception):
+    """Raised inside a task when the user asked to cancel it."""
+    pass
+
+
+class Task(QObject):
+    """
+    Run function(*args) in a worker thread.
+
+    The function can call report(done, total, text) to update the progress,
+    which raises Cancelled once cancel() has been called. The result, the
+    error message or the cancellation are sent back through signals, so
+    the connected slots of widgets run in the GUI thread.
+    """
+    progress = pyqtSignal(int, int, str)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, function, *args, interval=0.05):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.interval = interval  # minimum time between progress updates [s]
+        self.last = 0.
+        self.stop = threading.Event()
+        self.thread = QThread()
+        self.moveToThread(self.thread)
+        self.thread.started.connect(self.run)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.stop.set()
+
+    def wait(self):
+        """Block until the thread has finished."""
+        self.thread.wait()
+
+    def report(self, done, total, text=''):
+        if self.stop.is_set():
+            raise Cancelled()
+        now = time.monotonic()
+        if done >= total or now - self.last >= self.interval:
+            self.last = now
+            self.progress.emit(done, total, text)
+
+    def run(self):
+        try:
+            result = self.function(*self.args)
+        except Cancelled:
+            self.cancelled.emit()
+        except Exception as error:
+            self.failed.emit(str(error))
+        else:
+            self.finished.emit(result)
+        finally:
+            self.thread.quit()
@@ -0,0 +1,66 @@
+"""
+XML parsing of the AOR files.
+
+By default the backend is chosen by file size. The C parser of lxml,
+when installed, parses faster, but reading the requests creates a Python
+proxy per element: parsing plus reading is faster with lxml on typical
+proposals, up to a few MB, and not on larger ones, where ElementTree is
+used (see benchmark --xml). setBackend forces a backend. Both give the
+same elements and texts, so the translation does not depend on the
+backend.
+"""
+import os
+import xml.etree.ElementTree as ElementTree
+try:
+    from lxml import etree as lxmlTree
+except ImportError:
+    lxmlTree = None
+
+BACKENDS = ['auto', 'lxml', 'ElementTree']
+backend = 'auto'
+# Largest file parsed with lxml by the automatic choice [MB]
+LXML_MAX_MB = 8
+
+
+def setBackend(name):
+    """Select the XML backend, 'auto' (by file size), 'lxml' or 'ElementTree'."""
+    global backend
+    if name not in BACKENDS:
+        raise ValueError('Unknown XML backend ' + name)
+    if name == 'lxml' and lxmlTree is None:
+        raise ValueError('lxml is not installed')
+    backend = name
+
+
+def fileBackend(filename):
+    """Backend used to parse filename."""
+    if backend != 'auto':
+        return backend
+    if lxmlTree is not None and os.path.getsize(filename) <= LXML_MAX_MB * 1024 * 1024:
+        return 'lxml'
+    return 'ElementTree'
+
+
+def parse(filename):
+    """Parse an XML file, returns the tree."""
+    if fileBackend(filename) == 'lxml':
+        # huge_tree lifts the limits of libxml2 on very large proposals
+        return lxmlTree.parse(filename, lxmlTree.XMLParser(huge_tree=True))
+    return ElementTree.ElementTree(file=filename)
+
+
+def descendantTexts(element, tags):
+    """
+    Texts of the descendants of element with one of the tags, in document
+    order, as a dictionary of lists. Same as findall('.//' + tag) for each
+    tag, but in a single pass over the element.
+    """
+    texts = {tag: [] for tag in tags}
+    if lxmlTree is not None and isinstance(element, lxmlTree._Element):
+        nodes = element.iter(*texts)  # tags selected by lxml in C
+    else:
+        nodes = element.iter()
+    for node in nodes:
+        if node is not element and node.tag in texts:
+            texts[node.tag].append(node.text)
+    return texts
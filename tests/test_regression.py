@@ -0,0 +1,11 @@
+"""Golden output of the regression corpus, see obsmaker.regression."""
+import os
+
+from obsmaker.regression import check
+
+GOLDEN = os.path.join(os.path.dirname(__file__), 'golden')
+
+
+def test_golden_output():
+    # times recorded on another machine are no budget, only the files are compared
+    assert check(GOLDEN, time_factor=None, memory=False)